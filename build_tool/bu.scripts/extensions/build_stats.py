@@ -0,0 +1,126 @@
+"""Reports on the build metrics recorded by recent builds."""
+import argparse
+
+import mool.build_metrics as bm
+
+
+def _parse_command_line(program_name, cmd_line):
+  """Parse command line to generate arguments."""
+  parser = argparse.ArgumentParser(prog=program_name)
+  parser.add_argument('-n', '--runs', type=int, default=20,
+                      help='number of recent builds to report on')
+  parser.add_argument('-k', '--top', type=int, default=10,
+                      help='number of rules listed in every report')
+  return parser.parse_args(cmd_line)
+
+
+def _median(values):
+  """Get median of a non empty list."""
+  values = sorted(values)
+  return values[len(values) / 2]
+
+
+def _get_build_times(records):
+  """Get the times of records that actually built a rule."""
+  return [bm.get_rule_time(r) for r in records
+          if r[bm.STATUS_INDEX] != bm.STATUS_CACHED]
+
+
+def get_slowest_rules(runs, top):
+  """Get (rule, median seconds, builds) of the slowest rules."""
+  result = []
+  for rule_symbol, records in bm.get_rule_history(runs).iteritems():
+    times = _get_build_times(records)
+    if times:
+      result.append((rule_symbol, _median(times), len(times)))
+  result.sort(key=lambda r: (-r[1], r[0]))
+  return result[:top]
+
+
+def get_regressed_rules(runs, top):
+  """Get (rule, median seconds of earlier builds, seconds of the latest build)
+  of the rules whose latest build took longer than usual, worst first."""
+  result = []
+  for rule_symbol, records in bm.get_rule_history(runs).iteritems():
+    times = _get_build_times(records)
+    if len(times) < 2:
+      continue
+    baseline = _median(times[:-1])
+    if times[-1] > baseline:
+      result.append((rule_symbol, baseline, times[-1]))
+  result.sort(key=lambda r: (r[1] - r[2], r[0]))
+  return result[:top]
+
+
+def get_cache_stats(runs):
+  """Get counts of rules found up to date, restored from the action cache
+  and built."""
+  stats = {bm.STATUS_UP_TO_DATE: 0, bm.STATUS_CACHED: 0, bm.STATUS_BUILT: 0}
+  for run in runs:
+    stats[bm.STATUS_UP_TO_DATE] += run['up_to_date']
+    for record in run['rules'].itervalues():
+      stats[record[bm.STATUS_INDEX]] += 1
+  return stats
+
+
+def get_rebuilt_rules(all_runs, runs, top):
+  """Get (rule, count) of the rules most often rebuilt because their
+  snapshot no longer matched, i.e. rules built again after an earlier build
+  of them was recorded."""
+  first_run = len(all_runs) - len(runs)
+  seen = set()
+  for run in all_runs[:first_run]:
+    seen.update(run['rules'])
+  counts = {}
+  for run in runs:
+    for rule_symbol, record in run['rules'].iteritems():
+      if (rule_symbol in seen and
+          record[bm.STATUS_INDEX] != bm.STATUS_UP_TO_DATE):
+        counts[rule_symbol] = counts.get(rule_symbol, 0) + 1
+    seen.update(run['rules'])
+  result = sorted(counts.items(), key=lambda r: (-r[1], r[0]))
+  return result[:top]
+
+
+def _get_percent(count, total):
+  """Format a ratio as percentage."""
+  return '{:.1f}%'.format(100.0 * count / total) if total else '-'
+
+
+def get_report(all_runs, num_runs, top):
+  """Get text of all the reports."""
+  runs = all_runs[-num_runs:]
+  lines = ['Build metrics of the last {} build(s).'.format(len(runs))]
+  lines.append('\nSlowest rules (median seconds, builds):')
+  for rule_symbol, seconds, count in get_slowest_rules(runs, top):
+    lines.append('  {:8.2f} {:4d}  {}'.format(seconds, count, rule_symbol))
+  lines.append('\nRegressed rules (usual seconds -> latest seconds):')
+  for rule_symbol, baseline, latest in get_regressed_rules(runs, top):
+    lines.append('  {:8.2f} -> {:8.2f}  {}'.format(baseline, latest,
+                                                  rule_symbol))
+  stats = get_cache_stats(runs)
+  total = sum(stats.values())
+  compiled = stats[bm.STATUS_CACHED] + stats[bm.STATUS_BUILT]
+  lines.append('\nCache hit rates:')
+  lines.append('  up to date       {:8d}  {}'.format(
+      stats[bm.STATUS_UP_TO_DATE],
+      _get_percent(stats[bm.STATUS_UP_TO_DATE], total)))
+  lines.append('  action cache hit {:8d}  {} of rules not up to date'.format(
+      stats[bm.STATUS_CACHED], _get_percent(stats[bm.STATUS_CACHED],
+                                            compiled)))
+  lines.append('  built            {:8d}'.format(stats[bm.STATUS_BUILT]))
+  lines.append('\nMost often rebuilt rules (snapshot mismatches):')
+  for rule_symbol, count in get_rebuilt_rules(all_runs, runs, top):
+    lines.append('  {:8d}  {}'.format(count, rule_symbol))
+  return '\n'.join(lines)
+
+
+def main(program_name, cmd_line):
+  """Print reports on recent builds."""
+  args = _parse_command_line(program_name, cmd_line)
+  all_runs = bm.load_runs()
+  if not all_runs:
+    print 'No build metrics recorded yet.'
+    return (0, '')
+  print get_report(all_runs, args.runs, args.top)
+  return (0, '')
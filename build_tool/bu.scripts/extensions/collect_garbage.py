@@ -0,0 +1,60 @@
+"""Deletes the build files of removed rules and evicts least recently used
+rules above the size budget of the build directories. Index files and API
+digests of jars no longer built or downloaded are deleted too."""
+import argparse
+
+import mool.build_gc as bg
+import mool.dep_index as di
+import mool.file_snapshot as fs
+import mool.jar_index as ji
+import mool.java_abi as ja
+import mool.test_cache as tc
+
+
+def _parse_command_line(program_name, cmd_line):
+  """Parse command line to generate arguments."""
+  parser = argparse.ArgumentParser(prog=program_name)
+  parser.add_argument('--max-mb', type=int, default=None,
+                      help=('size budget of the build directories in '
+                            'megabytes, defaults to $BUILD_DIRS_MAX_MB, 0 '
+                            'for no limit'))
+  return parser.parse_args(cmd_line)
+
+
+def _get_megabytes(num_bytes):
+  """Format a number of bytes in megabytes."""
+  return '{:.1f} MB'.format(num_bytes / (1024.0 * 1024))
+
+
+def main(program_name, cmd_line):
+  """Collect garbage in the build directories."""
+  args = _parse_command_line(program_name, cmd_line)
+  if args.max_mb is None:
+    max_size_bytes = bg.get_max_size_bytes()
+  else:
+    max_size_bytes = max(args.max_mb, 0) * 1024 * 1024
+  dep_index = di.DepIndex()
+  dep_index.refresh()
+  ledger = bg.BuildLedger()
+  deleted_rules, deleted_bytes = bg.remove_deleted_rules(
+      ledger, dep_index.get_rules(), dep_index.get_broken_rule_paths())
+  print 'Deleted {} removed rule(s), {}.'.format(
+      len(deleted_rules), _get_megabytes(deleted_bytes))
+  test_cache = tc.TestCache()
+  test_cache.forget_rules(deleted_rules)
+  if max_size_bytes:
+    evicted_rules, evicted_bytes = bg.evict(ledger, max_size_bytes)
+    print 'Evicted {} least recently used rule(s), {}.'.format(
+        evicted_rules, _get_megabytes(evicted_bytes))
+  # Jars are indexed by digest, so the index files of jars no longer around
+  # are found by the digests of the files still known.
+  digests = fs.DIGEST_CACHE.get_digests()
+  removed_indexes = ji.JAR_INDEX.remove_unused(digests)
+  print 'Deleted {} unused jar index file(s).'.format(removed_indexes)
+  removed_abi_digests = ja.ABI_DIGEST_CACHE.remove_unused(digests)
+  print 'Forgot API digests of {} unused jar(s).'.format(removed_abi_digests)
+  ledger.save()
+  test_cache.save()
+  fs.DIGEST_CACHE.save()
+  ja.ABI_DIGEST_CACHE.save()
+  return (0, '')
@@ -2,9 +2,12 @@
 here with an appropriate command name."""
 
 import extensions.bld_formatter
+import extensions.build_stats
 import extensions.bump_mvn_version
+import extensions.collect_garbage
 import extensions.dep_tree
 import extensions.pom_builder
+import extensions.rule_query
 import extensions.setup_eclipse_project
 
 
@@ -16,8 +19,14 @@ EXTENSION_COMMANDS = {
     'bump_mvn_version': ('_handle_bump_mvn_version',
                          'update maven rule version in a given BLD file'),
     'dep_tree': ('_handle_dep_tree', 'prints dependency tree for given rule'),
+    'gc': ('_handle_gc',
+           'deletes build files of removed and least recently used rules'),
+    'query': ('_handle_query',
+              'queries dependencies of rules without building them'),
     'setup_eclipse_project': ('_handle_setup_eclipse_project',
-                              'creates metadata files for eclipse project')
+                              'creates metadata files for eclipse project'),
+    'stats': ('_handle_stats',
+              'reports slow, regressed and often rebuilt rules')
 }
 
 
@@ -41,11 +50,26 @@ def _handle_dep_tree(program_name, params, _):
   return extensions.dep_tree.main(program_name, params)
 
 
+def _handle_gc(program_name, params, _):
+  """Handler function for gc command."""
+  return extensions.collect_garbage.main(program_name, params)
+
+
+def _handle_query(program_name, params, _):
+  """Handler function for query command."""
+  return extensions.rule_query.main(program_name, params)
+
+
 def _handle_setup_eclipse_project(program_name, params, _):
   """Handler function for setup_eclipse_project command."""
   return extensions.setup_eclipse_project.main(program_name, params)
 
 
+def _handle_stats(program_name, params, _):
+  """Handler function for stats command."""
+  return extensions.build_stats.main(program_name, params)
+
+
 def generic_extension_handler(params, dependency_dict):
   """Generic extension handler visible outside."""
   handler = globals()[EXTENSION_COMMANDS[params[0]][0]]
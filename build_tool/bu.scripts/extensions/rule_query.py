@@ -0,0 +1,343 @@
+"""Queries the graph of build rules without building them.
+
+A query is an expression over sets of rules:
+  mool.path.rule           a rule, or all (light) rules of a BLD file with
+                           mool.path.ALL (mool.path.LIGHTRULES)
+  deps(x[, depth])         x and the rules it depends on
+  rdeps(u, x[, depth])     rules depending on x among u and its deps
+  somepath(x, y)           rules on a dependency path from x to y
+  allpaths(x, y)           rules on all dependency paths from x to y
+  kind(pattern, x)         rules of x whose rule_type matches pattern
+  attr(key[, pattern], x)  rules of x having key set, or matching pattern
+  x + y, x ^ y, x - y      union, intersection and difference
+Operators apply from left to right and must be separated by spaces. Only the
+rules named by the query and their dependencies are loaded. Rule sets are
+sets of rule graph nodes, which are walked through the adjacency lists of
+the graph.
+"""
+import argparse
+import collections
+import json
+import re
+
+import mool.rule_builder as rb
+import mool.rule_graph as rg
+import mool.shared_utils as su
+
+OUTPUT_FORMATS = ['text', 'json', 'dot']
+OPERATORS = {'+': 'union', '^': 'intersect', '-': 'except',
+             'union': 'union', 'intersect': 'intersect', 'except': 'except'}
+# Function name -> (minimum arguments, maximum arguments, positions of the
+# arguments that are rule sets). Other arguments are plain words.
+FUNCTIONS = {
+    'allpaths': (2, 2, [0, 1]),
+    'attr': (2, 3, [-1]),
+    'deps': (1, 2, [0]),
+    'kind': (2, 2, [-1]),
+    'rdeps': (2, 3, [0, 1]),
+    'somepath': (2, 2, [0, 1])}
+# Words may be quoted, e.g. patterns like "java_(lib|bin)".
+TOKEN_RE = re.compile(r'"[^"]*"|[(),]|[^\s(),"]+')
+
+
+class Error(su.Error):
+  """Error class for this module."""
+
+
+def _parse_command_line(program_name, cmd_line):
+  """Parse command line to generate arguments."""
+  parser = argparse.ArgumentParser(prog=program_name)
+  parser.add_argument('--output', choices=OUTPUT_FORMATS, default='text',
+                      help='output format, defaults to text')
+  parser.add_argument('expression', nargs='+',
+                      help='query expression, e.g. "deps(mool.x.y, 1)"')
+  return parser.parse_args(cmd_line)
+
+
+class _Parser(object):
+  """Recursive descent parser of query expressions. Expressions are parsed
+  into tuples ('rules', pattern), ('call', name, args) and
+  ('op', operator, left, right)."""
+  def __init__(self, text):
+    """Initialize."""
+    self._tokens = TOKEN_RE.findall(text)
+    self._position = 0
+
+  def _peek(self):
+    """Get the next token without consuming it."""
+    if self._position < len(self._tokens):
+      return self._tokens[self._position]
+    return None
+
+  def _next(self, expected=None):
+    """Consume the next token."""
+    token = self._peek()
+    if token is None:
+      raise Error('Unexpected end of query')
+    if expected and token != expected:
+      raise Error('Expected "{}" but found "{}" in query'.format(
+          expected, token))
+    self._position += 1
+    return token
+
+  def parse(self):
+    """Parse the whole query."""
+    expression = self._parse_expression()
+    if self._peek() is not None:
+      raise Error('Unexpected "{}" in query'.format(self._peek()))
+    return expression
+
+  def _parse_expression(self):
+    """Parse operands joined by operators."""
+    expression = self._parse_operand()
+    while self._peek() in OPERATORS:
+      operator = OPERATORS[self._next()]
+      expression = ('op', operator, expression, self._parse_operand())
+    return expression
+
+  def _parse_operand(self):
+    """Parse a rule pattern, a function call or a parenthesized expression."""
+    token = self._next()
+    if token == '(':
+      expression = self._parse_expression()
+      self._next(')')
+      return expression
+    if token in [')', ','] or token in OPERATORS:
+      raise Error('Unexpected "{}" in query'.format(token))
+    if self._peek() != '(':
+      if not token.startswith(su.BUILD_RULE_PREFIX):
+        raise Error('Not a rule in query: {}'.format(token))
+      return ('rules', token)
+    if token not in FUNCTIONS:
+      raise Error('Unknown query function: {}'.format(token))
+    self._next('(')
+    raw_args = [self._parse_argument()]
+    while self._peek() == ',':
+      self._next()
+      raw_args.append(self._parse_argument())
+    self._next(')')
+    min_args, max_args, expr_positions = FUNCTIONS[token]
+    if not min_args <= len(raw_args) <= max_args:
+      raise Error('{}() takes {} to {} arguments'.format(
+          token, min_args, max_args))
+    expr_positions = [p % len(raw_args) for p in expr_positions]
+    args = []
+    for position, (arg_token, arg_expression) in enumerate(raw_args):
+      if position in expr_positions:
+        if arg_expression is None:
+          raise Error('Argument {} of {}() must be rules'.format(
+              position + 1, token))
+        args.append(arg_expression)
+      elif arg_token is None:
+        raise Error('Argument {} of {}() must be a word'.format(
+            position + 1, token))
+      else:
+        args.append(arg_token)
+    return ('call', token, args)
+
+  def _parse_argument(self):
+    """Parse a function argument, which may either be a word or a rule set.
+    Returns (word or None, expression or None)."""
+    token = self._peek()
+    following = (self._tokens[self._position + 1]
+                 if self._position + 1 < len(self._tokens) else None)
+    if token not in [None, '(', ')', ','] and following in [',', ')']:
+      self._next()
+      if token.startswith('"'):
+        return (token[1:-1], None)
+      if token.startswith(su.BUILD_RULE_PREFIX):
+        return (token, ('rules', token))
+      return (token, None)
+    return (None, self._parse_expression())
+
+
+def parse_query(text):
+  """Parse a query expression."""
+  return _Parser(text).parse()
+
+
+def get_rule_patterns(expression):
+  """Get all the rule patterns named in a parsed query."""
+  if expression[0] == 'rules':
+    return [expression[1]]
+  if expression[0] == 'op':
+    return get_rule_patterns(expression[2]) + get_rule_patterns(expression[3])
+  patterns = []
+  for arg in expression[2]:
+    if isinstance(arg, tuple):
+      patterns.extend(get_rule_patterns(arg))
+  return patterns
+
+
+def _get_depth(text):
+  """Get a depth argument."""
+  if not text.isdigit():
+    raise Error('Invalid depth in query: {}'.format(text))
+  return int(text)
+
+
+class QueryEngine(object):
+  """Evaluates parsed queries over the rules loaded by a rule builder."""
+  def __init__(self, builder):
+    """Initialize."""
+    self._rules_map = builder.get_rules_map()
+    self._graph = builder.get_rule_graph()
+    # Rule path -> nodes of the loaded rules defined in its BLD file.
+    self._path_nodes = collections.defaultdict(list)
+    for node in xrange(self._graph.size()):
+      rule_details = self._get_details(node)
+      self._path_nodes[rule_details[su.PATH_KEY]].append(node)
+
+  def _get_details(self, node):
+    """Get rule details of a node."""
+    return self._rules_map[self._graph.get_symbol(node)]
+
+  def _get_rules(self, pattern):
+    """Get nodes of a rule pattern."""
+    path, name = pattern.rsplit(su.RULE_SEPARATOR, 1)
+    if name == su.ALL_RULES_KEY:
+      return set(self._path_nodes[path])
+    if name == su.ALL_LIGHT_RULES_KEY:
+      return set([
+          n for n in self._path_nodes[path]
+          if self._get_details(n).get(su.RULE_WEIGHT_KEY, None) is None])
+    return set([self._graph.get_node(pattern)])
+
+  @classmethod
+  def _walk(cls, nodes, get_next, depth=None):
+    """Get nodes reachable from the given ones within depth steps."""
+    reached = set(nodes)
+    frontier = list(nodes)
+    while frontier and depth != 0:
+      next_frontier = []
+      for node in frontier:
+        for next_node in get_next(node):
+          if next_node not in reached:
+            reached.add(next_node)
+            next_frontier.append(next_node)
+      frontier = next_frontier
+      depth = None if depth is None else depth - 1
+    return reached
+
+  def _somepath(self, from_nodes, to_nodes):
+    """Get nodes of a shortest dependency path from any of from_nodes to any
+    of to_nodes, if there is one."""
+    parents = dict([(n, None) for n in from_nodes])
+    frontier = collections.deque(sorted(from_nodes))
+    while frontier:
+      node = frontier.popleft()
+      if node in to_nodes:
+        path = set()
+        while node is not None:
+          path.add(node)
+          node = parents[node]
+        return path
+      for dep in self._graph.get_deps(node):
+        if dep not in parents:
+          parents[dep] = node
+          frontier.append(dep)
+    return set()
+
+  @classmethod
+  def _matches(cls, value, regex):
+    """Check if an attribute value matches. Items of list values are matched
+    one by one, like the rules of dependency closures."""
+    if isinstance(value, (list, rg.RuleSet)):
+      return any([cls._matches(v, regex) for v in value])
+    if isinstance(value, dict):
+      value = json.dumps(value, sort_keys=True)
+    return bool(regex.search(unicode(value)))
+
+  def _attr(self, key, pattern, nodes):
+    """Filter nodes by an attribute of their rule details."""
+    regex = re.compile(pattern) if pattern is not None else None
+    result = set()
+    for node in nodes:
+      value = self._get_details(node).get(key, None)
+      if regex is None:
+        matched = bool(value)
+      else:
+        matched = value is not None and self._matches(value, regex)
+      if matched:
+        result.add(node)
+    return result
+
+  def _call(self, name, args):
+    """Evaluate a query function."""
+    graph = self._graph
+    if name == 'deps':
+      depth = _get_depth(args[1]) if len(args) > 1 else None
+      return self._walk(self.evaluate(args[0]), graph.get_deps, depth)
+    if name == 'rdeps':
+      universe = self._walk(self.evaluate(args[0]), graph.get_deps)
+      depth = _get_depth(args[2]) if len(args) > 2 else None
+      targets = self.evaluate(args[1]).intersection(universe)
+      return self._walk(
+          targets, lambda n: [r for r in graph.get_rdeps(n) if r in universe],
+          depth)
+    if name == 'somepath':
+      return self._somepath(self.evaluate(args[0]), self.evaluate(args[1]))
+    if name == 'allpaths':
+      return self._walk(self.evaluate(args[0]), graph.get_deps).intersection(
+          self._walk(self.evaluate(args[1]), graph.get_rdeps))
+    if name == 'kind':
+      regex = re.compile(args[0])
+      return set([n for n in self.evaluate(args[1])
+                  if regex.search(self._get_details(n)[su.TYPE_KEY])])
+    assert name == 'attr'
+    pattern = args[1] if len(args) == 3 else None
+    return self._attr(args[0], pattern, self.evaluate(args[-1]))
+
+  def evaluate(self, expression):
+    """Evaluate a parsed query to a set of nodes."""
+    if expression[0] == 'rules':
+      return self._get_rules(expression[1])
+    if expression[0] == 'call':
+      return self._call(expression[1], expression[2])
+    left = self.evaluate(expression[2])
+    right = self.evaluate(expression[3])
+    if expression[1] == 'union':
+      return left.union(right)
+    if expression[1] == 'intersect':
+      return left.intersection(right)
+    return left.difference(right)
+
+  def format_result(self, nodes, output_format):
+    """Format the rules of a query result, in order of their symbols."""
+    graph = self._graph
+    nodes = sorted(nodes)
+    symbols = [graph.get_symbol(n) for n in nodes]
+    if output_format == 'text':
+      return '\n'.join(symbols)
+    if output_format == 'json':
+      return json.dumps(
+          [{'name': graph.get_symbol(n),
+            'rule_type': self._get_details(n)[su.TYPE_KEY],
+            'deps': [graph.get_symbol(d) for d in graph.get_deps(n)]}
+           for n in nodes], indent=2, sort_keys=True)
+    node_set = set(nodes)
+    lines = ['digraph mool {']
+    lines.extend(['  "{}";'.format(s) for s in symbols])
+    for node in nodes:
+      lines.extend(['  "{}" -> "{}";'.format(graph.get_symbol(node),
+                                             graph.get_symbol(d))
+                    for d in graph.get_deps(node) if d in node_set])
+    lines.append('}')
+    return '\n'.join(lines)
+
+
+def run_query(text, output_format='text'):
+  """Load the rules named by a query and get its formatted result."""
+  expression = parse_query(text)
+  builder = rb.RuleBuilder(get_rule_patterns(expression))
+  engine = QueryEngine(builder)
+  return engine.format_result(engine.evaluate(expression), output_format)
+
+
+def main(program_name, cmd_line):
+  """Print the result of a query."""
+  args = _parse_command_line(program_name, cmd_line)
+  result = run_query(' '.join(args.expression), args.output)
+  if result:
+    print result
+  return (0, '')
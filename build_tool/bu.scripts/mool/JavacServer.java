@@ -0,0 +1,65 @@
+import java.io.BufferedOutputStream;
+import java.io.BufferedReader;
+import java.io.ByteArrayOutputStream;
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.io.InputStreamReader;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.nio.charset.Charset;
+import javax.tools.JavaCompiler;
+import javax.tools.ToolProvider;
+
+/**
+ * Compiles Java sources for bu in a long lived JVM, see compile_server.py.
+ *
+ * Requests are read from stdin, one at a time: a line with the number of
+ * compiler arguments, followed by one line per argument. Each is answered on
+ * stdout with a line holding the compiler exit code and the size of its output
+ * in bytes, followed by the output.
+ */
+public final class JavacServer {
+  private static final Charset UTF8 = Charset.forName("UTF-8");
+  // Exit code of javac for abnormal termination.
+  private static final int ABNORMAL_EXIT_CODE = 4;
+
+  private JavacServer() {
+  }
+
+  public static void main(String[] args) throws IOException {
+    BufferedReader in = new BufferedReader(
+        new InputStreamReader(System.in, UTF8));
+    OutputStream out = new BufferedOutputStream(
+        new FileOutputStream(FileDescriptor.out));
+    // Nothing else may write to the stream of replies.
+    System.setOut(System.err);
+    JavaCompiler compiler = ToolProvider.getSystemJavaCompiler();
+    if (compiler == null) {
+      System.err.println("No Java compiler available, is this a JRE?");
+      System.exit(1);
+    }
+    String line;
+    while ((line = in.readLine()) != null) {
+      String[] compilerArgs = new String[Integer.parseInt(line.trim())];
+      for (int i = 0; i < compilerArgs.length; i++) {
+        compilerArgs[i] = in.readLine();
+        if (compilerArgs[i] == null) {
+          return;
+        }
+      }
+      ByteArrayOutputStream output = new ByteArrayOutputStream();
+      int exitCode;
+      try {
+        exitCode = compiler.run(null, output, output, compilerArgs);
+      } catch (RuntimeException e) {
+        e.printStackTrace(new PrintStream(output, true));
+        exitCode = ABNORMAL_EXIT_CODE;
+      }
+      byte[] outputBytes = output.toByteArray();
+      out.write((exitCode + " " + outputBytes.length + "\n").getBytes(UTF8));
+      out.write(outputBytes);
+      out.flush();
+    }
+  }
+}
@@ -0,0 +1,284 @@
+"""Content addressed local cache of rule outputs.
+
+A cache entry is keyed by a digest of the build commands of a rule and the
+contents of all its input files. Paths are normalized relative to BUILD_ROOT,
+BUILD_OUT_DIR and BUILD_WORK_DIR so that entries can be shared between
+checkouts. The cache lives outside the build directories and therefore
+survives do_clean and branch switches. Least recently used entries are evicted
+at the end of a build which stored entries, or as soon as the entries stored
+since push the cache beyond its size limit.
+
+Every entry holds a manifest mapping output paths to content digests and one
+file per distinct digest, which is also the layout used by the shared remote
+cache (see remote_cache.py). Local misses are looked up remotely and new local
+entries are pushed when configured.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+import mool.file_snapshot as fs
+import mool.remote_cache as rc
+import mool.shared_utils as su
+
+# Bump this whenever the way commands are executed changes in a way that is
+# not visible in the command lists.
+CACHE_FORMAT_VERSION = '2'
+MANIFEST_FILE_NAME = 'manifest.json'
+OUTPUT_KEYS = (su.OUT_KEY, su.OUT_HEADERS_KEY, su.EXPORTED_MVN_DEPS_FILE_KEY)
+
+
+def get_rule_outputs(rule_details):
+  """Get list of all the files emitted by a rule."""
+  outputs = []
+  for key in OUTPUT_KEYS:
+    value = rule_details.get(key, [])
+    if isinstance(value, str):
+      outputs.append(value)
+    else:
+      outputs.extend(value)
+  return sorted(list(set(outputs)))
+
+
+def _get_dir_size(dir_path):
+  """Get total size of all files inside a directory."""
+  total_size = 0
+  for root, _, files in os.walk(dir_path):
+    for file_name in files:
+      total_size += os.path.getsize(os.path.join(root, file_name))
+  return total_size
+
+
+class ActionCache(object):
+  """Local action cache of rule outputs."""
+  def __init__(self, cache_dir, max_size_bytes, remote_cache=None):
+    """Initialize."""
+    self._cache_dir = cache_dir
+    self._max_size_bytes = max_size_bytes
+    self._remote_cache = remote_cache
+    self._lock = threading.Lock()
+    self._stats = self._new_stats()
+    # Size of the cache as of the last eviction plus the entries stored since,
+    # None until the cache is first scanned.
+    self._total_size = None
+    self._stored_entries = False
+
+  @classmethod
+  def _new_stats(cls):
+    """Get zeroed cache statistics."""
+    return {'hits': 0, 'remote_hits': 0, 'misses': 0}
+
+  def enabled(self):
+    """Checks if the cache should be used."""
+    return (not su.TEST_MODE_EXECUTION) and self._max_size_bytes > 0
+
+  def _entry_dir(self, cache_key):
+    """Get directory of a cache entry."""
+    return os.path.join(self._cache_dir, cache_key[:2], cache_key)
+
+  def get_key(self, rule_details, file_list, command_list):
+    """Get cache key of a rule, None if the rule cannot be cached."""
+    if not self.enabled():
+      return None
+    outputs = get_rule_outputs(rule_details)
+    if not outputs or not all(
+        [su.child_contained_in(f, su.BUILD_OUT_DIR) for f in outputs]):
+      return None
+    key_hash = hashlib.sha1()
+    key_hash.update(CACHE_FORMAT_VERSION)
+    key_hash.update(su.log_normalize(
+        json.dumps(command_list, sort_keys=True, default=str)))
+    for file_path in sorted(set(file_list).difference(outputs)):
+      if not su.path_isfile(file_path):
+        logging.debug('Not caching %s, missing input %s',
+                      rule_details[su.SYMBOL_KEY], file_path)
+        return None
+      key_hash.update('\n{} {}'.format(su.log_normalize(file_path),
+                                       fs.DIGEST_CACHE.get_digest(file_path)))
+    return key_hash.hexdigest()
+
+  def _count(self, stat_name):
+    """Update a statistic."""
+    with self._lock:
+      self._stats[stat_name] += 1
+
+  def restore(self, cache_key, rule_details):
+    """Restore outputs of a rule from cache. Returns True on cache hit."""
+    if self._restore_local(cache_key, rule_details):
+      self._count('hits')
+      return True
+    if ((self._fetch_remote(cache_key) and
+         self._restore_local(cache_key, rule_details))):
+      self._count('remote_hits')
+      return True
+    self._count('misses')
+    return False
+
+  def _restore_local(self, cache_key, rule_details):
+    """Restore outputs of a rule from local cache entry."""
+    entry_dir = self._entry_dir(cache_key)
+    manifest_file = os.path.join(entry_dir, MANIFEST_FILE_NAME)
+    if not os.path.exists(manifest_file):
+      return False
+    try:
+      manifest = json.loads(su.read_file(manifest_file))
+      outputs = get_rule_outputs(rule_details)
+      if sorted(manifest) != [os.path.relpath(f, su.BUILD_OUT_DIR)
+                              for f in outputs]:
+        return False
+      for out_file in outputs:
+        details = manifest[os.path.relpath(out_file, su.BUILD_OUT_DIR)]
+        out_dir = os.path.dirname(out_file)
+        if not os.path.isdir(out_dir):
+          os.makedirs(out_dir)
+        shutil.copyfile(os.path.join(entry_dir, details['digest']), out_file)
+        os.chmod(out_file, details['mode'])
+      # Touching the entry keeps it away from eviction.
+      os.utime(entry_dir, None)
+    except (IOError, OSError, ValueError, KeyError) as exc:
+      logging.debug('Action cache miss for %s: %s',
+                    rule_details[su.SYMBOL_KEY], exc)
+      return False
+    return True
+
+  def _fetch_remote(self, cache_key):
+    """Fetch an entry from remote cache into local cache."""
+    if not self._remote_cache:
+      return False
+    entry_dir = self._entry_dir(cache_key)
+    temp_dir = self._make_temp_dir(entry_dir)
+    if not self._remote_cache.fetch_entry(cache_key, temp_dir,
+                                          MANIFEST_FILE_NAME):
+      shutil.rmtree(temp_dir, ignore_errors=True)
+      return False
+    self._commit_entry(temp_dir, entry_dir)
+    return True
+
+  @classmethod
+  def _make_temp_dir(cls, entry_dir):
+    """Create a temporary directory next to an entry."""
+    parent_dir = os.path.dirname(entry_dir)
+    if not os.path.isdir(parent_dir):
+      try:
+        os.makedirs(parent_dir)
+      except OSError:
+        if not os.path.isdir(parent_dir):
+          raise
+    return tempfile.mkdtemp(dir=parent_dir, prefix='.tmp.')
+
+  def _commit_entry(self, temp_dir, entry_dir):
+    """Atomically move a completed entry into place and enforce size limit
+    once it is known to be exceeded."""
+    entry_size = _get_dir_size(temp_dir)
+    try:
+      os.rename(temp_dir, entry_dir)
+    except OSError:
+      # Some other build stored the same entry first.
+      shutil.rmtree(temp_dir, ignore_errors=True)
+      return
+    with self._lock:
+      self._stored_entries = True
+      if self._total_size is None:
+        return
+      self._total_size += entry_size
+      if self._total_size <= self._max_size_bytes:
+        return
+    self._evict()
+
+  def store(self, cache_key, rule_details):
+    """Store outputs of a rule in cache."""
+    entry_dir = self._entry_dir(cache_key)
+    if os.path.exists(entry_dir):
+      return
+    temp_dir = self._make_temp_dir(entry_dir)
+    try:
+      manifest = {}
+      for out_file in get_rule_outputs(rule_details):
+        digest = fs.DIGEST_CACHE.get_digest(out_file)
+        # Copying dereferences outputs that are links to work directories.
+        shutil.copyfile(out_file, os.path.join(temp_dir, digest))
+        manifest[os.path.relpath(out_file, su.BUILD_OUT_DIR)] = {
+            'digest': digest, 'mode': os.stat(out_file).st_mode & 0777}
+      su.write_file(os.path.join(temp_dir, MANIFEST_FILE_NAME),
+                    json.dumps(manifest, sort_keys=True))
+    except (IOError, OSError) as exc:
+      logging.debug('Could not cache outputs of %s: %s',
+                    rule_details[su.SYMBOL_KEY], exc)
+      shutil.rmtree(temp_dir, ignore_errors=True)
+      return
+    self._commit_entry(temp_dir, entry_dir)
+    if self._remote_cache:
+      self._remote_cache.push_entry(cache_key, entry_dir, MANIFEST_FILE_NAME)
+
+  def log_stats(self):
+    """Log cache statistics of this build."""
+    with self._lock:
+      stats = self._stats
+      self._stats = self._new_stats()
+    if not any(stats.values()):
+      return
+    logging.info('Action cache: %d hits, %d remote hits, %d misses.',
+                 stats['hits'], stats['remote_hits'], stats['misses'])
+    if self._remote_cache:
+      remote_stats = self._remote_cache.pop_stats()
+      logging.info(('Remote cache: %d hits, %d misses, %d pushes, %d errors, '
+                    '%.1f MB downloaded, %.1f MB uploaded.'),
+                   remote_stats['hits'], remote_stats['misses'],
+                   remote_stats['pushes'], remote_stats['errors'],
+                   remote_stats['bytes_down'] / (1024.0 * 1024),
+                   remote_stats['bytes_up'] / (1024.0 * 1024))
+
+  def close(self):
+    """Finish remote pushes, stop the remote transfer threads and enforce
+    size limit at the end of a build."""
+    if self._remote_cache:
+      self._remote_cache.close()
+    with self._lock:
+      stored_entries = self._stored_entries
+    if stored_entries:
+      self._evict()
+
+  def _evict(self):
+    """Evict least recently used entries above the size limit. The cache is
+    scanned again since other builds share it."""
+    with self._lock:
+      entries = []
+      total_size = 0
+      for prefix in os.listdir(self._cache_dir):
+        prefix_dir = os.path.join(self._cache_dir, prefix)
+        for entry in os.listdir(prefix_dir):
+          if entry.startswith('.tmp.'):
+            continue
+          entry_dir = os.path.join(prefix_dir, entry)
+          entry_size = _get_dir_size(entry_dir)
+          entries.append((os.path.getmtime(entry_dir), entry_dir, entry_size))
+          total_size += entry_size
+      for _, entry_dir, entry_size in sorted(entries):
+        if total_size <= self._max_size_bytes:
+          break
+        logging.debug('Evicting %s from action cache.', entry_dir)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total_size -= entry_size
+      self._total_size = total_size
+      self._stored_entries = False
+
+
+_ACTION_CACHE = []
+
+
+def get_action_cache():
+  """Get action cache configured from environment. It is shared by all the
+  builds of a process, which keeps remote transfer threads from piling up in
+  the build daemon."""
+  if not _ACTION_CACHE:
+    remote_cache = None
+    if not su.TEST_MODE_EXECUTION:
+      remote_cache = rc.get_remote_cache()
+    _ACTION_CACHE.append(ActionCache(
+        su.ACTION_CACHE_DIR, int(su.ACTION_CACHE_MAX_MB) * 1024 * 1024,
+        remote_cache))
+  return _ACTION_CACHE[0]
@@ -0,0 +1,305 @@
+"""Long lived build server keeping parsed build rules in memory.
+
+'bu do_daemon start' launches a background process listening on a unix socket
+tied to BUILD_WORK_DIR. Every later bu invocation connects to it and the
+command runs inside the server, where python modules are already loaded and
+unchanged BLD files need not be parsed again (see build_file_cache.py). The
+rules loaded and set up for the last few sets of target rules are kept too,
+and only the rules affected by changed BLD files are loaded again (see
+RuleBuilderCache in rule_builder.py). The server redirects its stdout and
+stderr to the client connection for the duration of a request, so output of
+build commands reaches the terminal as usual, and finally sends the return
+code.
+
+The client falls back to running the command itself whenever the server is
+not running, runs different code or was started with a different environment.
+"""
+import hashlib
+import json
+import logging
+import os
+import socket
+import sys
+import tempfile
+import time
+import traceback
+
+import mool.build_file_cache as bfc
+import mool.shared_utils as su
+
+DAEMON_COMMAND = 'do_daemon'
+DAEMON_HELP = 'manage the build server (start, stop, status or run).'
+EXIT_MARKER = '\0BU_EXIT '
+LOG_FILE_NAME = '.bu_daemon.log'
+READ_SIZE = 64 * 1024
+# Environment variables which do not affect builds and are allowed to differ
+# between the server and its clients.
+VOLATILE_ENV_VARS = ['OLDPWD', 'PWD', 'SHLVL', '_']
+REPLY_OK = 'OK'
+REPLY_REFUSED = 'REFUSED'
+STOP_REQUEST = 'stop'
+
+
+class Error(su.Error):
+  """Error class for this module."""
+
+
+def get_socket_path():
+  """Get path of the server socket for current work directory. Unix socket
+  paths are limited to about 100 characters, so it does not live inside the
+  work directory itself."""
+  dir_hash = hashlib.sha1(os.path.realpath(su.BUILD_WORK_DIR)).hexdigest()
+  return os.path.join(tempfile.gettempdir(), 'bu-{}-{}.sock'.format(
+      os.getuid(), dir_hash[:16]))
+
+
+def get_code_stamp():
+  """Get a stamp of the bu sources, which changes whenever any of them does."""
+  stamp = hashlib.sha1()
+  for sub_dir in ['mool', 'extensions']:
+    for root, _, files in os.walk(os.path.join(su.BU_SCRIPT_DIR, sub_dir)):
+      for file_name in sorted(files):
+        if file_name.endswith('.py'):
+          file_path = os.path.join(root, file_name)
+          stamp.update('{} {}\n'.format(file_path, os.path.getmtime(file_path)))
+  return stamp.hexdigest()
+
+
+def _get_build_env():
+  """Get environment variables which matter to builds."""
+  return dict([(k, v) for (k, v) in os.environ.iteritems()
+               if k not in VOLATILE_ENV_VARS])
+
+
+def _connect():
+  """Connect to the server, None if it is not running."""
+  client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    client.connect(get_socket_path())
+  except socket.error:
+    client.close()
+    return None
+  return client
+
+
+def _send_request(client, request):
+  """Send a request and read the one line reply header."""
+  client.sendall(json.dumps(request) + '\n')
+  # An unbuffered file reads the header byte by byte, leaving the output that
+  # follows it in the socket.
+  return client.makefile('rb', 0).readline().rstrip('\n')
+
+
+def run_client(cmd_line, output=None):
+  """Run a command inside the server. Returns its return code or None if the
+  command could not be run there."""
+  output = output or sys.stdout
+  client = _connect()
+  if not client:
+    return None
+  try:
+    header = _send_request(client, {
+        'argv': cmd_line, 'cwd': os.getcwd(), 'env': _get_build_env(),
+        'code_stamp': get_code_stamp()})
+    if header != REPLY_OK:
+      logging.debug('Build server did not accept request: %s', header)
+      return None
+    # Output is streamed as it arrives. The tail is held back until it is
+    # clear that it is not part of the return code trailer.
+    pending = ''
+    while True:
+      chunk = client.recv(READ_SIZE)
+      if not chunk:
+        break
+      pending += chunk
+      marker_index = pending.rfind(EXIT_MARKER[0])
+      flush_upto = len(pending) if marker_index < 0 else marker_index
+      output.write(pending[:flush_upto])
+      output.flush()
+      pending = pending[flush_upto:]
+    if not pending.startswith(EXIT_MARKER):
+      logging.error('Lost connection to build server.')
+      return 1
+    return int(pending[len(EXIT_MARKER):].strip())
+  finally:
+    client.close()
+
+
+class BuildServer(object):
+  """Serves bu commands one at a time over a unix socket."""
+  def __init__(self, socket_path, run_func, idle_timeout):
+    """Initialize. run_func takes a command line and returns its return
+    code."""
+    self._socket_path = socket_path
+    self._run_func = run_func
+    self._idle_timeout = idle_timeout
+    self._code_stamp = get_code_stamp()
+    self._env = _get_build_env()
+    self._cwd = os.getcwd()
+    self._server = None
+
+  def bind(self):
+    """Start listening on the socket."""
+    if os.path.exists(self._socket_path):
+      if _connect():
+        raise Error('Build server is already running on {}'.format(
+            self._socket_path))
+      # Left over by a server that did not shut down cleanly.
+      os.remove(self._socket_path)
+    self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self._server.bind(self._socket_path)
+    os.chmod(self._socket_path, 0600)
+    self._server.listen(8)
+
+  def serve(self):
+    """Serve requests until stopped or idle for too long."""
+    self._server.settimeout(self._idle_timeout)
+    try:
+      while True:
+        try:
+          connection, _ = self._server.accept()
+        except socket.timeout:
+          logging.info('Build server idle for %d seconds, exiting.',
+                       self._idle_timeout)
+          return
+        connection.settimeout(None)
+        try:
+          if not self._handle_connection(connection):
+            return
+        except socket.error as exc:
+          # The client went away, e.g. on Ctrl-C.
+          logging.info('Lost connection to client: %s', exc)
+        finally:
+          connection.close()
+    finally:
+      self._server.close()
+      os.remove(self._socket_path)
+
+  def _get_refusal(self, request):
+    """Get the reason to refuse a request, None if it is acceptable."""
+    if request.get('code_stamp') != self._code_stamp:
+      return 'bu sources changed since the server started'
+    if request.get('env') != self._env:
+      changed = sorted(set(self._env.items()).symmetric_difference(
+          request.get('env', {}).items()))
+      return 'environment differs: {}'.format(
+          ', '.join(sorted(set([k for (k, _) in changed]))))
+    return None
+
+  def _handle_connection(self, connection):
+    """Handle one request. Returns False when the server should stop."""
+    line = connection.makefile('rb', 0).readline()
+    if not line:
+      # Status checks connect without sending anything.
+      return True
+    try:
+      request = json.loads(line)
+    except ValueError:
+      connection.sendall('{} malformed request\n'.format(REPLY_REFUSED))
+      return True
+    if request == STOP_REQUEST:
+      connection.sendall('{}\n'.format(REPLY_OK))
+      return False
+    refusal = self._get_refusal(request)
+    if refusal:
+      connection.sendall('{} {}\n'.format(REPLY_REFUSED, refusal))
+      # Stale code would be refused for every later client too.
+      return request.get('code_stamp') == self._code_stamp
+    connection.sendall('{}\n'.format(REPLY_OK))
+    start_time = time.time()
+    ret_code = self._run_redirected(connection, request)
+    stats = bfc.BUILD_FILE_CACHE.pop_stats()
+    logging.debug('Served %s in %.2f seconds, BLD cache hits %d, misses %d.',
+                  ' '.join(request['argv']), time.time() - start_time,
+                  stats['hits'], stats['misses'])
+    connection.sendall('{}{}\n'.format(EXIT_MARKER, ret_code))
+    return True
+
+  def _run_redirected(self, connection, request):
+    """Run a request with stdout and stderr sent to the client."""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = [os.dup(1), os.dup(2)]
+    os.dup2(connection.fileno(), 1)
+    os.dup2(connection.fileno(), 2)
+    try:
+      os.chdir(request['cwd'].encode('utf-8'))
+      return self._run_func([a.encode('utf-8') for a in request['argv']])
+    except:
+      traceback.print_exc()
+      return 1
+    finally:
+      sys.stdout.flush()
+      sys.stderr.flush()
+      os.dup2(saved_fds[0], 1)
+      os.dup2(saved_fds[1], 2)
+      for saved_fd in saved_fds:
+        os.close(saved_fd)
+      os.chdir(self._cwd)
+
+
+def _daemonize(log_file):
+  """Detach from the terminal into background."""
+  child_pid = os.fork()
+  if child_pid:
+    os.waitpid(child_pid, 0)
+    return False
+  os.setsid()
+  if os.fork():
+    os._exit(0)  # pylint: disable=W0212
+  null_fd = os.open(os.devnull, os.O_RDONLY)
+  log_fd = os.open(log_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+  os.dup2(null_fd, 0)
+  os.dup2(log_fd, 1)
+  os.dup2(log_fd, 2)
+  return True
+
+
+def _stop_server():
+  """Ask a running server to exit."""
+  client = _connect()
+  if not client:
+    logging.info('Build server is not running.')
+    return 0
+  try:
+    _send_request(client, STOP_REQUEST)
+  finally:
+    client.close()
+  logging.info('Build server stopped.')
+  return 0
+
+
+def daemon_main(params, run_func):
+  """Handler for do_daemon command."""
+  action = params[0] if params else 'status'
+  socket_path = get_socket_path()
+  if action == 'status':
+    client = _connect()
+    if client:
+      client.close()
+    logging.info('Build server is %srunning on %s',
+                 '' if client else 'not ', socket_path)
+    return 0
+  if action == 'stop':
+    return _stop_server()
+  if action not in ['start', 'run']:
+    raise Error('Unknown do_daemon action "{}", expected one of start, stop, '
+                'status, run.'.format(action))
+  server = BuildServer(socket_path, run_func,
+                       int(su.BUILD_DAEMON_IDLE_MINUTES) * 60)
+  server.bind()
+  if action == 'start':
+    if not _daemonize(os.path.join(su.BUILD_WORK_DIR, LOG_FILE_NAME)):
+      logging.info('Build server started on %s', socket_path)
+      return 0
+    # Output of a client must not take down the server.
+    logging.raiseExceptions = False
+  try:
+    server.serve()
+  except:
+    logging.exception('Build server failed.')
+    raise
+  finally:
+    if action == 'start':
+      os._exit(0)  # pylint: disable=W0212
+  return 0
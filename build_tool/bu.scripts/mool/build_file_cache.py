@@ -0,0 +1,131 @@
+"""Cache of parsed BLD files.
+
+Parsing BLD files dominates the start up time of large builds. Every parsed
+file is kept as a marshalled blob along with the modification time and size
+of the file, so only BLD files that changed since they were last read are
+parsed again. The blobs are persisted in an index file under BUILD_WORK_DIR,
+which a new bu process loads with a single read and unmarshal. Concurrent bu
+processes load the index under a shared lock and save it under an exclusive
+one, merging in the BLD files parsed by the others. Individual blobs are only
+unmarshalled when their BLD file is needed, and doing so hands out a private
+copy of the rules, as rule builders update rule details in place. A long
+lived process (see build_daemon.py) additionally keeps the index in memory.
+"""
+import logging
+import marshal
+import os
+import tempfile
+import threading
+
+import mool.file_locks as fl
+import mool.shared_utils as su
+
+INDEX_FILE_NAME = '.bld_index'
+# Bump this whenever the normalization of BLD contents changes.
+INDEX_FORMAT_VERSION = 1
+# Readers share a lock on this file next to the index, which a writer takes
+# exclusively.
+LOCK_FILE_SUFFIX = '.lock'
+
+
+def _to_plain_types(obj):
+  """Convert ordered dictionaries to plain ones, which can be marshalled."""
+  if isinstance(obj, dict):
+    return dict([(k, _to_plain_types(v)) for (k, v) in obj.iteritems()])
+  if isinstance(obj, list):
+    return [_to_plain_types(i) for i in obj]
+  return obj
+
+
+class BuildFileCache(object):
+  """Parsed BLD files invalidated by modification time and size."""
+  def __init__(self, index_file):
+    """Initialize."""
+    self._index_file = index_file
+    # BLD file path -> (mtime, size, marshalled rules), loaded lazily.
+    self._entries = None
+    self._dirty = False
+    self._lock = threading.Lock()
+    self._stats = {'hits': 0, 'misses': 0}
+
+  def _read_index(self):
+    """Read the persisted index, if any."""
+    if not os.path.exists(self._index_file):
+      return {}
+    try:
+      with open(self._index_file, 'rb') as file_object:
+        header, entries = marshal.load(file_object)
+    except (EOFError, ValueError, TypeError) as exc:
+      logging.debug('Ignoring corrupt BLD index %s: %s', self._index_file, exc)
+      return {}
+    if header != (INDEX_FORMAT_VERSION, marshal.version):
+      return {}
+    return entries
+
+  def _load_index(self):
+    """Load the persisted index under a lock shared with other readers."""
+    self._entries = {}
+    if not self._index_file:
+      return
+    with fl.FileLocks([], [self._index_file + LOCK_FILE_SUFFIX]):
+      self._entries = self._read_index()
+
+  def get(self, file_path):
+    """Get a private copy of the rules defined in a BLD file."""
+    if su.TEST_MODE_EXECUTION:
+      # Unit tests serve BLD files from an in-memory filesystem.
+      return su.read_build_file(file_path)
+    stat_result = os.stat(file_path)
+    file_stamp = (stat_result.st_mtime, stat_result.st_size)
+    with self._lock:
+      if self._entries is None:
+        self._load_index()
+      entry = self._entries.get(file_path, None)
+      is_hit = bool(entry) and entry[:2] == file_stamp
+      self._stats['hits' if is_hit else 'misses'] += 1
+    if not is_hit:
+      entry = file_stamp + (
+          marshal.dumps(_to_plain_types(su.read_build_file(file_path))),)
+      with self._lock:
+        self._entries[file_path] = entry
+        self._dirty = True
+    return marshal.loads(entry[2])
+
+  def save(self):
+    """Persist the index if any BLD file was parsed since it was loaded.
+    Entries of BLD files which no longer exist are dropped."""
+    with self._lock:
+      if not self._dirty or not self._index_file:
+        return
+      entries = dict(self._entries)
+      self._dirty = False
+    index_dir = os.path.dirname(self._index_file)
+    with fl.FileLocks([self._index_file + LOCK_FILE_SUFFIX]):
+      # Keep the BLD files parsed by concurrent builds since loading.
+      for file_path, entry in self._read_index().iteritems():
+        entries.setdefault(file_path, entry)
+      entries = dict([(k, v) for (k, v) in entries.iteritems()
+                      if os.path.exists(k)])
+      file_handle, temp_path = tempfile.mkstemp(dir=index_dir, prefix='.tmp.')
+      try:
+        with os.fdopen(file_handle, 'wb') as file_object:
+          marshal.dump(((INDEX_FORMAT_VERSION, marshal.version), entries),
+                       file_object)
+        os.rename(temp_path, self._index_file)
+      except (IOError, OSError) as exc:
+        logging.debug('Could not save BLD index: %s', exc)
+        if os.path.exists(temp_path):
+          os.remove(temp_path)
+
+  def pop_stats(self):
+    """Get and reset hit and miss counts."""
+    with self._lock:
+      stats = self._stats
+      self._stats = {'hits': 0, 'misses': 0}
+    return stats
+
+
+# BLD files parsed by this process. It outlives a single rule builder when
+# running inside the build daemon.
+BUILD_FILE_CACHE = BuildFileCache(
+    os.path.join(su.BUILD_WORK_DIR, INDEX_FILE_NAME))
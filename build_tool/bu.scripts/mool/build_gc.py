@@ -0,0 +1,293 @@
+"""Garbage collection of the build directories.
+
+Every build records in a ledger under BUILD_WORK_DIR when each of its rules
+was last built or found up to date, along with the working directory and the
+output files of the rule and their size on disk. Rules which no longer exist
+in any BLD file have their working directory and outputs deleted by bu gc,
+including working directories left over from before the ledger was kept.
+When BUILD_DIRS_MAX_MB is set, the least recently used rules are evicted
+until the recorded size fits, by bu gc as well as after every build.
+
+An evicted rule loses its working directory, and with it the file list
+snapshot which makes the rule up to date, before its outputs are deleted. It
+is therefore built again, or restored from the action cache, whenever it is
+needed next. Digests of deleted files are dropped from the digest cache.
+"""
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import mool.build_file_cache as bfc
+import mool.file_locks as fl
+import mool.file_snapshot as fs
+import mool.shared_utils as su
+
+LEDGER_FILE = os.path.join(su.BUILD_WORK_DIR, '.gc_ledger')
+# Bump this whenever the contents of ledger entries change.
+LEDGER_FORMAT_VERSION = 1
+# Positions in a ledger entry.
+LAST_USED_INDEX = 0
+SIZE_INDEX = 1
+WDIR_INDEX = 2
+OUTPUTS_INDEX = 3
+
+
+def get_disk_size(paths):
+  """Get total size of files and directories. Links are not followed, as
+  working directories link to the sources of their rule."""
+  total_size = 0
+  for path in paths:
+    if os.path.islink(path) or os.path.isfile(path):
+      total_size += os.lstat(path).st_size
+      continue
+    for root, _, files in os.walk(path):
+      for file_name in files:
+        total_size += os.lstat(os.path.join(root, file_name)).st_size
+  return total_size
+
+
+class BuildLedger(object):
+  """Last use and disk usage of the rules built in the build directories."""
+  def __init__(self, ledger_file=LEDGER_FILE):
+    """Initialize."""
+    self._ledger_file = ledger_file
+    # Rule symbol -> [last used time, size, working dir, output files].
+    self._entries = None
+    self._removed = set()
+    self._dirty = False
+    self._lock = threading.Lock()
+
+  def _read(self):
+    """Read the persisted ledger, if any."""
+    if not os.path.exists(self._ledger_file):
+      return {}
+    try:
+      ledger = json.loads(su.read_file(self._ledger_file))
+    except ValueError as exc:
+      logging.debug('Ignoring corrupt build ledger %s: %s', self._ledger_file,
+                    exc)
+      return {}
+    if ledger.get('version', None) != LEDGER_FORMAT_VERSION:
+      return {}
+    return ledger['entries']
+
+  def _get_entries(self):
+    """Get the entries, loading them first if needed."""
+    if self._entries is None:
+      with fl.FileLocks([], [self._ledger_file + bfc.LOCK_FILE_SUFFIX]):
+        self._entries = self._read()
+    return self._entries
+
+  def record(self, rule_symbol, working_dir, output_files, size=None):
+    """Record that a rule was used by a build. The size of a rule found up to
+    date is left as recorded before."""
+    with self._lock:
+      entries = self._get_entries()
+      if size is None:
+        if rule_symbol in entries:
+          size = entries[rule_symbol][SIZE_INDEX]
+        else:
+          size = get_disk_size([working_dir] + output_files)
+      entries[rule_symbol] = [time.time(), size, working_dir, output_files]
+      self._removed.discard(rule_symbol)
+      self._dirty = True
+
+  def remove(self, rule_symbol):
+    """Forget a rule whose files were deleted."""
+    with self._lock:
+      self._get_entries().pop(rule_symbol, None)
+      self._removed.add(rule_symbol)
+      self._dirty = True
+
+  def get_entries(self):
+    """Get a copy of all the entries."""
+    with self._lock:
+      return dict(self._get_entries())
+
+  def save(self):
+    """Persist the ledger, merging in the rules used by concurrent builds
+    since it was loaded."""
+    with self._lock:
+      if su.TEST_MODE_EXECUTION or not self._dirty:
+        return
+      entries = dict(self._entries)
+      removed = set(self._removed)
+      self._dirty = False
+    with fl.FileLocks([self._ledger_file + bfc.LOCK_FILE_SUFFIX]):
+      for rule_symbol, entry in self._read().iteritems():
+        if rule_symbol in removed:
+          continue
+        if ((rule_symbol not in entries or
+             entries[rule_symbol][LAST_USED_INDEX] < entry[LAST_USED_INDEX])):
+          entries[rule_symbol] = entry
+      file_handle, temp_path = tempfile.mkstemp(
+          dir=os.path.dirname(self._ledger_file), prefix='.tmp.')
+      try:
+        with os.fdopen(file_handle, 'w') as file_object:
+          json.dump({'version': LEDGER_FORMAT_VERSION, 'entries': entries},
+                    file_object, sort_keys=True)
+        os.rename(temp_path, self._ledger_file)
+      except (IOError, OSError) as exc:
+        logging.debug('Could not save build ledger: %s', exc)
+        if os.path.exists(temp_path):
+          os.remove(temp_path)
+
+
+def _remove_empty_parents(path):
+  """Remove the directories of a deleted path which became empty, up to the
+  build directories."""
+  top_prefixes = (os.path.join(su.BUILD_WORK_DIR, ''),
+                  os.path.join(su.BUILD_OUT_DIR, ''))
+  dir_path = os.path.dirname(path)
+  while dir_path.startswith(top_prefixes) and os.path.isdir(dir_path):
+    if os.listdir(dir_path):
+      break
+    os.rmdir(dir_path)
+    dir_path = os.path.dirname(dir_path)
+
+
+def _delete_paths(paths):
+  """Delete files and directories, along with their digests."""
+  for path in paths:
+    if os.path.isdir(path) and not os.path.islink(path):
+      shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+      os.remove(path)
+    _remove_empty_parents(path)
+  fs.DIGEST_CACHE.forget(paths)
+
+
+def _get_working_dir_paths(working_dir):
+  """Get the paths to delete for the working directory of a rule. The working
+  directories of rules in BLD files of subdirectories are nested inside it,
+  and are kept along with the directories leading to them."""
+  nested_dirs = set()
+  for root, dir_names, file_names in os.walk(working_dir):
+    if root != working_dir and su.CACHE_FILE_NAME in file_names:
+      nested_dirs.add(root)
+      dir_names[:] = []
+  if not nested_dirs:
+    return [working_dir]
+  kept_prefixes = tuple([os.path.join(d, '') for d in nested_dirs])
+  paths = []
+  for root, dir_names, file_names in os.walk(working_dir):
+    paths.extend([os.path.join(root, f) for f in file_names])
+    for dir_name in list(dir_names):
+      dir_path = os.path.join(root, dir_name)
+      if dir_path in nested_dirs:
+        dir_names.remove(dir_name)
+      elif not [p for p in kept_prefixes
+                if p.startswith(os.path.join(dir_path, ''))]:
+        paths.append(dir_path)
+        dir_names.remove(dir_name)
+  return paths
+
+
+def delete_rule(ledger, rule_symbol, entry):
+  """Delete the working directory and outputs of a rule, once no other bu
+  process is building it. Returns the number of bytes deleted."""
+  logging.debug('Deleting build files of %s', rule_symbol)
+  with fl.FileLocks([fl.get_rule_lock_file(rule_symbol)]):
+    # Without its snapshot the rule can never be taken as up to date again.
+    paths = _get_working_dir_paths(entry[WDIR_INDEX]) + entry[OUTPUTS_INDEX]
+    deleted_bytes = get_disk_size(paths)
+    _delete_paths(paths)
+    _delete_paths([su.get_output_state_dir(f) for f in entry[OUTPUTS_INDEX]])
+  ledger.remove(rule_symbol)
+  return deleted_bytes
+
+
+def evict(ledger, max_size_bytes, keep_rules=()):
+  """Evict the least recently used rules until the recorded size fits in
+  max_size_bytes. Returns the number of rules and bytes evicted."""
+  entries = ledger.get_entries()
+  total_size = sum([e[SIZE_INDEX] for e in entries.itervalues()])
+  evicted_rules = 0
+  evicted_bytes = 0
+  for rule_symbol, entry in sorted(entries.iteritems(),
+                                   key=lambda e: e[1][LAST_USED_INDEX]):
+    if total_size <= max_size_bytes:
+      break
+    if rule_symbol in keep_rules:
+      continue
+    delete_rule(ledger, rule_symbol, entry)
+    total_size -= entry[SIZE_INDEX]
+    evicted_rules += 1
+    evicted_bytes += entry[SIZE_INDEX]
+  return evicted_rules, evicted_bytes
+
+
+def _find_working_dirs():
+  """Get rule symbol -> working directory of all the rules which have ever
+  been built, found by their file list snapshots."""
+  working_dirs = {}
+  for root, dir_names, file_names in os.walk(su.BUILD_WORK_DIR):
+    if root == su.BUILD_WORK_DIR:
+      dir_names[:] = [d for d in dir_names if not d.startswith('.')]
+      continue
+    if su.CACHE_FILE_NAME in file_names:
+      rel_dir = os.path.relpath(root, su.BUILD_WORK_DIR)
+      working_dirs[su.RULE_ROOT_NAME + su.RULE_SEPARATOR + rel_dir.replace(
+          os.sep, su.RULE_SEPARATOR)] = root
+  return working_dirs
+
+
+def _find_orphan_outputs():
+  """Get the files in output directories of BLD files which no longer exist.
+  Output directories of existing BLD files are skipped along with everything
+  inside them, as rules may generate files in subdirectories."""
+  orphans = []
+  for root, dir_names, file_names in os.walk(su.BUILD_OUT_DIR):
+    if root == su.BUILD_OUT_DIR:
+      continue
+    rel_dir = os.path.relpath(root, su.BUILD_OUT_DIR)
+    if os.path.exists(os.path.join(su.BUILD_ROOT, rel_dir,
+                                   su.BUILD_FILE_NAME)):
+      dir_names[:] = []
+      continue
+    orphans.extend([os.path.join(root, f) for f in file_names])
+  return orphans
+
+
+def remove_deleted_rules(ledger, rule_symbols, kept_rule_paths=()):
+  """Delete the files of the rules not among the given existing rules. Rules
+  of the rule paths in kept_rule_paths, like those of BLD files which cannot
+  be read, are kept. Returns the deleted rules and the number of bytes
+  deleted."""
+  rule_symbols = set(rule_symbols)
+  kept_rule_paths = set(kept_rule_paths)
+
+  def _is_deleted(rule_symbol):
+    """Checks if a rule no longer exists."""
+    return rule_symbol not in rule_symbols and (
+        rule_symbol.rsplit(su.RULE_SEPARATOR, 1)[0] not in kept_rule_paths)
+
+  deleted_rules = set()
+  deleted_bytes = 0
+  for rule_symbol, entry in ledger.get_entries().iteritems():
+    if _is_deleted(rule_symbol):
+      deleted_bytes += delete_rule(ledger, rule_symbol, entry)
+      deleted_rules.add(rule_symbol)
+  for rule_symbol, working_dir in _find_working_dirs().iteritems():
+    if _is_deleted(rule_symbol):
+      deleted_bytes += delete_rule(ledger, rule_symbol,
+                                   [0, 0, working_dir, []])
+      deleted_rules.add(rule_symbol)
+  orphans = _find_orphan_outputs()
+  deleted_bytes += get_disk_size(orphans)
+  _delete_paths(orphans)
+  return sorted(deleted_rules), deleted_bytes
+
+
+def get_max_size_bytes():
+  """Get the size budget of the build directories, 0 for no limit."""
+  try:
+    max_size_mb = int(su.BUILD_DIRS_MAX_MB)
+  except ValueError:
+    raise su.Error('Invalid BUILD_DIRS_MAX_MB: {}'.format(
+        su.BUILD_DIRS_MAX_MB))
+  return max(max_size_mb, 0) * 1024 * 1024
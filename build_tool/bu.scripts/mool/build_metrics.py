@@ -0,0 +1,128 @@
+"""Store of build metrics recorded by every build.
+
+Each build appends one line of JSON to a file under BUILD_WORK_DIR. The line
+holds the number of rules found up to date and a record for each rule that
+was built, restored from the action cache or tested:
+  [status, build seconds, test seconds, output bytes, number of commands]
+Only the last MAX_RUNS builds are kept. The records give the schedulers their
+estimates of rule build and test times and are reported by 'bu stats'.
+"""
+import json
+import logging
+import os
+import tempfile
+import time
+
+import mool.shared_utils as su
+
+METRICS_FILE = os.path.join(su.BUILD_WORK_DIR, '.build_metrics')
+MAX_RUNS = 50
+# Number of recent records of a rule used for estimating its build or test
+# time.
+ESTIMATE_RUNS = 5
+
+STATUS_BUILT = 'built'
+STATUS_CACHED = 'cached'
+STATUS_UP_TO_DATE = 'up_to_date'
+
+# Positions in a rule record.
+STATUS_INDEX = 0
+BUILD_TIME_INDEX = 1
+TEST_TIME_INDEX = 2
+OUTPUT_SIZE_INDEX = 3
+NUM_COMMANDS_INDEX = 4
+
+
+def get_output_size(output_files):
+  """Get total size of the output files of a rule."""
+  total_size = 0
+  for file_path in output_files:
+    if os.path.isfile(file_path):
+      total_size += os.path.getsize(file_path)
+  return total_size
+
+
+def get_rule_time(record):
+  """Get total build and test time of a rule record."""
+  return record[BUILD_TIME_INDEX] + record[TEST_TIME_INDEX]
+
+
+def load_runs(metrics_file=METRICS_FILE):
+  """Load recorded builds, oldest first."""
+  if su.TEST_MODE_EXECUTION or not os.path.exists(metrics_file):
+    return []
+  runs = []
+  with open(metrics_file, 'r') as file_object:
+    for line in file_object:
+      try:
+        runs.append(json.loads(line))
+      except ValueError:
+        # A build might have been interrupted while appending.
+        logging.debug('Ignoring corrupt line in %s', metrics_file)
+  return runs
+
+
+def save_run(rule_records, num_up_to_date, wall_time,
+             metrics_file=METRICS_FILE):
+  """Append the metrics of a build, dropping the oldest builds beyond
+  MAX_RUNS."""
+  if su.TEST_MODE_EXECUTION or not (rule_records or num_up_to_date):
+    return
+  line = json.dumps({'time': int(time.time()), 'wall': round(wall_time, 3),
+                     'up_to_date': num_up_to_date, 'rules': rule_records},
+                    sort_keys=True, separators=(',', ':'))
+  try:
+    with open(metrics_file, 'a') as file_object:
+      file_object.write(line + '\n')
+    with open(metrics_file, 'r') as file_object:
+      lines = file_object.readlines()
+    # Compacting only once the store has doubled keeps appends cheap.
+    if len(lines) > MAX_RUNS * 2:
+      _compact(lines[-MAX_RUNS:], metrics_file)
+  except (IOError, OSError) as exc:
+    logging.debug('Could not save build metrics: %s', exc)
+
+
+def _compact(lines, metrics_file):
+  """Rewrite the store with the given lines."""
+  file_handle, temp_path = tempfile.mkstemp(
+      dir=os.path.dirname(metrics_file), prefix='.tmp.')
+  with os.fdopen(file_handle, 'w') as file_object:
+    file_object.writelines(lines)
+  os.rename(temp_path, metrics_file)
+
+
+def get_rule_history(runs):
+  """Get the records of every rule from a list of builds, oldest first."""
+  history = {}
+  for run in runs:
+    for rule_symbol, record in run['rules'].iteritems():
+      history.setdefault(rule_symbol, []).append(record)
+  return history
+
+
+def _get_median_times(runs, get_times):
+  """Get the median of the times picked from the recent records of every
+  rule, for the rules with any."""
+  durations = {}
+  for rule_symbol, records in get_rule_history(runs).iteritems():
+    times = sorted(get_times(records))
+    if times:
+      durations[rule_symbol] = times[len(times) / 2]
+  return durations
+
+
+def get_past_durations(runs):
+  """Estimate the build time of rules from their recent builds. Restores
+  from the action cache are left out as they say little about the cost of
+  building a rule."""
+  return _get_median_times(runs, lambda records: [
+      r[BUILD_TIME_INDEX] for r in records[-ESTIMATE_RUNS:]
+      if r[STATUS_INDEX] != STATUS_CACHED])
+
+
+def get_past_test_durations(runs):
+  """Estimate the test time of rules from their recent test runs."""
+  return _get_median_times(runs, lambda records: [
+      r[TEST_TIME_INDEX] for r in records if r[TEST_TIME_INDEX]][
+          -ESTIMATE_RUNS:])
@@ -0,0 +1,118 @@
+"""Profile of a build in Chrome trace event format.
+
+The profile is viewable in chrome://tracing or https://ui.perfetto.dev. Every
+span is a complete ("X") event on the lane of the thread that ran it, so the
+rules built by parallel workers show up side by side. Recording is off unless
+a command enables it, in which case spans cost a couple of clock reads.
+"""
+import json
+import threading
+import time
+
+# Process id used for all events, the viewers need one.
+TRACE_PID = 1
+
+
+class _NullSpan(object):
+  """Span used while profiling is off."""
+  def __enter__(self):
+    """Enter span."""
+    return self
+
+  def __exit__(self, *_):
+    """Exit span."""
+    return False
+
+  def set_arg(self, key, value):
+    """Add an argument to the event of the span."""
+
+
+class _Span(object):
+  """Span recording a complete event when it exits."""
+  def __init__(self, profiler, name, category, args):
+    """Initialize."""
+    self._profiler = profiler
+    self._name = name
+    self._category = category
+    self._args = args
+    self._start = None
+
+  def __enter__(self):
+    """Enter span."""
+    self._start = time.time()
+    return self
+
+  def set_arg(self, key, value):
+    """Add an argument to the event of the span."""
+    self._args[key] = value
+
+  def __exit__(self, exc_type, *_):
+    """Exit span."""
+    if exc_type:
+      self._args['error'] = exc_type.__name__
+    self._profiler.add_event(self._name, self._category, self._start,
+                             time.time(), self._args)
+    return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class BuildProfiler(object):
+  """Collects trace events from all threads."""
+  def __init__(self):
+    """Initialize."""
+    self._lock = threading.Lock()
+    self._events = None
+    self._start = None
+    # Thread ident -> (lane number, thread name).
+    self._lanes = {}
+
+  def enable(self):
+    """Start recording, dropping any earlier events."""
+    with self._lock:
+      self._events = []
+      self._start = time.time()
+      self._lanes = {}
+
+  def is_enabled(self):
+    """Check if events are being recorded."""
+    return self._events is not None
+
+  def span(self, name, category, **args):
+    """Get a context manager recording a span around its body."""
+    if self._events is None:
+      return NULL_SPAN
+    return _Span(self, name, category, args)
+
+  def add_event(self, name, category, start, end, args):
+    """Record a complete event of the calling thread."""
+    thread = threading.current_thread()
+    with self._lock:
+      if self._events is None:
+        return
+      if thread.ident not in self._lanes:
+        self._lanes[thread.ident] = (len(self._lanes), thread.name)
+      self._events.append({
+          'name': name, 'cat': category, 'ph': 'X', 'pid': TRACE_PID,
+          'tid': self._lanes[thread.ident][0],
+          'ts': int((start - self._start) * 1000000),
+          'dur': int((end - start) * 1000000), 'args': args})
+
+  def write(self, file_path):
+    """Write recorded events to a file and stop recording."""
+    with self._lock:
+      events = self._events or []
+      lanes = self._lanes.values()
+      self._events = None
+    events.sort(key=lambda e: (e['tid'], e['ts'], -e['dur']))
+    for lane, thread_name in sorted(lanes):
+      events.append({'name': 'thread_name', 'ph': 'M', 'pid': TRACE_PID,
+                     'tid': lane, 'args': {'name': thread_name}})
+    with open(file_path, 'w') as file_object:
+      json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'},
+                file_object)
+
+
+# Profiler of this process.
+PROFILER = BuildProfiler()
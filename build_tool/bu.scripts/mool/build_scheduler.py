@@ -0,0 +1,102 @@
+"""Dependency driven scheduling of build rules.
+
+A rule becomes ready as soon as all of its own deps and compileDeps have been
+built. Among the ready rules, the one with the longest critical path (its own
+estimated cost plus the most expensive chain of rules waiting on it) is built
+first, so that a long chain ending in a slow link step starts as early as
+possible.
+"""
+import heapq
+
+import mool.build_metrics as bm
+import mool.shared_utils as su
+
+# Estimated cost (in seconds) of rules which have never been built before.
+DEFAULT_RULE_COST = 1.0
+HEAVY_RULE_COST = 10.0
+
+
+def get_rule_cost(rule_details, past_durations):
+  """Estimate the build time of a rule. Recorded durations are preferred over
+  the weight specified in BLD file, which can either be a number of seconds or
+  any other text for a heavy rule."""
+  rule_symbol = rule_details[su.SYMBOL_KEY]
+  if rule_symbol in past_durations:
+    return past_durations[rule_symbol]
+  weight = rule_details.get(su.RULE_WEIGHT_KEY, None)
+  if weight is None:
+    return DEFAULT_RULE_COST
+  try:
+    return float(weight)
+  except ValueError:
+    return HEAVY_RULE_COST
+
+
+def load_past_durations():
+  """Load build durations of rules estimated from the build metrics
+  recorded by previous builds."""
+  return bm.get_past_durations(bm.load_runs())
+
+
+class BuildScheduler(object):
+  """Ready queue of rules ordered by critical path length."""
+  def __init__(self, graph, rule_costs):
+    """Initialize. Only the rules with a cost are scheduled, other rules of
+    the graph are taken as built already."""
+    self._graph = graph
+    self._scheduled = [graph.get_symbol(n) in rule_costs
+                       for n in xrange(graph.size())]
+    self._waiting_on = [len(self._get_scheduled(graph.get_deps(n)))
+                        for n in xrange(graph.size())]
+    self._priority = self._get_critical_paths(rule_costs)
+    self._ready = []
+    self._remaining = len(rule_costs)
+    for node, count in enumerate(self._waiting_on):
+      if self._scheduled[node] and not count:
+        self._push_ready(node)
+
+  def _get_scheduled(self, nodes):
+    """Get the scheduled nodes among the given ones."""
+    return [n for n in nodes if self._scheduled[n]]
+
+  def _get_critical_paths(self, rule_costs):
+    """Compute critical path length of every scheduled rule in reverse
+    topological order."""
+    critical_paths = [0] * self._graph.size()
+    for node in reversed(self._graph.get_topo_order()):
+      if not self._scheduled[node]:
+        continue
+      tail = [critical_paths[r]
+              for r in self._get_scheduled(self._graph.get_rdeps(node))]
+      critical_paths[node] = (rule_costs[self._graph.get_symbol(node)] +
+                              (max(tail) if tail else 0))
+    return critical_paths
+
+  def _push_ready(self, node):
+    """Add a rule to ready queue."""
+    heapq.heappush(self._ready, (-self._priority[node], node))
+
+  def get_priority(self, rule_symbol):
+    """Get critical path length of a rule."""
+    return self._priority[self._graph.get_node(rule_symbol)]
+
+  def has_ready(self):
+    """Checks if there is a rule ready to be built."""
+    return bool(self._ready)
+
+  def pop_ready(self):
+    """Get the ready rule with longest critical path."""
+    return self._graph.get_symbol(heapq.heappop(self._ready)[1])
+
+  def mark_done(self, rule_symbol):
+    """Mark a rule as built and release the rules waiting on it."""
+    self._remaining -= 1
+    for rdep in self._get_scheduled(
+        self._graph.get_rdeps(self._graph.get_node(rule_symbol))):
+      self._waiting_on[rdep] -= 1
+      if not self._waiting_on[rdep]:
+        self._push_ready(rdep)
+
+  def done(self):
+    """Checks if all the scheduled rules have been built."""
+    return not self._remaining
@@ -6,7 +6,9 @@ import subprocess
 import sys
 
 import extensions.extensions_main as em
+import mool.build_daemon as bd
 import mool.core_cmds as core_cmds
+import mool.file_locks as fl
 import mool.shared_utils as su
 
 LOG = logging.getLogger()
@@ -51,6 +53,7 @@ def _generate_help_message():
   core_help = []
   for key in sorted(core_cmds.CORE_COMMANDS.keys()):
     core_help.append(_format_line(key, core_cmds.CORE_COMMANDS[key][1]))
+  core_help.append(_format_line(bd.DAEMON_COMMAND, bd.DAEMON_HELP))
   ext_help = []
   for key in sorted(em.EXTENSION_COMMANDS.keys()):
     ext_help.append(_format_line(key, em.EXTENSION_COMMANDS[key][1]))
@@ -93,7 +96,8 @@ def apply_rules(cmd_line, dependency_dict):
     # scenario from this module as developers make continuous changes in their
     # code.
     LOG.error(ERROR_TEXT)
-    LOG.error('Current directory: %s', su.log_normalize(os.getcwd()))
+    curr_dir = getattr(error_obj, 'curr_dir', os.getcwd())
+    LOG.error('Current directory: %s', su.log_normalize(curr_dir))
     error_cmd = [su.log_normalize(x) for x in error_obj.cmd]
     LOG.error(' '.join(error_cmd))
     return (1,)
@@ -104,16 +108,37 @@ def apply_rules(cmd_line, dependency_dict):
 
 
 def do_main(rules_list):
-  """Apply build rules from a list."""
+  """Apply build rules from a list, inside the build server if one is
+  running."""
   _configure_logging()
+  if rules_list and rules_list[0] == bd.DAEMON_COMMAND:
+    try:
+      _check_working_dirs()
+      core_cmds.keep_rule_builders()
+      return bd.daemon_main(rules_list[1:], _do_main_in_process)
+    except su.Error as error_obj:
+      LOG.error('ERROR: %s', str(error_obj))
+      return 1
+  ret_code = None
+  # A watch session would keep the build server busy for good.
+  if not rules_list or rules_list[0] != core_cmds.WATCH_COMMAND:
+    ret_code = bd.run_client(rules_list)
+  if ret_code is None:
+    ret_code = _do_main_in_process(rules_list)
+  return ret_code
+
+
+def _do_main_in_process(rules_list):
+  """Apply build rules from a list in this process."""
   lock_file_object = None
   result = None
   try:
     _check_working_dirs()
-    lock_file_object = su.lock_working_dir()
+    lock_file_object = fl.lock_working_dir(
+        rules_list[:1] == [core_cmds.CLEAN_COMMAND])
     result = apply_rules(rules_list, {})
   finally:
-    su.release_working_dir(lock_file_object)
+    fl.release_working_dir(lock_file_object)
   if not isinstance(result, tuple):
     LOG.error('Expecting a tuple return value!')
   ret_code = result[0]
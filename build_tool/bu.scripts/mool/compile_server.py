@@ -0,0 +1,239 @@
+"""Long lived javac workers.
+
+Starting a JVM for every javac command dominates builds of many small Java
+rules. With JAVA_COMPILE_SERVER set to true, javac commands are sent to
+worker JVMs running JavacServer.java, which compile through the javax.tools
+API. Workers are started on demand, one for each java binary and
+-source/-target pair and as many as compile at once, and are kept for the
+rest of the bu process, a build daemon included. The server class is compiled
+on first use into BUILD_WORK_DIR.
+
+Workers compile in a directory of their own, so paths in the arguments are
+made absolute, and class path wildcards are expanded as the javac launcher
+would. Commands with options the worker can not take, like -J, run as a new
+javac process as before, as does every command once a worker fails.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+import mool.shared_utils as su
+
+SERVER_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'JavacServer.java')
+SERVER_CLASS = 'JavacServer'
+SERVER_DIR = os.path.join(su.BUILD_WORK_DIR, '.javac_server')
+LOG_FILE_NAME = 'javac_server.log'
+# javac options followed by a class path, which may have wildcards.
+CLASS_PATH_OPTIONS = ['-classpath', '-cp']
+# javac options followed by other paths or path lists.
+PATH_OPTIONS = ['-bootclasspath', '-d', '-endorseddirs', '-extdirs', '-h',
+                '-processorpath', '-s', '-sourcepath']
+# javac options followed by a value which is not a path.
+VALUE_OPTIONS = ['-encoding', '-processor', '-profile', '-release', '-source',
+                 '-target', '-Xmaxerrs', '-Xmaxwarns']
+# Options which select the language version, and with it the worker.
+VERSION_OPTIONS = ['-release', '-source', '-target']
+
+
+class Error(su.Error):
+  """Error class for this module."""
+
+
+def _expand_class_path(class_path, cwd):
+  """Make class path entries absolute and expand 'dir/*' entries to the jars
+  in the directory, which the javac launcher does but the compiler API does
+  not."""
+  entries = []
+  for entry in class_path.split(os.pathsep):
+    if not entry:
+      continue
+    entry = os.path.join(cwd, entry)
+    if os.path.basename(entry) != '*':
+      entries.append(entry)
+      continue
+    dir_path = os.path.dirname(entry)
+    if os.path.isdir(dir_path):
+      entries.extend([os.path.join(dir_path, f)
+                      for f in sorted(os.listdir(dir_path))
+                      if f.endswith(('.jar', '.JAR'))])
+  return os.pathsep.join(entries)
+
+
+def get_request(command, cwd):
+  """Get the worker key and the compiler arguments of a javac command, None
+  if it can't be run by a worker. The key is the java binary next to javac
+  along with the version options."""
+  if os.path.basename(command[0]) != 'javac':
+    return None
+  key = [os.path.join(os.path.dirname(command[0]), 'java')]
+  args = []
+  position = 1
+  while position < len(command):
+    arg = command[position]
+    if '\n' in arg or arg.startswith(('-J', '--', '@')):
+      return None
+    if arg in CLASS_PATH_OPTIONS + PATH_OPTIONS + VALUE_OPTIONS:
+      if position + 1 == len(command):
+        return None
+      value = command[position + 1]
+      if arg in CLASS_PATH_OPTIONS:
+        value = _expand_class_path(value, cwd)
+      elif arg in PATH_OPTIONS:
+        value = os.pathsep.join([os.path.join(cwd, p)
+                                 for p in value.split(os.pathsep)])
+      elif arg in VERSION_OPTIONS:
+        key.extend([arg, value])
+      args.extend([arg, value])
+      position += 2
+      continue
+    if not arg.startswith('-'):
+      # Source files.
+      arg = os.path.join(cwd, arg)
+    args.append(arg)
+    position += 1
+  return tuple(key), args
+
+
+class _Worker(object):
+  """A JVM compiling one request at a time."""
+  def __init__(self, java_bin, class_dir, log_file):
+    """Start the worker."""
+    with open(log_file, 'a') as log_object:
+      self._process = subprocess.Popen(
+          [java_bin, '-cp', class_dir, SERVER_CLASS], stdin=subprocess.PIPE,
+          stdout=subprocess.PIPE, stderr=log_object, close_fds=True)
+
+  def compile(self, args):
+    """Compile. Returns the exit code and output of the compiler."""
+    request = [str(len(args))]
+    request.extend(args)
+    self._process.stdin.write('\n'.join(request) + '\n')
+    self._process.stdin.flush()
+    reply = self._process.stdout.readline().split()
+    if len(reply) != 2:
+      raise Error('javac server exited with {}'.format(self._process.poll()))
+    size = int(reply[1])
+    output = self._process.stdout.read(size)
+    if len(output) != size:
+      raise Error('javac server exited with {}'.format(self._process.poll()))
+    return int(reply[0]), output
+
+  def is_alive(self):
+    """Checks if the worker is still running."""
+    return self._process.poll() is None
+
+  def stop(self):
+    """Stop the worker."""
+    if self.is_alive():
+      self._process.stdin.close()
+      self._process.wait()
+
+  def kill(self):
+    """Stop a worker which failed."""
+    if self.is_alive():
+      self._process.kill()
+      self._process.wait()
+
+
+class CompileServer(object):
+  """Pool of javac workers."""
+  def __init__(self, server_dir=SERVER_DIR, enabled=su.JAVA_COMPILE_SERVER):
+    """Initialize."""
+    self._server_dir = server_dir
+    self._enabled = enabled
+    # Worker key -> idle workers.
+    self._idle_workers = {}
+    # Java binary -> directory of the compiled server class.
+    self._class_dirs = {}
+    self._lock = threading.Lock()
+
+  def _get_class_dir(self, java_bin):
+    """Get the directory of the server class for a java binary, compiling
+    the class first if needed. Classes are kept for every version of the
+    server source and every JDK."""
+    if java_bin in self._class_dirs:
+      return self._class_dirs[java_bin]
+    key_hash = hashlib.sha1(su.read_file(SERVER_SOURCE))
+    key_hash.update(java_bin)
+    class_dir = os.path.join(self._server_dir, key_hash.hexdigest())
+    if not os.path.isdir(class_dir):
+      if not os.path.isdir(self._server_dir):
+        os.makedirs(self._server_dir)
+      temp_dir = tempfile.mkdtemp(dir=self._server_dir, prefix='.tmp.')
+      javac_bin = os.path.join(os.path.dirname(java_bin), 'javac')
+      try:
+        with open(os.path.join(self._server_dir, LOG_FILE_NAME),
+                  'a') as log_object:
+          subprocess.check_call([javac_bin, '-d', temp_dir, SERVER_SOURCE],
+                                stdout=log_object, stderr=log_object)
+        os.rename(temp_dir, class_dir)
+      finally:
+        # Another bu process may have compiled it meanwhile.
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    self._class_dirs[java_bin] = class_dir
+    return class_dir
+
+  def _get_worker(self, key):
+    """Get an idle worker for a key, starting one if there is none."""
+    with self._lock:
+      idle_workers = self._idle_workers.setdefault(key, [])
+      while idle_workers:
+        worker = idle_workers.pop()
+        if worker.is_alive():
+          return worker
+      class_dir = self._get_class_dir(key[0])
+    return _Worker(key[0], class_dir,
+                   os.path.join(self._server_dir, LOG_FILE_NAME))
+
+  def run(self, command, cwd=None):
+    """Run a javac command in a worker, raising CalledProcessError when it
+    fails like subprocess.check_call does. Returns False without running it
+    if it has to run as a process of its own."""
+    if not self._enabled:
+      return False
+    request = get_request(command, cwd or os.getcwd())
+    if not request:
+      return False
+    key, args = request
+    worker = None
+    try:
+      worker = self._get_worker(key)
+      exit_code, output = worker.compile(args)
+    except (Error, IOError, OSError, ValueError,
+            subprocess.CalledProcessError) as exc:
+      logging.warning('javac server failed, compiling in new processes '
+                      'from now on: %s', exc)
+      if worker:
+        worker.kill()
+      self.stop()
+      return False
+    with self._lock:
+      if self._enabled:
+        self._idle_workers.setdefault(key, []).append(worker)
+        worker = None
+    if worker:
+      worker.stop()
+    if output:
+      sys.stderr.write(output)
+      sys.stderr.flush()
+    if exit_code:
+      raise subprocess.CalledProcessError(exit_code, command)
+    return True
+
+  def stop(self):
+    """Stop all the idle workers, and use none from now on."""
+    with self._lock:
+      self._enabled = False
+      workers = sum(self._idle_workers.values(), [])
+      self._idle_workers = {}
+    for worker in workers:
+      worker.stop()
+
+
+COMPILE_SERVER = CompileServer()
@@ -1,7 +1,13 @@
 """Handlers and entry point for mool core commands."""
+import argparse
 import logging
 import os
+import subprocess
+import time
 
+import mool.build_profiler as bp
+import mool.dep_index as di
+import mool.file_watcher as fw
 import mool.rule_builder as rb
 import mool.shared_utils as su
 
@@ -13,6 +19,9 @@ BUILD_COMMAND = 'do_build'
 CLEAN_COMMAND = 'do_clean'
 TEST_COMMAND = 'do_test'
 TEST_CHANGES_COMMAND = 'do_test_changes'
+WATCH_COMMAND = 'do_watch'
+# Number of sets of rules whose rule builders a build server keeps.
+MAX_KEPT_RULE_BUILDERS = 4
 
 CORE_COMMANDS = {
     BUILD_COMMAND: ('_handle_do_build', 'build a list of given rules.'),
@@ -21,20 +30,34 @@ CORE_COMMANDS = {
     TEST_COMMAND: ('_handle_do_test', 'build and test a list of rules.'),
     TEST_CHANGES_COMMAND: ('_handle_do_test_changes',
                            ('builds and runs SUBMITQ rules for a list of '
-                            'changed files given in a file.'))
+                            'changed files given in a file.')),
+    WATCH_COMMAND: ('_handle_do_watch',
+                    ('build and test a list of rules, then rebuild and retest '
+                     'the rules affected by every saved change.'))
 }
 
 
+# Rule builders kept between commands, only by a build server.
+RULE_BUILDERS = rb.RuleBuilderCache()
+
+
 class Error(su.Error):
   """The Error class for this module."""
 
 
+def keep_rule_builders():
+  """Keep rule builders between the commands run by this process."""
+  RULE_BUILDERS.enable(MAX_KEPT_RULE_BUILDERS)
+
+
 def _clean_temp_dirs():
   """Clean the output directory."""
   LOG.info('Cleaning output and working directories: {}, {}'.format(
       su.log_normalize(su.BUILD_OUT_DIR), su.log_normalize(su.BUILD_WORK_DIR)))
   su.cleandir(su.BUILD_OUT_DIR)
   su.cleandir(su.BUILD_WORK_DIR)
+  # Kept rules were set up for the directories cleaned.
+  RULE_BUILDERS.clear()
   return 0
 
 
@@ -44,7 +67,17 @@ def _get_affected_rules(changed_files_list_file):
       f.strip() for f in su.read_file(changed_files_list_file).split('\n')
       if f.strip()]
   changed_files_list = [os.path.realpath(f) for f in changed_files_list]
-  affected_rules = su.get_affected_rules(changed_files_list)
+  dep_index = di.DepIndex()
+  affected_rules = set(dep_index.get_affected_rules(changed_files_list))
+  owned_files = [f for f in changed_files_list if dep_index.get_owners([f])]
+  # Files no rule is built from, like runtime data, still affect all rules of
+  # their directories along with the SUBMITQ rules there. Rules depending on
+  # owned files are known exactly from the index.
+  unowned_files = sorted(set(changed_files_list).difference(owned_files))
+  LOG.info('%d changed file(s) affect %d rule(s), %d file(s) not in any rule.',
+           len(owned_files), len(affected_rules), len(unowned_files))
+  affected_rules.update(su.get_affected_rules(unowned_files))
+  affected_rules = sorted(affected_rules)
   if not affected_rules:
     LOG.info('No changes covered by SUBMITQ files or BLD files.')
   if su.SUBMITQ_DEBUG_MODE:
@@ -53,13 +86,75 @@ def _get_affected_rules(changed_files_list_file):
   return affected_rules
 
 
+def _parse_build_params(command, params):
+  """Parse build options and the list of rules from command parameters."""
+  parser = argparse.ArgumentParser(prog='bu {}'.format(command))
+  parser.add_argument('-j', '--jobs', default=su.BUILD_JOBS,
+                      help=('number of rules to build in parallel, defaults '
+                            'to $BUILD_JOBS or 1'))
+  parser.add_argument('--profile', metavar='FILE',
+                      help=('write a profile of the build to FILE in Chrome '
+                            'trace event format'))
+  parser.add_argument('--test-jobs', default=su.TEST_JOBS,
+                      help=('number of tests to run in parallel, defaults to '
+                            '$TEST_JOBS or the number of build jobs'))
+  parser.add_argument('--test-timeout', default=su.TEST_TIMEOUT_SECONDS,
+                      metavar='SECONDS',
+                      help=('time limit of a test unless its rule sets '
+                            'test_timeout, defaults to $TEST_TIMEOUT_SECONDS '
+                            'or 900, 0 for no limit'))
+  parser.add_argument('--test-shard-size', default=su.TEST_SHARD_SIZE,
+                      type=int, metavar='N',
+                      help=('number of test classes per JVM for java tests, '
+                            'defaults to $TEST_SHARD_SIZE or 10, 0 for a '
+                            'single JVM'))
+  parser.add_argument('--no-test-cache', dest='test_cache',
+                      action='store_false',
+                      help=('run tests even if they passed with the same '
+                            'inputs before'))
+  parser.add_argument('rules', nargs='*', help='build rules')
+  args = parser.parse_args(params)
+  args.jobs = su.get_num_jobs(args.jobs)
+  args.test_jobs = (su.get_num_jobs(args.test_jobs) if args.test_jobs
+                    else args.jobs)
+  args.test_timeout = su.get_test_timeout(args.test_timeout)
+  return args
+
+
+def _get_rule_builder(args, rules):
+  """Get a builder of rules set up with the test options of build
+  options."""
+  builder = RULE_BUILDERS.get(rules)
+  builder.set_test_options(args.test_jobs, args.test_timeout,
+                           max(args.test_shard_size, 0), args.test_cache)
+  return builder
+
+
+def _write_profile(file_path):
+  """Write the profile of the commands run so far."""
+  bp.PROFILER.write(file_path)
+  LOG.info('Wrote build profile to %s', file_path)
+
+
+def _build_rules(args, run_tests, dependency_dict):
+  """Build the rules given by build options, profiling if asked to."""
+  if args.profile:
+    bp.PROFILER.enable()
+  try:
+    builder = _get_rule_builder(args, args.rules)
+    ret_code = builder.do_builds(run_tests, dependency_dict, args.jobs)
+  finally:
+    if args.profile:
+      _write_profile(args.profile)
+  return ret_code, builder
+
+
 def _handle_do_build(params, dependency_dict):
   """Handler for do_build command."""
-  if not params:
+  args = _parse_build_params(BUILD_COMMAND, params)
+  if not args.rules:
     raise Error('bu do_build expects a list of rules to build.')
-  builder = rb.RuleBuilder(params)
-  ret_code = builder.do_builds(False, dependency_dict)
-  return ret_code, builder
+  return _build_rules(args, False, dependency_dict)
 
 
 def _handle_do_clean(_, ___):
@@ -69,11 +164,10 @@ def _handle_do_clean(_, ___):
 
 def _handle_do_test(params, dependency_dict):
   """Handler for do_test command."""
-  if not params:
+  args = _parse_build_params(TEST_COMMAND, params)
+  if not args.rules:
     raise Error('bu do_test expects a list of rules to build.')
-  builder = rb.RuleBuilder(params)
-  ret_code = builder.do_builds(True, dependency_dict)
-  return ret_code, builder
+  return _build_rules(args, True, dependency_dict)
 
 
 def _handle_do_test_changes(params, dependency_dict):
@@ -83,7 +177,95 @@ def _handle_do_test_changes(params, dependency_dict):
   affected_rules = _get_affected_rules(params[0])
   if not affected_rules:
     return (0,)
-  return _handle_do_test(affected_rules, dependency_dict)
+  test_params = params[1:]
+  test_params.extend(affected_rules)
+  return _handle_do_test(test_params, dependency_dict)
+
+
+def _run_watch_build(args, builder, dependency_dict, build_rules=None):
+  """Build and test rules for the watch mode, logging failures instead of
+  stopping on them."""
+  try:
+    builder.do_builds(True, dependency_dict, args.jobs, build_rules)
+  except subprocess.CalledProcessError as error_obj:
+    LOG.error('FAILED: %s', ' '.join(
+        [su.log_normalize(x) for x in error_obj.cmd]))
+    return False
+  except su.Error as error_obj:
+    LOG.error('FAILED: %s', su.log_normalize(str(error_obj)))
+    return False
+  LOG.info('PASSED')
+  return True
+
+
+def _watch_rules(args, watcher, dependency_dict):
+  """Build and test the rules of build options, then keep rebuilding and
+  retesting the rules affected by changes to their source or BLD files until
+  interrupted.
+
+  One rule builder is kept for the whole watch. Changed BLD files are parsed
+  again, and only the rules loaded from them along with the rules depending
+  on them are loaded and set up again. Only the rules built from changed
+  files, along with the rules depending on them, are rebuilt and only their
+  tests are run.
+  """
+  builder = _get_rule_builder(args, args.rules)
+  builder.setup_rules()
+  # Rules loaded again which could not be set up yet.
+  reloaded_rules = set()
+  try:
+    _run_watch_build(args, builder, dependency_dict)
+    while True:
+      watched_files = builder.get_watched_files()
+      try:
+        watcher.set_files(watched_files)
+      except fw.Error as error_obj:
+        LOG.warning('Polling for changes, %s', error_obj)
+        watcher.close()
+        watcher = fw.PollingWatcher()
+        watcher.set_files(watched_files)
+      LOG.info('Watching for changes, press Ctrl-C to stop.')
+      changed_files = watcher.wait_for_changes()
+      change_time = time.time()
+      changed_rule_files = [f for f in changed_files
+                            if os.path.basename(f) == su.BUILD_FILE_NAME]
+      try:
+        if changed_rule_files:
+          reloaded_rules.update(builder.reload_rule_files(changed_rule_files))
+        builder.setup_rules()
+      except su.Error as error_obj:
+        LOG.error('FAILED: %s', su.log_normalize(str(error_obj)))
+        continue
+      affected_rules = set(builder.get_rules_affected_by(changed_files))
+      affected_rules.update(
+          [r for r in reloaded_rules if r in builder.get_rules_map()])
+      reloaded_rules = set()
+      if not affected_rules:
+        continue
+      LOG.info('Changed: %s', ' '.join(
+          [su.log_normalize(f) for f in sorted(changed_files)]))
+      _run_watch_build(args, builder, dependency_dict, affected_rules)
+      LOG.info('Rebuilt %d rule(s) in %.2f seconds after the change.',
+               len(affected_rules), time.time() - change_time)
+  except KeyboardInterrupt:
+    LOG.info('Stopped watching.')
+  return 0
+
+
+def _handle_do_watch(params, dependency_dict):
+  """Handler for do_watch command."""
+  args = _parse_build_params(WATCH_COMMAND, params)
+  if not args.rules:
+    raise Error('bu do_watch expects a list of rules to build.')
+  if args.profile:
+    bp.PROFILER.enable()
+  watcher = fw.get_file_watcher()
+  try:
+    return (_watch_rules(args, watcher, dependency_dict),)
+  finally:
+    watcher.close()
+    if args.profile:
+      _write_profile(args.profile)
 
 
 def generic_core_cmd_handler(params, dependency_dict):
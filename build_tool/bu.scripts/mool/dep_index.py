@@ -0,0 +1,226 @@
+"""Reverse dependency index of all the rules under BUILD_ROOT.
+
+For every BLD file the index keeps the modification time and size it was read
+at, and for each rule of the file the files it is built from (srcs, hdrs and
+the precompiled or system libraries under environment variable directories,
+along with the BLD file itself) and the rules it refers to (deps, compileDeps
+and the other rule lists). The index is persisted under
+BUILD_WORK_DIR, read under a lock shared with other bu processes and written
+under an exclusive one. Refreshing it only reads the BLD files which were
+added or changed since. Files map to their owning rules and rules to the rules
+depending on them, which gives the exact set of rules affected by a change.
+"""
+import json
+import logging
+import os
+import tempfile
+
+import mool.build_file_cache as bfc
+import mool.file_locks as fl
+import mool.shared_utils as su
+
+INDEX_FILE = os.path.join(su.BUILD_WORK_DIR, '.dep_index')
+# Bump this whenever the contents of index entries change.
+INDEX_FORMAT_VERSION = 2
+# Keys of rule details listing source files relative to the BLD file.
+FILE_KEYS = [su.SRCS_KEY, su.HDRS_KEY]
+# Keys of rule details listing files relative to directories given by
+# environment variables, like 'env.PREBUILT_DIR/lib/libfoo.a'. Other entries
+# are linker flags.
+ENV_FILE_KEYS = [su.PC_DEPS_KEY, su.SYS_DEPS_KEY]
+# Keys of rule details listing other rules, like rule_builder.EXPANDABLE_KEYS.
+RULE_KEYS = [su.COMPILE_DEPS_KEY, su.DEPS_KEY, su.EXTRACT_IN_ZIP,
+             su.EXTRACT_RESOURCES_DEP_KEY, su.PACKAGE_MODULES_KEY,
+             su.PACKAGE_TESTS_KEY]
+
+
+def _get_rule_path(build_root, bld_file):
+  """Get rule path prefix of the rules in a BLD file."""
+  rel_dir = os.path.relpath(os.path.dirname(bld_file), build_root)
+  return su.RULE_ROOT_NAME + su.RULE_SEPARATOR + rel_dir.replace(
+      os.sep, su.RULE_SEPARATOR)
+
+
+def _expand_env_path(dep_path):
+  """Get the real path of a file under an environment variable directory,
+  None if it is not such a file or the variable is not set."""
+  if not dep_path.startswith(su.PC_DEPS_PREFIX):
+    return None
+  env_var, _, rel_path = dep_path.partition(os.sep)
+  env_dir = os.environ.get(env_var[len(su.PC_DEPS_PREFIX):], None)
+  if not env_dir:
+    return None
+  return os.path.realpath(os.path.join(env_dir, rel_path))
+
+
+def _get_file_entry(build_root, bld_file, file_stamp):
+  """Index the rules of a BLD file."""
+  rule_path = _get_rule_path(build_root, bld_file)
+  dir_name = os.path.dirname(bld_file)
+  rules = {}
+  for rule_name, rule_details in bfc.BUILD_FILE_CACHE.get(bld_file).iteritems():
+    files = [bld_file]
+    for key in FILE_KEYS:
+      files.extend([os.path.normpath(os.path.join(dir_name, f))
+                    for f in rule_details.get(key, [])])
+    for key in ENV_FILE_KEYS:
+      files.extend([p for p in [_expand_env_path(f)
+                                for f in rule_details.get(key, [])] if p])
+    deps = []
+    for key in RULE_KEYS:
+      deps.extend([rule_path + d if d.startswith(su.RULE_SEPARATOR) else d
+                   for d in rule_details.get(key, [])])
+    rules[rule_path + su.RULE_SEPARATOR + rule_name] = {
+        'files': sorted(set(files)), 'deps': sorted(set(deps)),
+        'light': rule_details.get(su.RULE_WEIGHT_KEY, None) is None}
+  return {'stamp': list(file_stamp), 'rules': rules}
+
+
+class DepIndex(object):
+  """Persisted index of rule sources and reverse dependencies."""
+  def __init__(self, build_root=su.BUILD_ROOT, index_file=INDEX_FILE):
+    """Initialize."""
+    # Changed files are given as real paths.
+    self._build_root = os.path.realpath(build_root)
+    self._index_file = index_file
+    # BLD file path -> {'stamp': [mtime, size], 'rules': {...}}.
+    self._entries = self._load()
+    self._rules = None
+    self._owners = None
+    self._rdeps = None
+    self._update_maps()
+
+  def _load(self):
+    """Load the persisted index, if any."""
+    if not os.path.exists(self._index_file):
+      return {}
+    try:
+      with fl.FileLocks([], [self._index_file + bfc.LOCK_FILE_SUFFIX]):
+        index = json.loads(su.read_file(self._index_file))
+    except ValueError as exc:
+      logging.debug('Ignoring corrupt dependency index %s: %s',
+                    self._index_file, exc)
+      return {}
+    if index.get('version', None) != INDEX_FORMAT_VERSION:
+      return {}
+    return index['entries']
+
+  def _save(self):
+    """Persist the index."""
+    if su.TEST_MODE_EXECUTION:
+      return
+    with fl.FileLocks([self._index_file + bfc.LOCK_FILE_SUFFIX]):
+      file_handle, temp_path = tempfile.mkstemp(
+          dir=os.path.dirname(self._index_file), prefix='.tmp.')
+      try:
+        with os.fdopen(file_handle, 'w') as file_object:
+          json.dump({'version': INDEX_FORMAT_VERSION,
+                     'entries': self._entries}, file_object, sort_keys=True)
+        os.rename(temp_path, self._index_file)
+      except (IOError, OSError) as exc:
+        logging.debug('Could not save dependency index: %s', exc)
+        if os.path.exists(temp_path):
+          os.remove(temp_path)
+
+  def _update_maps(self):
+    """Derive the file to owning rules and rule to dependent rules maps from
+    index entries."""
+    self._rules = {}
+    for entry in self._entries.itervalues():
+      self._rules.update(entry['rules'])
+    self._owners = {}
+    self._rdeps = {}
+    for rule_symbol, details in self._rules.iteritems():
+      for file_path in details['files']:
+        self._owners.setdefault(file_path, set()).add(rule_symbol)
+      for dep in details['deps']:
+        self._rdeps.setdefault(dep, set()).add(rule_symbol)
+      # Rules may depend on all the (light) rules of a BLD file, which then
+      # depend on this rule.
+      rule_path = rule_symbol.rsplit(su.RULE_SEPARATOR, 1)[0]
+      all_keys = [su.ALL_RULES_KEY]
+      if details['light']:
+        all_keys.append(su.ALL_LIGHT_RULES_KEY)
+      for key in all_keys:
+        self._rdeps.setdefault(rule_symbol, set()).add(
+            rule_path + su.RULE_SEPARATOR + key)
+
+  def _find_bld_files(self):
+    """Get modification time and size of all BLD files under build root.
+    Hidden directories and the build directories are skipped."""
+    skipped_dirs = set([su.BUILD_OUT_DIR, su.BUILD_WORK_DIR])
+    bld_files = {}
+    for root, dir_names, file_names in os.walk(self._build_root):
+      dir_names[:] = [d for d in dir_names if not d.startswith('.') and
+                      os.path.join(root, d) not in skipped_dirs]
+      if su.BUILD_FILE_NAME in file_names:
+        bld_file = os.path.join(root, su.BUILD_FILE_NAME)
+        stat_result = os.stat(bld_file)
+        bld_files[bld_file] = [stat_result.st_mtime, stat_result.st_size]
+    return bld_files
+
+  def refresh(self):
+    """Bring the index up to date, reading only added or changed BLD files.
+    Returns the number of BLD files read."""
+    bld_files = self._find_bld_files()
+    changed = [f for (f, s) in bld_files.iteritems()
+               if self._entries.get(f, {}).get('stamp', None) != s]
+    removed = set(self._entries).difference(bld_files)
+    for bld_file in removed:
+      del self._entries[bld_file]
+    for bld_file in sorted(changed):
+      try:
+        self._entries[bld_file] = _get_file_entry(
+            self._build_root, bld_file, bld_files[bld_file])
+      except (su.Error, ValueError, IOError, OSError) as exc:
+        # Rules of a broken BLD file are reported once they are built. The
+        # file is not read again until it changes.
+        logging.warning('Could not index %s: %s',
+                        su.log_normalize(bld_file), exc)
+        self._entries[bld_file] = {'stamp': bld_files[bld_file], 'rules': {},
+                                   'broken': True}
+    if changed or removed:
+      bfc.BUILD_FILE_CACHE.save()
+      self._save()
+      self._update_maps()
+    return len(changed)
+
+  def get_rules(self):
+    """Get all the indexed rules."""
+    return sorted(self._rules)
+
+  def get_broken_rule_paths(self):
+    """Get the rule paths of the BLD files which could not be read."""
+    return sorted([_get_rule_path(self._build_root, f)
+                   for (f, e) in self._entries.iteritems()
+                   if e.get('broken', False)])
+
+  def get_owners(self, file_list):
+    """Get the rules built from any of the given files, including all rules
+    of changed BLD files."""
+    owners = set()
+    for file_path in file_list:
+      owners.update(self._owners.get(file_path, []))
+    return sorted(owners)
+
+  def get_dependents(self, rule_symbols):
+    """Get the given rules along with all the rules depending on them
+    transitively. Rules which are no longer defined are left out."""
+    dependents = set()
+    pending = list(rule_symbols)
+    while pending:
+      rule_symbol = pending.pop()
+      if rule_symbol in dependents:
+        continue
+      dependents.add(rule_symbol)
+      pending.extend(self._rdeps.get(rule_symbol, []))
+    return sorted(dependents.intersection(self._rules))
+
+  def get_affected_rules(self, changed_files):
+    """Get the rules affected by changes to files, refreshing the index.
+    Rules built from a file before the refresh count too, which covers the
+    dependents of rules whose BLD file was removed."""
+    owners = set(self.get_owners(changed_files))
+    self.refresh()
+    owners.update(self.get_owners(changed_files))
+    return self.get_dependents(owners)
@@ -0,0 +1,79 @@
+"""Run simple file commands of build rules without starting processes.
+
+Rules issue many mkdir, ln, cp, mv and chmod commands, and starting a process
+for each of them costs far more than the file operation itself. These
+commands are executed in the bu process instead, behaving like the
+corresponding shell commands. Failures are raised like failed subprocess
+calls.
+"""
+import logging
+import os
+import shutil
+import subprocess
+
+# File mode creation mask, which 'chmod +x' applies. It can only be read by
+# setting it.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def is_file_command(command):
+  """Check if a command is one of the simple file commands which
+  run_file_commands executes without starting a process."""
+  name = command[0]
+  if name == 'mkdir':
+    return len(command) > 2 and command[1] == '-p'
+  if name == 'ln':
+    return len(command) == 5 and command[1:3] == ['-f', '-s']
+  if name in ('cp', 'mv'):
+    return len(command) == 3 and not command[1].startswith('-')
+  if name == 'chmod':
+    return len(command) > 2 and command[1] == '+x'
+  return False
+
+
+def _run_file_command(command, cwd):
+  """Execute a simple file command like the corresponding shell command."""
+  def _get_path(file_path):
+    """Resolve a path given to the command."""
+    return os.path.join(cwd, file_path)
+
+  name = command[0]
+  if name == 'mkdir':
+    for dir_path in command[2:]:
+      if not os.path.isdir(_get_path(dir_path)):
+        try:
+          os.makedirs(_get_path(dir_path))
+        except OSError:
+          # Another rule might have just created it.
+          if not os.path.isdir(_get_path(dir_path)):
+            raise
+  elif name == 'ln':
+    # The link target is stored as given, relative to the link location.
+    target, link_path = command[3], _get_path(command[4])
+    if os.path.isdir(link_path):
+      link_path = os.path.join(link_path, os.path.basename(target))
+    if os.path.lexists(link_path):
+      os.remove(link_path)
+    os.symlink(target, link_path)
+  elif name == 'cp':
+    shutil.copy(_get_path(command[1]), _get_path(command[2]))
+  elif name == 'mv':
+    shutil.move(_get_path(command[1]), _get_path(command[2]))
+  else:
+    for file_path in command[2:]:
+      mode = os.stat(_get_path(file_path)).st_mode
+      os.chmod(_get_path(file_path), mode | (0111 & ~_UMASK))
+
+
+def run_file_commands(command_list, cwd=None):
+  """Execute a batch of simple file commands in this process, as starting a
+  process for each of them is much slower. Failures are raised like failed
+  subprocess calls."""
+  cwd = cwd or os.getcwd()
+  for command in command_list:
+    try:
+      _run_file_command(command, cwd)
+    except (IOError, OSError, shutil.Error) as exc:
+      logging.error('%s: %s', ' '.join(command), exc)
+      raise subprocess.CalledProcessError(1, command)
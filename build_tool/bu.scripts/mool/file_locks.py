@@ -0,0 +1,104 @@
+"""Advisory locks shared by concurrent bu processes.
+
+Builds running at the same time share the lock of the working directory and
+lock the rules they build, exclusively for a rule being built and shared for
+its dependencies, so they only wait on each other for the rules they have in
+common. Cleaning the directories takes the working directory lock
+exclusively.
+"""
+import errno
+import fcntl
+import logging
+import os
+
+import mool.shared_utils as su
+
+LOCK_FILE_NAME = '.bu.lock'
+RULE_LOCKS_DIR_NAME = '.locks'
+
+
+def _lock_file(lock_path, exclusive):
+  """Take an advisory lock on a file, waiting for other processes holding it.
+  Returns the open lock file."""
+  file_object = open(lock_path, 'a')
+  mode = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+  is_locked = False
+  try:
+    try:
+      fcntl.flock(file_object, mode | fcntl.LOCK_NB)
+    except IOError as exc:
+      if exc.errno not in (errno.EAGAIN, errno.EACCES):
+        raise
+      logging.info('Waiting for another bu process to release %s',
+                   su.log_normalize(lock_path))
+      fcntl.flock(file_object, mode)
+    is_locked = True
+  finally:
+    if not is_locked:
+      file_object.close()
+  return file_object
+
+
+def _unlock_file(file_object):
+  """Release a lock taken by _lock_file."""
+  fcntl.flock(file_object, fcntl.LOCK_UN)
+  file_object.close()
+
+
+class FileLocks(object):
+  """Context manager holding advisory locks on a set of files, shared by
+  readers and exclusive to a writer. Locks are taken in sorted order of their
+  paths, so processes locking overlapping sets cannot deadlock. Unit tests run
+  without any locks."""
+  def __init__(self, exclusive_paths, shared_paths=()):
+    """Initialize."""
+    self._modes = dict([(p, False) for p in shared_paths])
+    self._modes.update([(p, True) for p in exclusive_paths])
+    self._file_objects = []
+
+  def __enter__(self):
+    """Take all the locks."""
+    if su.TEST_MODE_EXECUTION:
+      return self
+    for lock_dir in set([os.path.dirname(p) for p in self._modes]):
+      try:
+        os.makedirs(lock_dir)
+      except OSError as exc:
+        if exc.errno != errno.EEXIST:
+          raise
+    is_locked = False
+    try:
+      for lock_path in sorted(self._modes):
+        self._file_objects.append(
+            _lock_file(lock_path, self._modes[lock_path]))
+      is_locked = True
+    finally:
+      if not is_locked:
+        self.__exit__(None, None, None)
+    return self
+
+  def __exit__(self, exc_type, exc_value, exc_traceback):
+    """Release all the locks taken."""
+    while self._file_objects:
+      _unlock_file(self._file_objects.pop())
+
+
+def get_rule_lock_file(rule_symbol):
+  """Get the lock file of a rule, which guards its working and output
+  directories."""
+  return os.path.join(su.BUILD_WORK_DIR, RULE_LOCKS_DIR_NAME, rule_symbol)
+
+
+def lock_working_dir(exclusive=False):
+  """Lock the working directory. Builds share the lock and only wait on each
+  other for the rules they have in common, while cleaning the directories
+  takes the lock exclusively."""
+  return _lock_file(os.path.join(su.BUILD_WORK_DIR, LOCK_FILE_NAME),
+                    exclusive)
+
+
+def release_working_dir(file_object):
+  """Release the working directory lock."""
+  if not file_object:
+    return
+  _unlock_file(file_object)
@@ -0,0 +1,293 @@
+"""Snapshots of the files a rule is built from.
+
+A rule is rebuilt only if the snapshot of its input files differs from the
+one saved after its last build. Files are identified by content digests,
+which are persisted in a cache under BUILD_WORK_DIR and computed again only
+for files whose inode, modification time or size changed. The files looked at
+during a build are stat-ed once, directory by directory.
+"""
+import hashlib
+import logging
+import marshal
+import os
+import stat
+import tempfile
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+import mool.shared_utils as su
+
+DIGEST_CACHE_FILE_NAME = '.file_digests'
+DIGEST_CHUNK_SIZE = 1024 * 1024
+STAT_SCAN_THREADS = 8
+
+
+def get_file_digest(file_path):
+  """Get hex digest of file contents."""
+  file_hash = hashlib.sha1()
+  with open(file_path, 'rb') as file_object:
+    while True:
+      chunk = file_object.read(DIGEST_CHUNK_SIZE)
+      if not chunk:
+        break
+      file_hash.update(chunk)
+  return file_hash.hexdigest()
+
+
+class DigestCache(object):
+  """Content digests of files. Every digest is persisted along with the
+  inode, modification time and size of the file it was computed from, so a
+  file is hashed again only if one of them changed."""
+  def __init__(self, cache_file):
+    """Initialize."""
+    self._cache_file = cache_file
+    # File path -> ((inode, mtime, size), digest), loaded lazily.
+    self._entries = None
+    self._dirty = False
+    self._lock = threading.Lock()
+
+  def _load(self):
+    """Load persisted digests, if any."""
+    self._entries = {}
+    if not os.path.exists(self._cache_file):
+      return
+    try:
+      with open(self._cache_file, 'rb') as file_object:
+        self._entries = marshal.load(file_object)
+    except (EOFError, ValueError, TypeError) as exc:
+      logging.debug('Ignoring corrupt digest cache %s: %s', self._cache_file,
+                    exc)
+
+  def get_digest(self, file_path, stat_result=None):
+    """Get hex digest of file contents. Directories are identified by their
+    modification time and size only."""
+    stat_result = stat_result or os.stat(file_path)
+    file_stamp = (stat_result.st_ino, stat_result.st_mtime,
+                  stat_result.st_size)
+    if stat.S_ISDIR(stat_result.st_mode):
+      return str(file_stamp[1:])
+    with self._lock:
+      if self._entries is None:
+        self._load()
+      entry = self._entries.get(file_path, None)
+    if entry and entry[0] == file_stamp:
+      return entry[1]
+    digest = get_file_digest(file_path)
+    with self._lock:
+      self._entries[file_path] = (file_stamp, digest)
+      self._dirty = True
+    return digest
+
+  def get_digests(self):
+    """Get the digests of all the files known."""
+    with self._lock:
+      if self._entries is None:
+        self._load()
+      return set([e[1] for e in self._entries.itervalues()])
+
+  def forget(self, paths):
+    """Drop the digests of deleted files, and of all files inside deleted
+    directories."""
+    prefixes = tuple([os.path.join(p, '') for p in paths])
+    paths = set(paths)
+    with self._lock:
+      if self._entries is None:
+        self._load()
+      for file_path in self._entries.keys():
+        if file_path in paths or file_path.startswith(prefixes):
+          del self._entries[file_path]
+          self._dirty = True
+
+  def save(self):
+    """Persist digests computed since the cache was loaded."""
+    with self._lock:
+      if su.TEST_MODE_EXECUTION or not self._dirty:
+        return
+      entries = dict(self._entries)
+      self._dirty = False
+    file_handle, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(self._cache_file), prefix='.tmp.')
+    try:
+      with os.fdopen(file_handle, 'wb') as file_object:
+        marshal.dump(entries, file_object)
+      os.rename(temp_path, self._cache_file)
+    except (IOError, OSError) as exc:
+      logging.debug('Could not save digest cache: %s', exc)
+      if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+
+class StatCache(object):
+  """Stat results of the files looked at during one build.
+
+  Rules share most of their input files, especially the sources of transitive
+  dependencies, so every file is stat-ed once per build. Files asked for
+  together are looked up directory by directory on a thread pool. Listing a
+  directory once answers existence of all of its files, so only existing files
+  need a stat call. Entries of files written by a rule must be invalidated.
+  """
+  def __init__(self, num_threads=STAT_SCAN_THREADS):
+    """Initialize."""
+    self._num_threads = num_threads
+    self._pool = None
+    # Directory path -> set of its entry names.
+    self._listings = {}
+    # File path -> stat result, None for missing files.
+    self._stats = {}
+    # Directory or file path -> number of times it has been invalidated. A
+    # lookup racing with an invalidation does not store its stale result.
+    self._generations = {}
+    self._lock = threading.Lock()
+
+  @classmethod
+  def _list_dir(cls, dir_path):
+    """Get names of directory entries, None if it does not exist."""
+    try:
+      return set(os.listdir(dir_path))
+    except OSError:
+      return None
+
+  def _scan_dir(self, work_item):
+    """Stat the given files of a directory, from a pair of directory path and
+    file names."""
+    dir_path, file_names = work_item
+    with self._lock:
+      listing = self._listings.get(dir_path, False)
+      generation = self._generations.get(dir_path, 0)
+    if listing is False:
+      listing = self._list_dir(dir_path)
+      with self._lock:
+        if generation == self._generations.get(dir_path, 0):
+          self._listings[dir_path] = listing
+    results = []
+    for file_name in file_names:
+      stat_result = None
+      if listing and file_name in listing:
+        try:
+          stat_result = os.stat(os.path.join(dir_path, file_name))
+        except OSError:
+          # A dangling link.
+          pass
+      results.append((os.path.join(dir_path, file_name), stat_result))
+    return results
+
+  def prefetch(self, file_list):
+    """Look up many files at once."""
+    by_dir = {}
+    generations = {}
+    with self._lock:
+      for file_path in file_list:
+        if file_path not in self._stats:
+          generations[file_path] = self._generations.get(file_path, 0)
+          dir_path, file_name = os.path.split(file_path)
+          by_dir.setdefault(dir_path, []).append(file_name)
+      if not by_dir:
+        return
+      if len(by_dir) > 1 and not self._pool:
+        self._pool = ThreadPool(self._num_threads)
+    work_items = sorted(by_dir.items())
+    if len(work_items) > 1:
+      dir_results = self._pool.map(self._scan_dir, work_items)
+    else:
+      dir_results = [self._scan_dir(work_items[0])]
+    with self._lock:
+      for results in dir_results:
+        for file_path, stat_result in results:
+          if generations[file_path] == self._generations.get(file_path, 0):
+            self._stats[file_path] = stat_result
+
+  def get(self, file_path):
+    """Get stat result of a file, None if it does not exist."""
+    while True:
+      with self._lock:
+        if file_path in self._stats:
+          return self._stats[file_path]
+      # Retried if the file is invalidated while being looked up.
+      self.prefetch([file_path])
+
+  def invalidate(self, file_list):
+    """Forget about files which have been written since they were looked
+    up."""
+    with self._lock:
+      for file_path in file_list:
+        dir_path = os.path.dirname(file_path)
+        self._stats.pop(file_path, None)
+        self._listings.pop(dir_path, None)
+        for path in (file_path, dir_path):
+          self._generations[path] = self._generations.get(path, 0) + 1
+
+  def close(self):
+    """Stop lookup threads."""
+    if self._pool:
+      self._pool.close()
+      self._pool.join()
+      self._pool = None
+
+
+# Digests of files seen by this process, shared by all rules.
+DIGEST_CACHE = DigestCache(
+    os.path.join(su.BUILD_WORK_DIR, DIGEST_CACHE_FILE_NAME))
+
+
+def _get_current_snapshot_text(file_list, rule_hash, stat_cache, abi_files,
+                               get_abi_digest):
+  """Gets current snapshot text from file list. Files are identified by
+  content digests, so touching a file or regenerating an identical output of
+  a dependency does not cause a rebuild. The files in abi_files are identified
+  by get_abi_digest(file_path, digest) instead."""
+  found_all = True
+  abi_files = set(abi_files)
+  curr_snapshot_map = {}
+  stat_cache = stat_cache or StatCache()
+  stat_cache.prefetch(file_list)
+  for file_path in file_list:
+    assert file_path not in curr_snapshot_map
+    stat_result = stat_cache.get(file_path)
+    if not stat_result:
+      logging.debug('Did not find %s', file_path)
+      found_all = False
+      break
+    digest = DIGEST_CACHE.get_digest(file_path, stat_result)
+    if file_path in abi_files:
+      digest = get_abi_digest(file_path, digest)
+    curr_snapshot_map[file_path] = digest
+  curr_snapshot_text = '\n'.join(
+      ['{} {}'.format(v, k) for (k, v) in sorted(curr_snapshot_map.items())])
+  full_snapshot_text = '{}: {}\n{}'.format(
+      'RULE_DETAILS_HASH_VALUE', rule_hash, curr_snapshot_text)
+  return found_all, full_snapshot_text
+
+
+def needs_build(working_dir, file_list, rule_hash, stat_cache=None,
+                abi_files=(), get_abi_digest=None,
+                cache_file_name=su.CACHE_FILE_NAME):
+  """Checks file list snapshot for any changes."""
+  tracer = logging.debug
+  cache_file = os.path.join(working_dir, cache_file_name)
+  if not su.path_exists(cache_file):
+    tracer('Did not find cache file at %s', su.log_normalize(cache_file))
+    return True
+  found_all, snapshot_text = _get_current_snapshot_text(
+      file_list, rule_hash, stat_cache, abi_files, get_abi_digest)
+  if not found_all:
+    tracer('Did not find all files present.')
+    return True
+  cached_text = su.read_file(cache_file)
+  if snapshot_text != cached_text:
+    tracer('Snapshot mismatch.')
+    tracer('\nCache file: \n%s', cached_text)
+    tracer('\nCurrent snapshot: \n%s', snapshot_text)
+    return True
+  return False
+
+
+def save_file_list_cache(working_dir, file_list, rule_hash, stat_cache=None,
+                         abi_files=(), get_abi_digest=None,
+                         cache_file_name=su.CACHE_FILE_NAME):
+  """Saves file list snapshot to disk."""
+  found_all, snapshot_text = _get_current_snapshot_text(
+      file_list, rule_hash, stat_cache, abi_files, get_abi_digest)
+  assert found_all
+  cache_file = os.path.join(working_dir, cache_file_name)
+  su.write_file(cache_file, snapshot_text)
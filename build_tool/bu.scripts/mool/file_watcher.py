@@ -0,0 +1,181 @@
+"""Watch a set of files for changes.
+
+On Linux the parent directories of the watched files are subscribed to with
+inotify, which also catches editors that save by renaming a new file over the
+old one. Elsewhere, or when inotify is not usable (e.g. the per user watch
+limit is exhausted), the files are polled for changes in modification time or
+size.
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+import mool.shared_utils as su
+
+# Changes arriving within this many seconds of each other are reported
+# together, as saving a file or checking out a branch touches many files.
+DEBOUNCE_SECONDS = 0.2
+POLL_INTERVAL_SECONDS = 0.5
+
+# From sys/inotify.h.
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_CLOEXEC = 0x00080000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE)
+EVENT_HEADER = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+
+
+class Error(su.Error):
+  """Error class for this module."""
+
+
+class PollingWatcher(object):
+  """Detects changes by comparing file modification times and sizes."""
+  def __init__(self, poll_interval=POLL_INTERVAL_SECONDS):
+    """Initialize."""
+    self._poll_interval = poll_interval
+    self._snapshot = {}
+
+  @classmethod
+  def _get_signature(cls, file_path):
+    """Get modification time and size of a file, None if it is missing."""
+    try:
+      stat_result = os.stat(file_path)
+    except OSError:
+      return None
+    return (stat_result.st_mtime, stat_result.st_size)
+
+  def set_files(self, file_paths):
+    """Set the files to watch."""
+    self._snapshot = dict([(f, self._get_signature(f)) for f in file_paths])
+
+  def _get_changes(self):
+    """Get files changed since last check."""
+    changed = set()
+    for file_path, signature in self._snapshot.iteritems():
+      new_signature = self._get_signature(file_path)
+      if new_signature != signature:
+        self._snapshot[file_path] = new_signature
+        changed.add(file_path)
+    return changed
+
+  def wait_for_changes(self, timeout=None):
+    """Wait for changes to the watched files. Returns the set of changed
+    files, which is empty on timeout."""
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+      changed = self._get_changes()
+      if changed:
+        time.sleep(DEBOUNCE_SECONDS)
+        changed.update(self._get_changes())
+        return changed
+      if deadline is not None and time.time() >= deadline:
+        return changed
+      time.sleep(self._poll_interval)
+
+  def close(self):
+    """Release resources."""
+
+
+class InotifyWatcher(object):
+  """Detects changes with inotify subscriptions on parent directories."""
+  def __init__(self):
+    """Initialize."""
+    libc_name = ctypes.util.find_library('c')
+    if not libc_name:
+      raise Error('Could not find C library for inotify.')
+    self._libc = ctypes.CDLL(libc_name, use_errno=True)
+    if not hasattr(self._libc, 'inotify_init1'):
+      raise Error('inotify is not supported on this platform.')
+    self._fd = self._libc.inotify_init1(IN_CLOEXEC)
+    if self._fd < 0:
+      raise Error('inotify_init1 failed: {}'.format(
+          os.strerror(ctypes.get_errno())))
+    self._files = set()
+    # Watch descriptor -> directory path and back.
+    self._watched_dirs = {}
+    self._dir_watches = {}
+
+  def set_files(self, file_paths):
+    """Set the files to watch."""
+    self._files = set(file_paths)
+    dirs = set([os.path.dirname(f) for f in self._files])
+    for dir_path in sorted(set(self._dir_watches).difference(dirs)):
+      self._libc.inotify_rm_watch(self._fd, self._dir_watches.pop(dir_path))
+    for dir_path in sorted(dirs.difference(self._dir_watches)):
+      watch = self._libc.inotify_add_watch(self._fd, dir_path, WATCH_MASK)
+      if watch < 0:
+        error_code = ctypes.get_errno()
+        if error_code == errno.ENOENT:
+          # Watching the parent of a missing directory would be needed to
+          # notice its creation. This is rare enough to be ignored.
+          logging.debug('Not watching missing directory %s', dir_path)
+          continue
+        raise Error('Could not watch {}: {}'.format(
+            dir_path, os.strerror(error_code)))
+      self._dir_watches[dir_path] = watch
+      self._watched_dirs[watch] = dir_path
+
+  def _read_changes(self, timeout):
+    """Read pending events, waiting at most timeout seconds for the first
+    one."""
+    readable, _, _ = select.select([self._fd], [], [], timeout)
+    if not readable:
+      return set()
+    data = os.read(self._fd, READ_SIZE)
+    changed = set()
+    offset = 0
+    while offset < len(data):
+      watch, _, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+      offset += EVENT_HEADER.size
+      name = data[offset:offset + name_length].rstrip('\0')
+      offset += name_length
+      dir_path = self._watched_dirs.get(watch, None)
+      if dir_path and name:
+        file_path = os.path.join(dir_path, name)
+        if file_path in self._files:
+          changed.add(file_path)
+    return changed
+
+  def wait_for_changes(self, timeout=None):
+    """Wait for changes to the watched files. Returns the set of changed
+    files, which is empty on timeout."""
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+      remaining = None if deadline is None else max(0, deadline - time.time())
+      changed = self._read_changes(remaining)
+      if changed:
+        while True:
+          more_changes = self._read_changes(DEBOUNCE_SECONDS)
+          if not more_changes:
+            return changed
+          changed.update(more_changes)
+      if deadline is not None and time.time() >= deadline:
+        return changed
+
+  def close(self):
+    """Release resources."""
+    if self._fd >= 0:
+      os.close(self._fd)
+      self._fd = -1
+
+
+def get_file_watcher():
+  """Get the best file watcher available on this system."""
+  try:
+    return InotifyWatcher()
+  except Error as exc:
+    logging.info('Polling for changes, %s', exc)
+    return PollingWatcher()
@@ -0,0 +1,108 @@
+"""Persistent index of the entries of jar files.
+
+The entries of a jar, name -> (CRC, size), are indexed the first time the jar
+is looked up and kept in a file of their own under BUILD_WORK_DIR, named by
+the digest of the jar contents. Index files are only read when their jar is
+looked up, and then kept in memory for the rest of the process. A maven jar
+is therefore scanned once per version, however many class paths and merged
+jars it is part of.
+"""
+import logging
+import marshal
+import os
+import tempfile
+import threading
+import zipfile
+
+import mool.file_snapshot as fs
+import mool.shared_utils as su
+
+INDEX_DIR = os.path.join(su.BUILD_WORK_DIR, '.jar_index')
+# Bump this whenever the contents of index files change.
+INDEX_FORMAT_VERSION = 1
+# Positions in an index entry.
+CRC_INDEX = 0
+SIZE_INDEX = 1
+
+
+class JarIndex(object):
+  """Entries of jar files, indexed by the digest of their contents."""
+  def __init__(self, index_dir=INDEX_DIR):
+    """Initialize."""
+    self._index_dir = index_dir
+    # Jar digest -> entry name -> (CRC, size) of the jars looked up so far.
+    self._jars = {}
+    self._lock = threading.Lock()
+
+  def _read(self, index_file):
+    """Read an index file, None if there is none."""
+    if not os.path.exists(index_file):
+      return None
+    try:
+      with open(index_file, 'rb') as file_object:
+        version, entries = marshal.load(file_object)
+    except (EOFError, ValueError, TypeError) as exc:
+      logging.debug('Ignoring corrupt jar index %s: %s', index_file, exc)
+      return None
+    if version != INDEX_FORMAT_VERSION:
+      return None
+    return entries
+
+  def _save(self, index_file, entries):
+    """Write an index file."""
+    if su.TEST_MODE_EXECUTION:
+      return
+    if not os.path.isdir(self._index_dir):
+      os.makedirs(self._index_dir)
+    file_handle, temp_path = tempfile.mkstemp(dir=self._index_dir,
+                                              prefix='.tmp.')
+    try:
+      with os.fdopen(file_handle, 'wb') as file_object:
+        marshal.dump((INDEX_FORMAT_VERSION, entries), file_object)
+      os.rename(temp_path, index_file)
+    except (IOError, OSError) as exc:
+      logging.debug('Could not save jar index: %s', exc)
+      if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+  @classmethod
+  def _scan(cls, jar_file):
+    """Index all the entries of a jar."""
+    with zipfile.ZipFile(jar_file, 'r') as jar_obj:
+      return dict([(i.filename, (i.CRC, i.file_size))
+                   for i in jar_obj.infolist()])
+
+  def get_entries(self, jar_file, digest=None):
+    """Get entry name -> (CRC, size) of all the entries of a jar. The digest
+    of the jar is looked up unless given."""
+    if digest is None:
+      digest = fs.DIGEST_CACHE.get_digest(jar_file)
+    with self._lock:
+      entries = self._jars.get(digest, None)
+    if entries is not None:
+      return entries
+    index_file = os.path.join(self._index_dir, digest)
+    entries = self._read(index_file)
+    if entries is None:
+      entries = self._scan(jar_file)
+      self._save(index_file, entries)
+    with self._lock:
+      self._jars[digest] = entries
+    return entries
+
+  def remove_unused(self, digests):
+    """Delete the index files of jars with none of the given digests. Returns
+    the number of index files deleted. Hidden files, like the temporary files
+    of indexes being saved by a concurrent bu process, are left alone."""
+    if not os.path.isdir(self._index_dir):
+      return 0
+    digests = set(digests)
+    removed = 0
+    for file_name in os.listdir(self._index_dir):
+      if not file_name.startswith('.') and file_name not in digests:
+        os.remove(os.path.join(self._index_dir, file_name))
+        removed += 1
+    return removed
+
+
+JAR_INDEX = JarIndex()
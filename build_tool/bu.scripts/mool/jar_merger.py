@@ -1,13 +1,49 @@
-"""Jar merger utility."""
+"""Jar merger utility.
+
+Entries of the merged jars are copied as they are stored, compressed data and
+CRC included, a chunk at a time. Nothing is decompressed or compressed again,
+and memory use does not depend on the size of the entries. The manifest is
+written by the merger itself.
+
+Next to a merged jar, in the state directory of the output, the merger keeps a
+hard link to it and an index of the entries each input jar contributed, with
+their CRCs. Merging into the jar again only reads the jars whose digest
+changed. Entries of the other jars are copied from the previous output in runs
+of consecutive entries, and file clashes are found from the indexes. Entries
+of the jars are looked up in the jar index rather than read from the jars.
+"""
+import json
+import logging
 import os
+import shutil
+import struct
 import subprocess
 import zipfile
 
+import mool.file_snapshot as fs
+import mool.jar_index as ji
 import mool.shared_utils as su
 
 
 MANIFEST_SERVICES_PREFIX = os.path.join(
     su.JAR_MANIFEST_KEY, su.JAR_MANIFEST_SERVICE_KEY, '')
+MANIFEST_DIR = os.path.join(su.JAR_MANIFEST_KEY, '')
+MANIFEST_FILE = os.path.join(su.JAR_MANIFEST_KEY, 'MANIFEST.MF')
+# Manifest lines may not be longer than this many bytes, see the jar file
+# specification.
+MANIFEST_LINE_LENGTH = 72
+COPY_CHUNK_SIZE = 1024 * 1024
+# Positions in a local file header, as unpacked by zipfile.structFileHeader.
+FILE_HEADER_SIGNATURE_INDEX = 0
+FILE_HEADER_NAME_LENGTH_INDEX = 10
+FILE_HEADER_EXTRA_LENGTH_INDEX = 11
+# Local file headers flag a data descriptor following the data with this bit.
+DATA_DESCRIPTOR_FLAG = 0x08
+# Files kept next to a merged jar for merging into it again.
+LINK_INDEX_FILE_NAME = 'link_index'
+PREVIOUS_JAR_FILE_NAME = 'previous.jar'
+# Bump this whenever the contents of link indexes change.
+LINK_INDEX_VERSION = 1
 
 
 class Error(su.Error):
@@ -26,20 +62,19 @@ def check_jar_collisions(jar_list):
   class_map = {}
   clashes_found = False
   for jar_file in jar_list:
-    with zipfile.ZipFile(jar_file, 'r') as jar_obj:
-      for cfile in sorted(jar_obj.namelist()):
-        if cfile.startswith('META-INF') or not cfile.endswith('.class'):
-          continue
-        crc = jar_obj.getinfo(cfile).CRC
-        if cfile not in class_map:
-          class_map[cfile] = (crc, jar_file)
-        elif class_map[cfile][0] != crc:
-          clashes_found = True
-          msg = 'Same file {} with different content found in jars {} & {}!'
-          msg = msg.format(cfile, os.path.realpath(jar_file),
-                           os.path.realpath(class_map[cfile][1]))
-          # TODO: We may want to change this to error in future!
-          _raise_warning(msg)
+    for cfile, entry in sorted(ji.JAR_INDEX.get_entries(jar_file).iteritems()):
+      if cfile.startswith('META-INF') or not cfile.endswith('.class'):
+        continue
+      crc = entry[ji.CRC_INDEX]
+      if cfile not in class_map:
+        class_map[cfile] = (crc, jar_file)
+      elif class_map[cfile][0] != crc:
+        clashes_found = True
+        msg = 'Same file {} with different content found in jars {} & {}!'
+        msg = msg.format(cfile, os.path.realpath(jar_file),
+                         os.path.realpath(class_map[cfile][1]))
+        # TODO: We may want to change this to error in future!
+        _raise_warning(msg)
   return clashes_found
 
 
@@ -67,15 +102,38 @@ def _allowed(src_file, inclusions, exclusions):
   return False
 
 
+def _get_file_stamp(file_path):
+  """Get modification time and size of a file."""
+  stat_result = os.stat(file_path)
+  return [stat_result.st_mtime, stat_result.st_size]
+
+
+def _get_manifest_text(main_class):
+  """Get contents of the manifest of a merged jar."""
+  attributes = [('Manifest-Version', '1.0'), ('Created-By', 'mool')]
+  if main_class != su.JAVA_FAKE_MAIN_CLASS:
+    attributes.append(('Main-Class', main_class))
+  lines = []
+  for name, value in attributes:
+    line = '{}: {}'.format(name, value)
+    lines.append(line[:MANIFEST_LINE_LENGTH])
+    # Longer values continue on lines starting with a space.
+    for start in xrange(MANIFEST_LINE_LENGTH, len(line),
+                        MANIFEST_LINE_LENGTH - 1):
+      lines.append(' ' + line[start:start + MANIFEST_LINE_LENGTH - 1])
+  return '\r\n'.join(lines + ['', ''])
+
+
 class JarMerger(object):
   """Jar merger utility class."""
   def __init__(self, params):
     """Initializer."""
     self.manifest_services = {}
-    self.file_hash_dict = {}
-    self.file_src_dict = {}
     (self.jar_files, self.inclusions, self.exclusions,
      self.jar_out_file) = params
+    state_dir = su.get_output_state_dir(self.jar_out_file)
+    self._index_file = os.path.join(state_dir, LINK_INDEX_FILE_NAME)
+    self._previous_jar = os.path.join(state_dir, PREVIOUS_JAR_FILE_NAME)
 
   @classmethod
   def _read_file_from_archive(cls, read_obj, src_file):
@@ -91,36 +149,244 @@ class JarMerger(object):
     else:
       write_obj.writestr(src_file, file_text, zipfile.ZIP_DEFLATED)
 
-  def _copy_file_obj(self, write_obj, jar_file, read_obj, src_file):
-    """Utility to copy file from source archive to destination archive."""
-    file_hash = read_obj.getinfo(src_file).CRC
-    if src_file not in self.file_hash_dict:
-      with read_obj.open(src_file, 'r') as src_obj:
-        # Python standard zipfile library doesn't allow appending to an
-        # existing file in zip. For now we read whole file in memory and write
-        # it back.
-        self._write_target_file(write_obj, src_file, src_obj.read())
-      self.file_hash_dict[src_file] = file_hash
-    elif self.file_hash_dict[src_file] != file_hash:
-      raise Error(
-          'File clash: Mismatching "{}" exists in both {} and {}'.format(
-              src_file, self.file_src_dict[src_file], jar_file))
-    else:
-      # There was a duplicate with the same hash. Ignore and continue.
-      pass
+  @classmethod
+  def _copy_bytes(cls, src_fp, dst_fp, size, src_name):
+    """Copy size bytes from the current position of src_fp, a chunk at a
+    time."""
+    remaining = size
+    while remaining:
+      chunk = src_fp.read(min(remaining, COPY_CHUNK_SIZE))
+      if not chunk:
+        raise Error('Unexpected end of {}'.format(src_name))
+      dst_fp.write(chunk)
+      remaining -= len(chunk)
+
+  @classmethod
+  def _add_entry_info(cls, write_obj, src_info, header_offset):
+    """Register an entry copied as it is stored with the destination archive,
+    the way ZipFile.writestr does. The standard zipfile library has no such
+    operation."""
+    dst_info = zipfile.ZipInfo(src_info.filename, src_info.date_time)
+    for attr in ['compress_type', 'CRC', 'compress_size', 'file_size',
+                 'create_system', 'create_version', 'extract_version',
+                 'internal_attr', 'external_attr']:
+      setattr(dst_info, attr, getattr(src_info, attr))
+    # Sizes and CRC are known up front, so no data descriptor is written.
+    dst_info.flag_bits = src_info.flag_bits & ~DATA_DESCRIPTOR_FLAG
+    dst_info.header_offset = header_offset
+    write_obj._writecheck(dst_info)  # pylint: disable=W0212
+    write_obj._didModify = True  # pylint: disable=W0212
+    write_obj.filelist.append(dst_info)
+    write_obj.NameToInfo[dst_info.filename] = dst_info
+    return dst_info
+
+  @classmethod
+  def _copy_raw_entry(cls, write_obj, read_obj, src_info):
+    """Copy an entry from source archive to destination archive without
+    decompressing it."""
+    read_obj.fp.seek(src_info.header_offset)
+    file_header = struct.unpack(
+        zipfile.structFileHeader, read_obj.fp.read(zipfile.sizeFileHeader))
+    if file_header[FILE_HEADER_SIGNATURE_INDEX] != zipfile.stringFileHeader:
+      raise Error('Bad local header of {} in {}'.format(
+          src_info.filename, read_obj.filename))
+    read_obj.fp.seek(file_header[FILE_HEADER_NAME_LENGTH_INDEX] +
+                     file_header[FILE_HEADER_EXTRA_LENGTH_INDEX], os.SEEK_CUR)
+    dst_info = cls._add_entry_info(write_obj, src_info, write_obj.fp.tell())
+    write_obj.fp.write(dst_info.FileHeader())
+    cls._copy_bytes(read_obj.fp, write_obj.fp, src_info.compress_size,
+                    read_obj.filename)
 
-  def _copy_src_file(self, write_obj, jar_file, read_obj, src_file):
-    """Copy the src_file from source jar (read_obj) to the target jar
-    (write_obj)."""
-    if not _allowed(src_file, self.inclusions, self.exclusions):
+  @classmethod
+  def _copy_previous_entries(cls, write_obj, previous_obj, src_infos,
+                             end_offset):
+    """Copy entries stored one after the other in the previous output with
+    a single copy of their local headers and data."""
+    start_offset = src_infos[0].header_offset
+    shift = write_obj.fp.tell() - start_offset
+    for src_info in src_infos:
+      cls._add_entry_info(write_obj, src_info, src_info.header_offset + shift)
+    previous_obj.fp.seek(start_offset)
+    cls._copy_bytes(previous_obj.fp, write_obj.fp, end_offset - start_offset,
+                    previous_obj.filename)
+
+  def _scan_jar(self, jar_file, digest):
+    """Index the entries a jar contributes to the merged jar, in the order
+    they are merged, along with its service files. Only jars with service
+    files are opened, to read them."""
+    entries = []
+    service_files = []
+    for src_file, entry in sorted(
+        ji.JAR_INDEX.get_entries(jar_file, digest).iteritems()):
+      if not _allowed(src_file, self.inclusions, self.exclusions):
+        continue
+      if src_file in [MANIFEST_DIR, MANIFEST_FILE]:
+        # The merged jar gets a manifest of its own.
+        continue
+      if src_file.startswith(MANIFEST_SERVICES_PREFIX):
+        service_files.append(src_file)
+      else:
+        entries.append([src_file, entry[ji.CRC_INDEX]])
+    services = {}
+    if service_files:
+      with zipfile.ZipFile(jar_file, 'r') as read_obj:
+        for src_file in service_files:
+          services[src_file] = self._read_file_from_archive(read_obj,
+                                                            src_file)
+    return {'path': jar_file, 'digest': digest, 'entries': entries,
+            'services': services}
+
+  def _get_jar_indexes(self, link_index):
+    """Index all the jars to merge. Jars indexed by the previous merge are
+    only scanned again if their contents changed."""
+    previous_jars = {}
+    if link_index:
+      for jar_index in link_index['jars']:
+        previous_jars[(jar_index['path'], jar_index['digest'])] = jar_index
+    jar_indexes = []
+    for jar_file in self.jar_files:
+      digest = fs.DIGEST_CACHE.get_digest(jar_file)
+      jar_index = previous_jars.get((jar_file, digest), None)
+      if jar_index is None:
+        jar_index = self._scan_jar(jar_file, digest)
+      jar_indexes.append(jar_index)
+    return jar_indexes
+
+  @classmethod
+  def _get_merge_order(cls, jar_indexes):
+    """Get the entries of the merged jar as (name, position of the jar taken
+    from) in order. An entry found in more than one jar is taken from the
+    first, but only if all its copies are the same."""
+    taken = {}
+    merge_order = []
+    for position, jar_index in enumerate(jar_indexes):
+      for src_file, file_hash in jar_index['entries']:
+        if src_file not in taken:
+          taken[src_file] = (file_hash, position)
+          merge_order.append((src_file, position))
+        elif taken[src_file][0] != file_hash:
+          raise Error(
+              'File clash: Mismatching "{}" exists in both {} and {}'.format(
+                  src_file, jar_indexes[taken[src_file][1]]['path'],
+                  jar_index['path']))
+        else:
+          # There was a duplicate with the same hash. Ignore and continue.
+          pass
+    return merge_order
+
+  def _load_link_index(self):
+    """Load the index of the previous merge into this jar, None if its output
+    can't be reused."""
+    if not os.path.exists(self._index_file):
+      return None
+    try:
+      link_index = json.loads(su.read_file(self._index_file))
+      previous_stamp = _get_file_stamp(self._previous_jar)
+    except (ValueError, OSError) as exc:
+      logging.debug('Ignoring link index %s: %s', self._index_file, exc)
+      return None
+    if ((link_index.get('version', None) != LINK_INDEX_VERSION or
+         link_index['inclusions'] != self.inclusions or
+         link_index['exclusions'] != self.exclusions or
+         link_index['previous_stamp'] != previous_stamp)):
+      return None
+    for jar_index in link_index['jars']:
+      jar_index['services'] = dict([
+          (k, v.encode('utf-8'))
+          for (k, v) in jar_index['services'].iteritems()])
+    return link_index
+
+  def _save_link_index(self, jar_indexes):
+    """Keep the merged jar and its index for the next merge."""
+    state_dir = os.path.dirname(self._index_file)
+    temp_jar = self._previous_jar + '.temp'
+    temp_index = self._index_file + '.temp'
+    try:
+      if not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+      if os.path.exists(temp_jar):
+        os.remove(temp_jar)
+      # A hard link costs no space while the merged jar exists, and keeps its
+      # contents once the next build deletes it.
+      os.link(self.jar_out_file, temp_jar)
+      os.rename(temp_jar, self._previous_jar)
+      with open(temp_index, 'w') as file_object:
+        # Unlike json.dump, json.dumps encodes with the C speedups.
+        file_object.write(json.dumps({
+            'version': LINK_INDEX_VERSION, 'inclusions': self.inclusions,
+            'exclusions': self.exclusions,
+            'previous_stamp': _get_file_stamp(self._previous_jar),
+            'jars': jar_indexes}))
+      os.rename(temp_index, self._index_file)
+    except (IOError, OSError, UnicodeDecodeError) as exc:
+      logging.debug('Could not save link index of %s: %s', self.jar_out_file,
+                    exc)
+      shutil.rmtree(state_dir, ignore_errors=True)
+
+  def _copy_entries(self, write_obj, jar_indexes, merge_order, link_index):
+    """Copy the entries of the merged jars. Entries of the jars which did not
+    change since the previous merge are copied from its output, a run of
+    entries at a time, and the others from their jars."""
+    previous_sources = {}
+    previous_infos = []
+    previous_obj = None
+    if link_index:
+      previous_jars = link_index['jars']
+      for src_file, position in self._get_merge_order(previous_jars):
+        previous_sources[src_file] = (previous_jars[position]['path'],
+                                      previous_jars[position]['digest'])
+      previous_obj = zipfile.ZipFile(self._previous_jar, 'r')
+      previous_infos = sorted(previous_obj.infolist(),
+                              key=lambda i: i.header_offset)
+    # Entry name -> its position in the previous output.
+    previous_positions = dict([(i.filename, p)
+                               for (p, i) in enumerate(previous_infos)])
+    previous_run = []
+    read_obj = None
+    read_position = None
+    try:
+      for src_file, position in merge_order:
+        jar_index = jar_indexes[position]
+        previous_position = previous_positions.get(src_file, None)
+        if ((previous_position is not None and
+             previous_sources.get(src_file, None) == (jar_index['path'],
+                                                      jar_index['digest']))):
+          if previous_run and previous_run[-1] + 1 != previous_position:
+            self._flush_previous_run(write_obj, previous_obj, previous_infos,
+                                     previous_run)
+          previous_run.append(previous_position)
+          continue
+        self._flush_previous_run(write_obj, previous_obj, previous_infos,
+                                 previous_run)
+        if read_position != position:
+          if read_obj:
+            read_obj.close()
+          read_obj = zipfile.ZipFile(jar_index['path'], 'r')
+          read_position = position
+        self._copy_raw_entry(write_obj, read_obj, read_obj.getinfo(src_file))
+      self._flush_previous_run(write_obj, previous_obj, previous_infos,
+                               previous_run)
+    finally:
+      if read_obj:
+        read_obj.close()
+      if previous_obj:
+        previous_obj.close()
+
+  @classmethod
+  def _flush_previous_run(cls, write_obj, previous_obj, previous_infos,
+                          previous_run):
+    """Copy a pending run of entries of the previous output."""
+    if not previous_run:
       return
-    if src_file.startswith(MANIFEST_SERVICES_PREFIX):
-      if src_file not in self.manifest_services:
-        self.manifest_services[src_file] = []
-      self.manifest_services[src_file].append(
-          self._read_file_from_archive(read_obj, src_file))
+    last_position = previous_run[-1]
+    if last_position + 1 < len(previous_infos):
+      end_offset = previous_infos[last_position + 1].header_offset
     else:
-      self._copy_file_obj(write_obj, jar_file, read_obj, src_file)
+      end_offset = previous_obj.start_dir
+    cls._copy_previous_entries(
+        write_obj, previous_obj,
+        [previous_infos[p] for p in previous_run], end_offset)
+    del previous_run[:]
 
   def _merge_manifests(self, write_obj):
     """Merge manifest files to output archive."""
@@ -145,26 +411,34 @@ class JarMerger(object):
     copy_ok = ((not need_main) and (1 == len(self.jar_files)) and
                (not self.inclusions) and (not self.exclusions))
     if copy_ok:
+      shutil.rmtree(os.path.dirname(self._index_file), ignore_errors=True)
       subprocess.check_call(
           su.get_copy_command(
               self.jar_files[0], self.jar_out_file,
               su.is_temporary_path(self.jar_out_file)))
       return
+    link_index = self._load_link_index()
+    jar_indexes = self._get_jar_indexes(link_index)
+    # File clashes are found before anything is written.
+    merge_order = self._get_merge_order(jar_indexes)
     self.manifest_services = {}
-    with zipfile.ZipFile(self.jar_out_file, 'w') as write_obj:
-      self._write_target_file(
-          write_obj, os.path.join(su.JAR_MANIFEST_KEY, ''), '')
-      for jar_file in self.jar_files:
-        with zipfile.ZipFile(jar_file, 'r') as read_obj:
-          for src_file in sorted(read_obj.namelist()):
-            self._copy_src_file(write_obj, jar_file, read_obj, src_file)
-            self.file_src_dict[src_file] = jar_file
-      self._merge_manifests(write_obj)
-    # Finally pre-process once using the jar tool to make it look official.
-    if need_main:
-      subprocess.check_call([su.JAR_BIN, 'ufe', self.jar_out_file, main_class])
-    else:
-      subprocess.check_call([su.JAR_BIN, 'umf', os.devnull, self.jar_out_file])
+    for jar_index in jar_indexes:
+      for src_file, file_text in sorted(jar_index['services'].iteritems()):
+        self.manifest_services.setdefault(src_file, []).append(file_text)
+    temp_out_file = self.jar_out_file + '.temp'
+    try:
+      with zipfile.ZipFile(temp_out_file, 'w', allowZip64=True) as write_obj:
+        # The manifest comes first, as java.util.jar.JarInputStream expects.
+        self._write_target_file(write_obj, MANIFEST_DIR, '')
+        self._write_target_file(write_obj, MANIFEST_FILE,
+                                _get_manifest_text(main_class))
+        self._copy_entries(write_obj, jar_indexes, merge_order, link_index)
+        self._merge_manifests(write_obj)
+      os.rename(temp_out_file, self.jar_out_file)
+    finally:
+      if os.path.exists(temp_out_file):
+        os.remove(temp_out_file)
+    self._save_link_index(jar_indexes)
 
 
 def do_merge(lib_details, jar_out_file, main_class):
@@ -5,8 +5,10 @@ import subprocess
 import zipfile
 import xml.etree.ElementTree as ElementTree
 
+import mool.file_commands as fcmd
 import mool.jar_merger as jm
 import mool.shared_utils as su
+import mool.test_process as tp
 
 TEST_METHOD_XPATH = './suite/test/class/test-method[@status=\'FAIL\']'
 
@@ -30,16 +32,18 @@ def _display_details(result_file):
 
   if not os.path.exists(result_file):
     return
-  print 'Detailed results at: {}\n'.format(su.log_normalize(result_file))
+  output = tp.get_test_output()
+  print >> output, 'Detailed results at: {}\n'.format(
+      su.log_normalize(result_file))
   node_root = ElementTree.parse(result_file).getroot()
   for test_method in node_root.findall(TEST_METHOD_XPATH):
-    print '---------------------------------------------'
-    print test_method.attrib['signature']
+    print >> output, '---------------------------------------------'
+    print >> output, test_method.attrib['signature']
     stack_text = test_method.findall('./exception/full-stacktrace')[0].text
     stack_text_lines = [l for l in stack_text.strip().split('\n')
                         if _line_ok(l)]
-    print '\n'.join(stack_text_lines)
-    print
+    print >> output, '\n'.join(stack_text_lines)
+    print >> output
 
 
 def _extract_files_from_jars(work_dir, jar_list):
@@ -57,9 +61,9 @@ def do_main(args):
   class_path_list = [jar_path]
   class_path_list.extend(
       [os.path.join(classpath_dir, j) for j in os.listdir(classpath_dir)])
-  subprocess.check_call(su.get_mkdir_command(results_dir))
   working_dir = os.path.join(results_dir, '.wdir')
-  subprocess.check_call(su.get_mkdir_command(working_dir))
+  fcmd.run_file_commands([su.get_mkdir_command(results_dir),
+                          su.get_mkdir_command(working_dir)])
 
   _extract_files_from_jars(working_dir, extract_jars)
   result_file = None
@@ -72,11 +76,11 @@ def do_main(args):
          '-d', results_dir, '-groups', ','.join(test_groups),
          '-testclass', ','.join(test_classes)])
     logging.debug('Command: %s', ' '.join(test_command))
-    subprocess.check_call(test_command, cwd=working_dir)
+    tp.run_test_process(test_command, cwd=working_dir)
   except subprocess.CalledProcessError:
     result_file = os.path.join(results_dir, 'testng-results.xml')
     _display_details(result_file)
     raise
   finally:
     if clashes_found:
-      print CLASHING_DEPS_MSG
+      print >> tp.get_test_output(), CLASHING_DEPS_MSG
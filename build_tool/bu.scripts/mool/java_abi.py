@@ -0,0 +1,433 @@
+"""Digests of the public API of jar files.
+
+Java rules are compiled against the jars of their dependencies, and only
+need to be compiled again when the API of one of them changes, not when a
+method body or a private member does. The API digest of a jar covers every
+class which is not private, anonymous or local: its access flags, name,
+super class, interfaces and generic signature, along with the access flags,
+names, descriptors, generic signatures and exceptions of its fields and
+methods which are neither private nor synthetic, and the values of constants,
+which javac inlines into dependent classes. Annotations and annotation
+defaults, which annotation processors of dependent rules read and javac checks
+uses of annotations against, are covered too, as are the permitted subclasses,
+record components and method parameters of classes. Other entries,
+resources and the manifest included, are covered by their CRC, and classes
+compiled by scalac by all of their contents. Jars with annotation processors
+run code at compile time, so their API digest is their content digest.
+
+API digests are persisted under BUILD_WORK_DIR by the content digest of the
+jar, so each version of a jar is parsed once.
+"""
+import hashlib
+import logging
+import marshal
+import os
+import struct
+import tempfile
+import threading
+import zipfile
+
+import mool.file_snapshot as fs
+import mool.shared_utils as su
+
+ABI_DIGEST_CACHE_FILE = os.path.join(su.BUILD_WORK_DIR, '.abi_digests')
+# Bump this whenever the contents of API digests change.
+ABI_FORMAT_VERSION = 2
+CLASS_MAGIC = 0xCAFEBABE
+CLASS_SUFFIX = '.class'
+MODULE_INFO_CLASS = 'module-info.class'
+PROCESSOR_SERVICE_FILE = (
+    'META-INF/services/javax.annotation.processing.Processor')
+ACC_PRIVATE = 0x0002
+ACC_SYNTHETIC = 0x1000
+CONSTANT_UTF8 = 1
+CONSTANT_CLASS = 7
+CONSTANT_STRING = 8
+# Constant pool entries taking two slots.
+WIDE_CONSTANTS = [5, 6]
+# Constant pool tag -> size of the entry following the tag, but for UTF8
+# entries which are sized by their first two bytes.
+CONSTANT_SIZES = {3: 4, 4: 4, 5: 8, 6: 8, 7: 2, 8: 2, 9: 4, 10: 4, 11: 4,
+                  12: 4, 15: 3, 16: 2, 17: 4, 18: 4, 19: 2, 20: 2}
+# Tags of annotation element values holding a constant pool index.
+CONSTANT_ELEMENT_TAGS = 'BCDFIJSZcs'
+# Type annotation target type -> size of its target info, but for local
+# variable targets which are sized by their first two bytes.
+TARGET_INFO_SIZES = {0x00: 1, 0x01: 1, 0x10: 2, 0x11: 2, 0x12: 2, 0x13: 0,
+                     0x14: 0, 0x15: 0, 0x16: 1, 0x17: 2, 0x42: 2, 0x43: 2,
+                     0x44: 2, 0x45: 2, 0x46: 2, 0x47: 3, 0x48: 3, 0x49: 3,
+                     0x4A: 3, 0x4B: 3}
+LOCAL_VARIABLE_TARGETS = [0x40, 0x41]
+INNER_CLASSES_ATTRIBUTE = 'InnerClasses'
+# Attributes of classes compiled by scalac, which reads the types of Scala
+# classes from pickled signatures and may inline their methods.
+SCALA_ATTRIBUTES = ['Scala', 'ScalaSig']
+
+
+class Error(su.Error):
+  """Error class for this module."""
+
+
+class _ClassReader(object):
+  """Sequential reader of class file data."""
+  def __init__(self, data):
+    """Initialize."""
+    self._data = data
+    self._position = 0
+
+  def read(self, fmt):
+    """Read big endian values of a struct format."""
+    fmt = '>' + fmt
+    values = struct.unpack_from(fmt, self._data, self._position)
+    self._position += struct.calcsize(fmt)
+    return values
+
+  def read_bytes(self, size):
+    """Read raw bytes."""
+    if self._position + size > len(self._data):
+      raise Error('Truncated class file')
+    data = self._data[self._position:self._position + size]
+    self._position += size
+    return data
+
+
+def _resolve(pool, index):
+  """Get the text of a UTF8, class or string constant, and the raw bytes of
+  any other constant."""
+  tag, value = pool[index]
+  if tag in [CONSTANT_CLASS, CONSTANT_STRING]:
+    return _resolve(pool, struct.unpack('>H', value)[0])
+  return value
+
+
+def _read_constant_pool(reader):
+  """Read the constant pool, as (tag, raw bytes) by index."""
+  count = reader.read('H')[0]
+  pool = [None] * count
+  index = 1
+  while index < count:
+    tag = reader.read('B')[0]
+    if tag == CONSTANT_UTF8:
+      pool[index] = (tag, reader.read_bytes(reader.read('H')[0]))
+    elif tag in CONSTANT_SIZES:
+      pool[index] = (tag, reader.read_bytes(CONSTANT_SIZES[tag]))
+    else:
+      raise Error('Unknown constant pool tag {}'.format(tag))
+    index += 2 if tag in WIDE_CONSTANTS else 1
+  return pool
+
+
+def _read_attributes(reader, pool):
+  """Read attributes, as name -> raw bytes."""
+  attributes = {}
+  for _ in xrange(reader.read('H')[0]):
+    name_index, size = reader.read('HI')
+    attributes[_resolve(pool, name_index)] = reader.read_bytes(size)
+  return attributes
+
+
+def _read_index(reader, pool):
+  """Read a constant pool index, as the tag and value of the constant."""
+  index = reader.read('H')[0]
+  return pool[index][0], _resolve(pool, index)
+
+
+def _read_index_list(reader, pool):
+  """Read a list of constant pool indexes, as the sorted constants."""
+  return sorted([_resolve(pool, i)
+                 for i in reader.read('H' * reader.read('H')[0])])
+
+
+def _read_element_value(reader, pool):
+  """Read the value of an annotation element."""
+  tag = chr(reader.read('B')[0])
+  if tag in CONSTANT_ELEMENT_TAGS:
+    return tag, _read_index(reader, pool)
+  if tag == 'e':
+    type_index, name_index = reader.read('HH')
+    return tag, _resolve(pool, type_index), _resolve(pool, name_index)
+  if tag == '@':
+    return tag, _read_annotation(reader, pool)
+  if tag == '[':
+    return tag, [_read_element_value(reader, pool)
+                 for _ in xrange(reader.read('H')[0])]
+  raise Error('Unknown annotation element tag {}'.format(tag))
+
+
+def _read_annotation(reader, pool):
+  """Read an annotation, as its type and its sorted elements."""
+  type_index, count = reader.read('HH')
+  elements = []
+  for _ in xrange(count):
+    name_index = reader.read('H')[0]
+    elements.append((_resolve(pool, name_index),
+                     _read_element_value(reader, pool)))
+  return _resolve(pool, type_index), sorted(elements)
+
+
+def _read_annotations(reader, pool):
+  """Read a list of annotations, sorted as their order does not matter."""
+  return sorted([_read_annotation(reader, pool)
+                 for _ in xrange(reader.read('H')[0])])
+
+
+def _read_parameter_annotations(reader, pool):
+  """Read the annotations of every parameter of a method."""
+  return [_read_annotations(reader, pool)
+          for _ in xrange(reader.read('B')[0])]
+
+
+def _read_type_annotations(reader, pool):
+  """Read type annotations, with their target and type path as raw bytes,
+  which hold no constant pool indexes."""
+  type_annotations = []
+  for _ in xrange(reader.read('H')[0]):
+    target_type = reader.read('B')[0]
+    if target_type in LOCAL_VARIABLE_TARGETS:
+      target_info = reader.read_bytes(6 * reader.read('H')[0])
+    elif target_type in TARGET_INFO_SIZES:
+      target_info = reader.read_bytes(TARGET_INFO_SIZES[target_type])
+    else:
+      raise Error('Unknown type annotation target {}'.format(target_type))
+    type_path = reader.read_bytes(2 * reader.read('B')[0])
+    type_annotations.append((target_type, target_info, type_path,
+                             _read_annotation(reader, pool)))
+  return sorted(type_annotations)
+
+
+def _read_method_parameters(reader, pool):
+  """Read the names and access flags of method parameters."""
+  parameters = []
+  for _ in xrange(reader.read('B')[0]):
+    name_index, access_flags = reader.read('HH')
+    parameters.append((_resolve(pool, name_index) if name_index else None,
+                       access_flags))
+  return parameters
+
+
+def _read_record(reader, pool):
+  """Read the components of a record class."""
+  components = []
+  for _ in xrange(reader.read('H')[0]):
+    name_index, descriptor_index = reader.read('HH')
+    attributes = _read_attributes(reader, pool)
+    components.append((_resolve(pool, name_index),
+                       _resolve(pool, descriptor_index),
+                       _get_api_attributes(pool, attributes)))
+  return components
+
+
+# Name -> reader of the resolved value of the attributes which are part of
+# the API.
+API_ATTRIBUTE_READERS = {
+    'AnnotationDefault': _read_element_value,
+    'ConstantValue': _read_index,
+    'Exceptions': _read_index_list,
+    'MethodParameters': _read_method_parameters,
+    'PermittedSubclasses': _read_index_list,
+    'Record': _read_record,
+    'RuntimeInvisibleAnnotations': _read_annotations,
+    'RuntimeInvisibleParameterAnnotations': _read_parameter_annotations,
+    'RuntimeInvisibleTypeAnnotations': _read_type_annotations,
+    'RuntimeVisibleAnnotations': _read_annotations,
+    'RuntimeVisibleParameterAnnotations': _read_parameter_annotations,
+    'RuntimeVisibleTypeAnnotations': _read_type_annotations,
+    'Signature': _read_index}
+
+
+def _get_api_attributes(pool, attributes):
+  """Get the resolved values of the attributes which are part of the API."""
+  api_attributes = []
+  for name, read_value in sorted(API_ATTRIBUTE_READERS.iteritems()):
+    if name in attributes:
+      api_attributes.append(
+          (name, read_value(_ClassReader(attributes[name]), pool)))
+  return api_attributes
+
+
+def _read_members(reader, pool):
+  """Read the fields or methods of a class, keeping those in its API. They
+  are sorted, as reordering members does not change the API."""
+  members = []
+  for _ in xrange(reader.read('H')[0]):
+    access_flags, name_index, descriptor_index = reader.read('HHH')
+    attributes = _read_attributes(reader, pool)
+    if access_flags & (ACC_PRIVATE | ACC_SYNTHETIC):
+      continue
+    members.append((access_flags, _resolve(pool, name_index),
+                    _resolve(pool, descriptor_index),
+                    _get_api_attributes(pool, attributes)))
+  return sorted(members)
+
+
+def _get_nested_access_flags(pool, class_name, attributes):
+  """Get the access flags a nested class is declared with, None if it is not
+  a nested class, and False if it is not part of the API."""
+  if INNER_CLASSES_ATTRIBUTE not in attributes:
+    return None
+  reader = _ClassReader(attributes[INNER_CLASSES_ATTRIBUTE])
+  for _ in xrange(reader.read('H')[0]):
+    inner_index, outer_index, name_index, access_flags = reader.read('HHHH')
+    if _resolve(pool, inner_index) != class_name:
+      continue
+    if ((not outer_index or not name_index or
+         access_flags & (ACC_PRIVATE | ACC_SYNTHETIC))):
+      # A local, anonymous or private class.
+      return False
+    return access_flags
+  return None
+
+
+def get_class_api(data):
+  """Get a representation of the API of a class file, None if the class is
+  not part of the API of its jar."""
+  reader = _ClassReader(data)
+  magic, _, major_version = reader.read('IHH')
+  if magic != CLASS_MAGIC:
+    raise Error('Not a class file')
+  pool = _read_constant_pool(reader)
+  access_flags, this_index, super_index = reader.read('HHH')
+  class_name = _resolve(pool, this_index)
+  super_name = _resolve(pool, super_index) if super_index else None
+  interfaces = [_resolve(pool, i)
+                for i in reader.read('H' * reader.read('H')[0])]
+  fields = _read_members(reader, pool)
+  methods = _read_members(reader, pool)
+  attributes = _read_attributes(reader, pool)
+  if access_flags & ACC_SYNTHETIC:
+    return None
+  if any([a in attributes for a in SCALA_ATTRIBUTES]):
+    return repr((class_name, hashlib.sha1(data).hexdigest()))
+  nested_access_flags = _get_nested_access_flags(pool, class_name,
+                                                 attributes)
+  if nested_access_flags is False:
+    return None
+  return repr((major_version, access_flags, nested_access_flags, class_name,
+               super_name, sorted(interfaces), fields, methods,
+               _get_api_attributes(pool, attributes)))
+
+
+class AbiDigestCache(object):
+  """API digests of jars, by the content digest of the jars."""
+  def __init__(self, cache_file=ABI_DIGEST_CACHE_FILE):
+    """Initialize."""
+    self._cache_file = cache_file
+    # Jar content digest -> API digest, loaded lazily.
+    self._entries = None
+    # (entry name, CRC, size) -> API digest of class files seen by this
+    # process, as jars bundling their dependencies share most classes.
+    self._class_digests = {}
+    self._dirty = False
+    self._lock = threading.Lock()
+
+  def _load(self):
+    """Load persisted digests, if any."""
+    self._entries = {}
+    if not os.path.exists(self._cache_file):
+      return
+    try:
+      with open(self._cache_file, 'rb') as file_object:
+        version, entries = marshal.load(file_object)
+    except (EOFError, ValueError, TypeError) as exc:
+      logging.debug('Ignoring corrupt API digest cache %s: %s',
+                    self._cache_file, exc)
+      return
+    if version == ABI_FORMAT_VERSION:
+      self._entries = entries
+
+  def _get_class_digest(self, jar_obj, info):
+    """Get the API digest of a class file, None if it is not in the API.
+    Classes which can not be parsed are taken as a whole."""
+    key = (info.filename, info.CRC, info.file_size)
+    with self._lock:
+      if key in self._class_digests:
+        return self._class_digests[key]
+    try:
+      class_api = get_class_api(jar_obj.read(info))
+    except (Error, struct.error, IndexError, TypeError) as exc:
+      logging.debug('Could not parse %s: %s', info.filename, exc)
+      class_api = repr(key)
+    digest = None
+    if class_api is not None:
+      digest = hashlib.sha1(class_api).hexdigest()
+    with self._lock:
+      self._class_digests[key] = digest
+    return digest
+
+  def _compute(self, jar_file, digest):
+    """Compute the API digest of a jar."""
+    api_hash = hashlib.sha1()
+    with zipfile.ZipFile(jar_file, 'r') as jar_obj:
+      infos = sorted(jar_obj.infolist(), key=lambda i: i.filename)
+      if PROCESSOR_SERVICE_FILE in [i.filename for i in infos]:
+        return digest
+      for info in infos:
+        if info.filename.endswith('/'):
+          continue
+        if ((info.filename.endswith(CLASS_SUFFIX) and
+             os.path.basename(info.filename) != MODULE_INFO_CLASS)):
+          class_digest = self._get_class_digest(jar_obj, info)
+          if class_digest is not None:
+            api_hash.update('{} {}\n'.format(class_digest, info.filename))
+          continue
+        api_hash.update('{:08x} {} {}\n'.format(info.CRC, info.file_size,
+                                                info.filename))
+    return api_hash.hexdigest()
+
+  def get_digest(self, jar_file, digest=None):
+    """Get the API digest of a jar. The content digest of the jar is looked
+    up unless given, and is returned for files which are not jars."""
+    if digest is None:
+      digest = fs.DIGEST_CACHE.get_digest(jar_file)
+    with self._lock:
+      if self._entries is None:
+        self._load()
+      api_digest = self._entries.get(digest, None)
+    if api_digest:
+      return api_digest
+    try:
+      api_digest = self._compute(jar_file, digest)
+    except (zipfile.BadZipfile, zipfile.LargeZipFile, IOError) as exc:
+      logging.debug('Using content digest of %s: %s', jar_file, exc)
+      return digest
+    with self._lock:
+      self._entries[digest] = api_digest
+      self._dirty = True
+    return api_digest
+
+  def remove_unused(self, digests):
+    """Forget the API digests of jars with none of the given content digests.
+    Returns the number of jars forgotten."""
+    digests = set(digests)
+    with self._lock:
+      if self._entries is None:
+        self._load()
+      unused = [d for d in self._entries if d not in digests]
+      for digest in unused:
+        del self._entries[digest]
+      if unused:
+        self._dirty = True
+    return len(unused)
+
+  def save(self):
+    """Persist API digests computed since the cache was loaded."""
+    with self._lock:
+      if su.TEST_MODE_EXECUTION or not self._dirty:
+        return
+      entries = dict(self._entries)
+      self._dirty = False
+    if not os.path.isdir(os.path.dirname(self._cache_file)):
+      os.makedirs(os.path.dirname(self._cache_file))
+    file_handle, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(self._cache_file), prefix='.tmp.')
+    try:
+      with os.fdopen(file_handle, 'wb') as file_object:
+        marshal.dump((ABI_FORMAT_VERSION, entries), file_object)
+      os.rename(temp_path, self._cache_file)
+    except (IOError, OSError) as exc:
+      logging.debug('Could not save API digest cache: %s', exc)
+      if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+
+ABI_DIGEST_CACHE = AbiDigestCache()
@@ -4,6 +4,7 @@ import logging
 import os
 import subprocess
 
+import mool.file_commands as fcmd
 import mool.jar_merger as jm
 import mool.shared_utils as su
 import mool.jar_testng_runner as testng_runner
@@ -11,7 +12,6 @@ import mool.jar_testng_runner as testng_runner
 
 JAVA_VERSION_DEP_RULE_TYPES = [su.JAVA_BIN_TYPE, su.JAVA_LIB_TYPE,
                                su.JAVA_TEST_TYPE]
-MAX_LOOP_COUNT = 5000
 
 
 class Error(su.Error):
@@ -28,11 +28,12 @@ def perform_java_linkall_currdir(params):
   """Perform Java linking of current directory to single jar."""
   assert 1 == len(params)
   target_file = params[0]
+  curr_dir = su.get_curr_dir()
   # Ensure current directory is not empty.
-  subprocess.check_call(su.get_mkdir_command(su.JAR_MANIFEST_PATH))
+  fcmd.run_file_commands([su.get_mkdir_command(su.JAR_MANIFEST_PATH)], curr_dir)
   jar_create_command = [su.JAR_BIN, 'cf', target_file]
-  jar_create_command.extend(os.listdir('.'))
-  subprocess.check_call(jar_create_command)
+  jar_create_command.extend(os.listdir(curr_dir))
+  subprocess.check_call(jar_create_command, cwd=curr_dir)
 
 
 def get_maven_download_paths(maven_identifiers):
@@ -148,23 +149,6 @@ def _get_maven_identifiers(maven_details):
   return artifact_id, classifier, group_id, repo_url, version
 
 
-def _get_recursive_compile_deps(rule_details, details_map):
-  """Get all compile time deps dependencies for a rule."""
-  final_deps = set()
-  active_set = set(rule_details.get(su.DEPS_KEY))
-  iters = 0
-  while active_set:
-    iters += 1
-    assert iters <= MAX_LOOP_COUNT, "Too many recursive iterations."
-    temp_set = set()
-    for dep in active_set:
-      final_deps = final_deps.union(
-          set(details_map[dep].get(su.COMPILE_DEPS_KEY, [])))
-      temp_set = temp_set.union(details_map[dep][su.DEPS_KEY])
-    active_set = temp_set
-  return final_deps
-
-
 class JavaCommon(object):
   """Common Java handler functions."""
   @classmethod
@@ -235,7 +219,7 @@ class JavaCommon(object):
       dep_sources.extend(dep_rule_details[su.SRCS_KEY])
 
     link_libs.extend(cls._get_all_pc_deps(rule_details))
-    link_libs.extend(cls._get_maven_dep(rule_details))
+    link_libs.extend(rule_details[su.SETUP_FILES_KEY])
     assert all([l.endswith('.jar') for l in link_libs])
     link_libs = sorted(list(set(link_libs)))
     compile_libs = [details_map[r][su.OUT_KEY]
@@ -243,14 +227,16 @@ class JavaCommon(object):
     # For java test rule, recursively add all the compile time dependencies
     # as run time dependencies of rule.
     if cls._is_test_rule(rule_details):
-      all_compile_deps = _get_recursive_compile_deps(rule_details, details_map)
-      compile_libs.extend(
-          [details_map[dep][su.OUT_KEY] for dep in all_compile_deps])
+      compile_libs.extend([details_map[dep][su.OUT_KEY]
+                           for dep in rule_details[su.ALL_COMPILE_DEPS_KEY]])
     return link_libs, compile_libs, dep_sources
 
   @classmethod
   def _get_recursive_maven_deps(cls, rule_details, details_map):
-    """Get all maven dependencies for a rule."""
+    """Get all maven dependencies for a rule from the rules in its shared
+    dependency closure. The maven dependencies of every dependency are already
+    recursive, which carries those of the rules a closure leaves out, like the
+    dependencies bundled in a jar."""
 
     def _accumulate(deps_key, included_deps, compile_deps):
       """Accumulate maven dependencies from a dependency key."""
@@ -260,22 +246,19 @@ class JavaCommon(object):
         dep_rule_details = details_map[rule_symbol]
         dep_maven_id = dep_rule_details.get(su.MAVEN_IDENTIFIERS_KEY, [])
         if dep_maven_id:
-          included_deps.append(dep_maven_id + tuple([
+          included_deps.add(dep_maven_id + tuple([
               dep_rule_details[su.OUT_KEY]]))
         maven_deps_pair = dep_rule_details.get(su.MAVEN_DEPS_KEY, ([], []))
-        included_deps.extend(maven_deps_pair[0])
-        compile_deps.extend(maven_deps_pair[1])
+        included_deps.update(maven_deps_pair[0])
+        compile_deps.update(maven_deps_pair[1])
 
-    maven_included_deps = []
-    maven_compile_deps = []
-    _accumulate(su.DEPS_KEY, maven_included_deps, maven_compile_deps)
-    _accumulate(su.COMPILE_DEPS_KEY, maven_compile_deps, maven_compile_deps)
+    maven_included_deps = set()
+    maven_compile_deps = set()
+    # Direct deps are part of the dependency closure.
     _accumulate(su.ALL_DEPS_KEY, maven_included_deps, maven_compile_deps)
-    maven_included_deps = sorted(list(set(maven_included_deps)))
-    maven_compile_deps = sorted(list(set(maven_compile_deps)))
-    maven_compile_deps = [d for d in maven_compile_deps
-                          if d not in maven_included_deps]
-    return (maven_included_deps, maven_compile_deps)
+    _accumulate(su.COMPILE_DEPS_KEY, maven_compile_deps, maven_compile_deps)
+    return (sorted(maven_included_deps),
+            sorted(maven_compile_deps.difference(maven_included_deps)))
 
   @classmethod
   def _set_compile_command(cls, rule_details):
@@ -372,6 +355,13 @@ class JavaCommon(object):
     all_dep_paths.extend(dep_sources)
     all_dep_paths.append(rule_details[su.OUT_KEY])
     rule_details[su.ALL_DEP_PATHS_KEY].extend(sorted(list(set(all_dep_paths))))
+    # Dependencies are built before the rule, so changes to their sources
+    # show in their jars, of which only the public API matters to javac.
+    rule_details[su.INDIRECT_DEP_PATHS_KEY] = sorted(list(
+        set(dep_sources).difference(rule_details[su.SRCS_KEY])))
+    rule_details[su.ABI_DEP_PATHS_KEY] = []
+    if rule_details[su.SRCS_KEY]:
+      rule_details[su.ABI_DEP_PATHS_KEY] = link_libs[:]
 
   @classmethod
   def _normalize_fields(cls, rule_details):
@@ -426,6 +416,9 @@ class JavaCommon(object):
         rule_details, details_map)
     rule_details[su.EXPORTED_MVN_DEPS_FILE_KEY] = os.path.join(
         rule_details[su.OUTDIR_KEY], out_file + '.mvn_deps.json')
+    # Downloaded maven jars are files a build server checks for before
+    # reusing the rule.
+    rule_details[su.SETUP_FILES_KEY] = cls._get_maven_dep(rule_details)
     link_libs, compile_libs, dep_sources = cls._get_all_deps(
         rule_details, details_map)
     rule_details[su.LINK_LIBS_KEY] = link_libs
@@ -449,6 +442,37 @@ class JavaCommon(object):
       return False
     return True
 
+  @classmethod
+  def restore_commands(cls, rule_details):
+    """Tests run with the class path linked in clsdeps directory."""
+    if not cls._is_test_rule(rule_details):
+      return []
+    command_list = [su.get_mkdir_command(rule_details[su.WDIR_CLSDEPS_KEY])]
+    command_list.extend(rule_details[su.PRECOMPILE_COMMANDS_KEY])
+    return command_list
+
+  @classmethod
+  def relink_commands(cls, rule_details):
+    """The jar of a rule bundling its dependencies is linked again from the
+    classes compiled by its last build, when the dependencies only changed
+    their implementation."""
+    if ((not rule_details[su.COMPILE_COMMAND_KEY] or
+         not rule_details[su.LINK_INCLUDE_DEPS_KEY])):
+      return []
+    command_list = [su.get_mkdir_command(rule_details[su.OUTDIR_KEY])]
+    # The last link command merges the jar of compiled classes left in the
+    # working directory with the dependencies.
+    command_list.append(rule_details[su.LINK_COMMANDS_KEY][-1])
+    command_list.append(cls._get_export_mvn_deps_command(rule_details))
+    return command_list
+
+  @classmethod
+  def _get_export_mvn_deps_command(cls, rule_details):
+    """Get command exporting the maven dependencies of the rule."""
+    return [su.EXPORT_MVN_DEPS, rule_details[su.EXPORTED_MVN_DEPS_FILE_KEY],
+            rule_details[su.MAVEN_DEPS_KEY][0],
+            rule_details[su.MAVEN_DEPS_KEY][1]]
+
   @classmethod
   def build_commands(cls, rule_details):
     """Generate build command line."""
@@ -464,10 +488,7 @@ class JavaCommon(object):
     command_list.extend(rule_details[su.PRECOMPILE_COMMANDS_KEY])
     command_list.extend(rule_details[su.COMPILE_COMMAND_KEY])
     command_list.extend(rule_details[su.LINK_COMMANDS_KEY])
-    command_list.append([su.EXPORT_MVN_DEPS,
-                         rule_details[su.EXPORTED_MVN_DEPS_FILE_KEY],
-                         rule_details[su.MAVEN_DEPS_KEY][0],
-                         rule_details[su.MAVEN_DEPS_KEY][1]])
+    command_list.append(cls._get_export_mvn_deps_command(rule_details))
     return command_list
 
 
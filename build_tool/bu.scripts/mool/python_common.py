@@ -5,6 +5,7 @@ import os
 import subprocess
 import zipfile
 
+import mool.file_commands as fcmd
 import mool.shared_utils as su
 
 MAIN_FILE_NAME = '__main__.py'
@@ -60,33 +61,39 @@ class Error(su.Error):
 def compile_all(params):
   """Compile python code recursively under current directory."""
   assert not params
-  compileall.compile_dir('./', quiet=True)
+  compileall.compile_dir(su.get_curr_dir(), quiet=True)
 
 
 def expand_lib(params):
   """Expand a link library in place."""
   link_lib, is_zipped = params
   tracer = logging.debug
+  curr_dir = su.get_curr_dir()
   if is_zipped:
     tracer('Expanding zipped lib at %s', link_lib)
     with zipfile.ZipFile(link_lib, 'r') as zip_obj:
-      zip_obj.extractall()
+      zip_obj.extractall(curr_dir)
   else:
     tracer('Expanding directory lib at %s', link_lib)
     # Recursively copying a directory to another. We cannot use shutil.copytree
     # as we cannot assume the directory to be new.
     link_lib = link_lib if link_lib.endswith(os.sep) else link_lib + os.sep
+    copy_commands = []
     for root, _, files in os.walk(link_lib):
+      if files:
+        copy_commands.append(su.get_mkdir_command(
+            root.replace(link_lib, '.' + os.sep)))
       for file_path in files:
         src_file = os.path.join(root, file_path)
         dst_file = src_file.replace(link_lib, '.' + os.sep)
         tracer('Copying %s to %s', src_file, dst_file)
-        subprocess.check_call(su.get_mkdir_command(os.path.dirname(dst_file)))
-        subprocess.check_call(['cp', src_file, dst_file])
+        copy_commands.append(['cp', src_file, dst_file])
+    fcmd.run_file_commands(copy_commands, curr_dir)
 
   # Remove any main file in zip root coming from python executable binary.
-  if os.path.exists(MAIN_FILE_NAME):
-    os.remove(MAIN_FILE_NAME)
+  main_file_path = os.path.join(curr_dir, MAIN_FILE_NAME)
+  if os.path.exists(main_file_path):
+    os.remove(main_file_path)
 
 
 def run_pylint_checks(params):
@@ -102,7 +109,7 @@ def run_pylint_checks(params):
   if 'PYTHONPATH' in os.environ:
     new_path = '{}:{}'.format(new_path, os.environ['PYTHONPATH'])
   environment = {'PATH': os.environ.get('PATH', ''), 'PYTHONPATH': new_path}
-  subprocess.check_call(command, env=environment)
+  subprocess.check_call(command, env=environment, cwd=su.get_curr_dir())
 
 
 def _main_file_contents_for_bin(main_class):
@@ -116,14 +123,15 @@ def _main_file_contents_for_bin(main_class):
 def perform_linking(command_parts):
   """Steps to perform actual python linking."""
   rule_type, main_class, tmp_out_file, out_file = command_parts
-  main_file_path = os.path.join('.', MAIN_FILE_NAME)
+  curr_dir = su.get_curr_dir()
+  main_file_path = os.path.join(curr_dir, MAIN_FILE_NAME)
   if su.PYTHON_BIN_TYPE == rule_type:
     su.write_file(main_file_path, _main_file_contents_for_bin(main_class))
   elif su.PYTHON_TEST_TYPE == rule_type:
     su.write_file(main_file_path, MAIN_FILE_CONTENTS_FOR_TEST)
 
   with zipfile.ZipFile(tmp_out_file, 'w') as zip_obj:
-    for root, _, files in os.walk('.'):
+    for root, _, files in os.walk(curr_dir):
       for file_path in files:
         full_file_path = os.path.join(root, file_path)
         # It is ok to skip raw .py files for py binaries. The directory has
@@ -134,24 +142,26 @@ def perform_linking(command_parts):
                      file_path.endswith('.py'))
         if skip_file:
           continue
-        zip_obj.write(full_file_path)
+        zip_obj.write(full_file_path,
+                      os.path.relpath(full_file_path, curr_dir))
 
   if su.PYTHON_LIB_TYPE == rule_type:
-    subprocess.check_call(['mv', tmp_out_file, out_file])
+    fcmd.run_file_commands([['mv', tmp_out_file, out_file]])
   elif su.PYTHON_BIN_TYPE == rule_type:
     su.write_file(out_file, PY_SHEBANG_HEADER + su.read_file(tmp_out_file))
-    subprocess.check_call(['chmod', '+x', out_file])
+    fcmd.run_file_commands([['chmod', '+x', out_file]])
   else:
     assert su.PYTHON_TEST_TYPE == rule_type
     su.write_file(out_file, PY_SHEBANG_HEADER + su.read_file(tmp_out_file))
-    subprocess.check_call(['chmod', '+x', out_file])
+    fcmd.run_file_commands([['chmod', '+x', out_file]])
 
 
 def create_initializers(params):
   """Create initializers recursively under current subdirectory."""
   assert not params
-  for root, _unused_dirs, _unused_files in os.walk('.'):
-    if root == '.':
+  curr_dir = su.get_curr_dir()
+  for root, _unused_dirs, _unused_files in os.walk(curr_dir):
+    if root == curr_dir:
       continue
     init_file = os.path.join(root, INIT_FILE_NAME)
     if su.path_exists(init_file):
@@ -1,9 +1,9 @@
 """Implement the rules of release package build rule."""
 import logging
 import os
-import subprocess
 import zipfile
 
+import mool.file_commands as fcmd
 import mool.shared_utils as su
 
 
@@ -12,17 +12,20 @@ def zip_all_currdir(params):
   assert 1 == len(params)
   target_file = params[0]
   tmp_file = target_file + '.tmp'
+  curr_dir = su.get_curr_dir()
   with zipfile.ZipFile(tmp_file, 'w') as zip_obj:
-    for root, _, files in os.walk('.'):
+    for root, _, files in os.walk(curr_dir):
       for file_path in files:
-        zip_obj.write(os.path.join(root, file_path))
-  subprocess.check_call(['mv', tmp_file, target_file])
+        full_file_path = os.path.join(root, file_path)
+        zip_obj.write(full_file_path,
+                      os.path.relpath(full_file_path, curr_dir))
+  fcmd.run_file_commands([['mv', tmp_file, target_file]])
 
 
 def unzip_all_currdir(file_path):
   """Unzip the given file in current directory."""
   with zipfile.ZipFile(file_path) as zip_obj:
-    zip_obj.extractall()
+    zip_obj.extractall(su.get_curr_dir())
 
 
 def _check_and_get_outfile(rule_details):
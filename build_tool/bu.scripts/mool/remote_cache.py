@@ -0,0 +1,287 @@
+"""Shared remote cache of rule outputs.
+
+The remote cache mirrors entries of the local action cache. An entry is a
+manifest stored under 'ac/<action key>' that maps every output of a rule to
+the digest of its contents, plus one blob per distinct output stored under
+'cas/<digest>'. Blobs are transferred concurrently and streamed between files
+and the backend, so their size does not affect memory usage. Entries are pushed
+in the background while the build goes on.
+
+Backends are picked from the REMOTE_CACHE_URL environment variable:
+    /path/to/dir or file:///path/to/dir : a shared (e.g. NFS) directory.
+    http://host:port/prefix : a key/value server supporting GET, HEAD and PUT.
+"""
+import httplib
+import json
+import logging
+import os
+import tempfile
+import threading
+import urllib2
+import urlparse
+
+from multiprocessing.pool import ThreadPool
+
+import mool.file_snapshot as fs
+import mool.shared_utils as su
+
+MANIFEST_PREFIX = 'ac'
+BLOB_PREFIX = 'cas'
+COPY_BUFFER_SIZE = 1024 * 1024
+HTTP_TIMEOUT_SECONDS = 60
+
+
+class Error(su.Error):
+  """Error class for this module."""
+
+
+def _copy_stream(src_obj, dst_obj):
+  """Stream data from one file object to another, returns bytes copied."""
+  num_bytes = 0
+  while True:
+    chunk = src_obj.read(COPY_BUFFER_SIZE)
+    if not chunk:
+      return num_bytes
+    dst_obj.write(chunk)
+    num_bytes += len(chunk)
+
+
+class FileSystemBackend(object):
+  """Remote cache backend on a shared directory."""
+  def __init__(self, root_dir):
+    """Initialize."""
+    self._root_dir = root_dir
+
+  def _get_path(self, name):
+    """Get file path of a cache object."""
+    return os.path.join(self._root_dir, name)
+
+  def contains(self, name):
+    """Checks if an object exists in cache."""
+    return os.path.exists(self._get_path(name))
+
+  def fetch(self, name, dst_path):
+    """Fetch an object to a file. Returns number of bytes or None on miss."""
+    try:
+      with open(self._get_path(name), 'rb') as src_obj:
+        with open(dst_path, 'wb') as dst_obj:
+          return _copy_stream(src_obj, dst_obj)
+    except IOError:
+      return None
+
+  def store(self, name, src_path):
+    """Store a file as an object. Returns number of bytes."""
+    obj_path = self._get_path(name)
+    obj_dir = os.path.dirname(obj_path)
+    if not os.path.isdir(obj_dir):
+      try:
+        os.makedirs(obj_dir)
+      except OSError:
+        # Another builder might have created it in the meantime.
+        if not os.path.isdir(obj_dir):
+          raise
+    # Write to a temporary file first so that readers never see partial data.
+    file_handle, temp_path = tempfile.mkstemp(dir=obj_dir, prefix='.tmp.')
+    try:
+      with os.fdopen(file_handle, 'wb') as dst_obj:
+        with open(src_path, 'rb') as src_obj:
+          num_bytes = _copy_stream(src_obj, dst_obj)
+      os.rename(temp_path, obj_path)
+    except:
+      os.remove(temp_path)
+      raise
+    return num_bytes
+
+
+class HttpBackend(object):
+  """Remote cache backend on an HTTP key/value server."""
+  def __init__(self, base_url):
+    """Initialize."""
+    self._base_url = base_url.rstrip('/')
+    parts = urlparse.urlparse(self._base_url)
+    self._netloc = parts.netloc
+    self._base_path = parts.path
+
+  def _request(self, method, name, body=None, headers=None):
+    """Send a request on a new connection, which keeps it thread safe."""
+    connection = httplib.HTTPConnection(self._netloc,
+                                        timeout=HTTP_TIMEOUT_SECONDS)
+    connection.request(method, '{}/{}'.format(self._base_path, name),
+                       body, headers or {})
+    return connection, connection.getresponse()
+
+  def contains(self, name):
+    """Checks if an object exists in cache."""
+    connection, response = self._request('HEAD', name)
+    connection.close()
+    return response.status == httplib.OK
+
+  def fetch(self, name, dst_path):
+    """Fetch an object to a file. Returns number of bytes or None on miss."""
+    try:
+      response = urllib2.urlopen('{}/{}'.format(self._base_url, name),
+                                 timeout=HTTP_TIMEOUT_SECONDS)
+    except urllib2.HTTPError as exc:
+      if exc.code == httplib.NOT_FOUND:
+        return None
+      raise
+    try:
+      with open(dst_path, 'wb') as dst_obj:
+        return _copy_stream(response, dst_obj)
+    finally:
+      response.close()
+
+  def store(self, name, src_path):
+    """Store a file as an object. Returns number of bytes."""
+    num_bytes = os.path.getsize(src_path)
+    with open(src_path, 'rb') as src_obj:
+      # httplib streams file objects in blocks.
+      connection, response = self._request(
+          'PUT', name, src_obj, {'Content-Length': str(num_bytes)})
+      connection.close()
+    if response.status not in (httplib.OK, httplib.CREATED,
+                               httplib.NO_CONTENT):
+      raise Error('Remote cache store of {} failed with HTTP {}'.format(
+          name, response.status))
+    return num_bytes
+
+
+def get_backend(url):
+  """Get remote cache backend from its url."""
+  parts = urlparse.urlparse(url)
+  if parts.scheme in ('http', 'https'):
+    if parts.scheme == 'https':
+      raise Error('Remote cache over https is not supported: {}'.format(url))
+    return HttpBackend(url)
+  if parts.scheme == 'file':
+    return FileSystemBackend(parts.path)
+  if not parts.scheme:
+    return FileSystemBackend(url)
+  raise Error('Unknown remote cache url: {}'.format(url))
+
+
+class RemoteCache(object):
+  """Pulls and pushes action cache entries from and to a backend."""
+  def __init__(self, backend, push, num_threads):
+    """Initialize."""
+    self._backend = backend
+    self._push = push
+    self._num_threads = num_threads
+    # Transfer threads, started on first use and stopped by close.
+    self._pool = None
+    self._lock = threading.Lock()
+    self._stats = self._new_stats()
+
+  @classmethod
+  def _new_stats(cls):
+    """Get zeroed transfer statistics."""
+    return {'hits': 0, 'misses': 0, 'pushes': 0, 'errors': 0,
+            'bytes_down': 0, 'bytes_up': 0}
+
+  def _count(self, stat_name, value=1):
+    """Update a statistic."""
+    with self._lock:
+      self._stats[stat_name] += value
+
+  def _get_pool(self):
+    """Get the transfer threads, starting them if needed."""
+    with self._lock:
+      if not self._pool:
+        self._pool = ThreadPool(self._num_threads)
+      return self._pool
+
+  def _fetch_blob(self, blob):
+    """Fetch a blob given as digest and file path and verify its
+    contents."""
+    digest, dst_path = blob
+    num_bytes = self._backend.fetch('{}/{}'.format(BLOB_PREFIX, digest),
+                                    dst_path)
+    if num_bytes is None:
+      return False
+    self._count('bytes_down', num_bytes)
+    return fs.get_file_digest(dst_path) == digest
+
+  def _push_blob(self, digest, src_path):
+    """Push a blob unless backend already has it."""
+    name = '{}/{}'.format(BLOB_PREFIX, digest)
+    if not self._backend.contains(name):
+      self._count('bytes_up', self._backend.store(name, src_path))
+
+  def fetch_entry(self, cache_key, entry_dir, manifest_file_name):
+    """Fetch an entry into a local directory. Returns True on hit."""
+    manifest_path = os.path.join(entry_dir, manifest_file_name)
+    try:
+      num_bytes = self._backend.fetch(
+          '{}/{}'.format(MANIFEST_PREFIX, cache_key), manifest_path)
+      if num_bytes is None:
+        self._count('misses')
+        return False
+      self._count('bytes_down', num_bytes)
+      manifest = json.loads(su.read_file(manifest_path))
+      digests = sorted(set([v['digest'] for v in manifest.itervalues()]))
+      results = self._get_pool().map(
+          self._fetch_blob, [(d, os.path.join(entry_dir, d)) for d in digests])
+    except (IOError, OSError, ValueError, KeyError, httplib.HTTPException,
+            urllib2.URLError, Error) as exc:
+      logging.warn('Remote cache fetch of %s failed: %s', cache_key, exc)
+      self._count('errors')
+      return False
+    if not all(results):
+      logging.warn('Remote cache entry %s is incomplete.', cache_key)
+      self._count('misses')
+      return False
+    self._count('hits')
+    return True
+
+  def push_entry(self, cache_key, entry_dir, manifest_file_name):
+    """Queue pushing an entry from a local directory on the transfer threads.
+    Queued pushes are done by close."""
+    if not self._push:
+      return
+    self._get_pool().apply_async(
+        self._push_entry, (cache_key, entry_dir, manifest_file_name))
+
+  def _push_entry(self, cache_key, entry_dir, manifest_file_name):
+    """Push an entry from a local directory, blobs before the manifest.
+    Entries are pushed concurrently and their blobs one by one, as waiting
+    for other transfer threads here could use them all up."""
+    manifest_path = os.path.join(entry_dir, manifest_file_name)
+    try:
+      manifest = json.loads(su.read_file(manifest_path))
+      for digest in sorted(set([v['digest'] for v in manifest.itervalues()])):
+        self._push_blob(digest, os.path.join(entry_dir, digest))
+      self._count('bytes_up', self._backend.store(
+          '{}/{}'.format(MANIFEST_PREFIX, cache_key), manifest_path))
+    except (IOError, OSError, ValueError, httplib.HTTPException,
+            urllib2.URLError, Error) as exc:
+      logging.warn('Remote cache push of %s failed: %s', cache_key, exc)
+      self._count('errors')
+      return
+    self._count('pushes')
+
+  def pop_stats(self):
+    """Get and reset transfer statistics."""
+    with self._lock:
+      stats = self._stats
+      self._stats = self._new_stats()
+    return stats
+
+  def close(self):
+    """Wait for queued pushes and stop transfer threads. They are started
+    again if the cache is used later on, like by the next build of a build
+    daemon."""
+    with self._lock:
+      pool = self._pool
+      self._pool = None
+    if pool:
+      pool.close()
+      pool.join()
+
+
+def get_remote_cache():
+  """Get remote cache configured from environment, None if not configured."""
+  if not su.REMOTE_CACHE_URL:
+    return None
+  return RemoteCache(get_backend(su.REMOTE_CACHE_URL),
+                     su.string_to_bool(su.REMOTE_CACHE_PUSH),
+                     int(su.REMOTE_CACHE_THREADS))
@@ -1,36 +1,86 @@
 """Rule builder module."""
 
+import collections
 import logging
 import os
 import subprocess
-
+import time
+
+import mool.action_cache as ac
+import mool.build_file_cache as bfc
+import mool.build_gc as bg
+import mool.build_metrics as bm
+import mool.build_profiler as bp
+import mool.build_scheduler as bs
+import mool.compile_server as cs
+import mool.file_commands as fcmd
+import mool.file_locks as fl
+import mool.file_snapshot as fs
 import mool.shared_utils as su
 import mool.file_collection as fc
+import mool.java_abi as ja
 import mool.java_common as jc
 import mool.python_common as pc
+import mool.rule_graph as rg
 import mool.rule_handler as rh
+import mool.test_cache as tc
+import mool.test_process as tp
+import mool.test_runner as tr
 import mool.thrift.cc_thrift as cc_thrift
 import mool.thrift.java_thrift as java_thrift
+import mool.worker_pool as wp
 
 
 FILE_DEP_PREFIX = 'FILE: '
 MVN_INCL_DEP_PREFIX = 'MVNI: '
 MVN_COMPL_DEP_PREFIX = 'MVNC: '
 
-MAX_LOOP_COUNT = 5000
 TRACE_COMMANDS = (os.environ.get('DEBUG_MODE', '') != '')
 
 EXPANDABLE_KEYS = [su.COMPILE_DEPS_KEY, su.DEPS_KEY, su.EXTRACT_IN_ZIP,
                    su.EXTRACT_RESOURCES_DEP_KEY, su.PACKAGE_MODULES_KEY,
                    su.PACKAGE_TESTS_KEY]
+# Rule details keys of dependency closures. Node numbers of their bitsets
+# depend on all the rules loaded, so closures are left out of rule hashes. The
+# details handlers derive from them are hashed instead.
+CLOSURE_KEYS = [su.ALL_COMPILE_DEPS_KEY, su.ALL_DEPS_KEY]
 
 
 class Error(su.Error):
   """Generic error class."""
 
 
-def _run_commands(command_list):
-  """Run the commands generated by the steps."""
+def _get_rule_hash(rule_details):
+  """Get hash of rule details which is stable across builds."""
+  return su.get_dictionary_hash(dict(
+      [(k, v) for (k, v) in rule_details.iteritems()
+       if k not in CLOSURE_KEYS]))
+
+
+def _get_file_stamp(file_path):
+  """Get modification time and size of a file, None if it does not exist."""
+  try:
+    stat_result = os.stat(file_path)
+  except OSError:
+    return None
+  return (stat_result.st_mtime, stat_result.st_size)
+
+
+def _get_handler_name(handler):
+  """Get name of an in-process command handler for profiles."""
+  # Handlers may be partially applied functions.
+  func = getattr(handler, 'func', handler)
+  return '{}.{}'.format(func.__module__.split('.')[-1], func.__name__)
+
+
+def _run_commands(command_list, run_process=None):
+  """Run the commands generated by the steps. Commands other than in-process
+  steps are run by run_process, subprocess.check_call by default.
+
+  A command list starts from the process working directory. The directory
+  changes made by CHANGE_CURR_DIR commands are local to the calling thread, so
+  command lists of different rules can run concurrently.
+  """
   tracer = logging.info if TRACE_COMMANDS else logging.debug
   # This dictionary should be kept inside as global dictionaries are
   # initialized before monkey patching and eventually results in failures.
@@ -52,14 +102,49 @@ def _run_commands(command_list):
       su.THRIFT_COMPILE_GENERATED_JAVA: java_thrift.compile_thrift_generated
   }
 
-  for command in command_list:
-    assert command
-    tracer('Command: %s', str(command))
-    handler = cmd_handler_map.get(command[0], None)
-    if handler:
-      handler(command[1:])
-    else:
-      subprocess.check_call(command)
+  def _flush_file_commands():
+    """Execute the pending batch of simple file commands."""
+    if file_commands:
+      with bp.PROFILER.span('file_commands', 'command',
+                            count=len(file_commands)):
+        fcmd.run_file_commands(
+            file_commands, su.get_curr_dir() if su.is_curr_dir_set() else None)
+      del file_commands[:]
+
+  run_process = run_process or subprocess.check_call
+  file_commands = []
+  su.reset_curr_dir()
+  try:
+    for command in command_list:
+      assert command
+      tracer('Command: %s', str(command))
+      if fcmd.is_file_command(command):
+        file_commands.append(command)
+        continue
+      # Any other command, directory changes included, ends the batch so that
+      # it runs in order and where it was meant to.
+      _flush_file_commands()
+      handler = cmd_handler_map.get(command[0], None)
+      if handler:
+        with bp.PROFILER.span(_get_handler_name(handler), 'command'):
+          handler(command[1:])
+      else:
+        with bp.PROFILER.span(os.path.basename(command[0]), 'command',
+                              command=' '.join(command)):
+          curr_dir = su.get_curr_dir() if su.is_curr_dir_set() else None
+          if cs.COMPILE_SERVER.run(command, curr_dir):
+            continue
+          if curr_dir:
+            run_process(command, cwd=curr_dir)
+          else:
+            run_process(command)
+    _flush_file_commands()
+  except subprocess.CalledProcessError as error_obj:
+    # Remember where the command ran for error reporting in the main thread.
+    error_obj.curr_dir = su.get_curr_dir()
+    raise
+  finally:
+    su.reset_curr_dir()
 
 
 def _split_rule_symbol(rule_symbol):
@@ -85,6 +170,14 @@ def _delete_existing_out_files(rule_details):
       _remove_file(out_file)
 
 
+def _get_written_files(rule_details, file_list):
+  """Get the files which building a rule might have changed."""
+  written_files = ac.get_rule_outputs(rule_details)
+  work_dir = os.path.join(rule_details[su.WDIR_KEY], '')
+  written_files.extend([f for f in file_list if f.startswith(work_dir)])
+  return written_files
+
+
 class RuleBuilder(object):
   """Traverse rules graph and apply them."""
   def __init__(self, rules_list):
@@ -94,12 +187,31 @@ class RuleBuilder(object):
         su.RULE_SEPARATOR, su.ALL_LIGHT_RULES_KEY)
     self._target_prefix = su.BUILD_RULE_PREFIX
     self._rule_handler = rh.RuleHandler()
+    self._rules_list = list(rules_list)
     self._rules_map = {}
     self._rule_file_cache = {}
-    self._build_order = []
-    self._load_rules_list_to_map(rules_list)
-    self._load_build_order()
-    self._load_all_recursive_deps()
+    # Modification time and size of BLD files when they were loaded.
+    self._rule_file_stamps = {}
+    self._graph = None
+    # Dependency closures of rules as bitsets, indexed by graph node.
+    self._all_deps = None
+    self._all_compile_deps = None
+    # Rules which have been set up already.
+    self._set_up = set()
+    self._rule_metrics = {}
+    self._test_jobs = None
+    self._test_timeout = None
+    self._test_shard_size = 0
+    self._use_test_cache = True
+    self._action_cache = ac.get_action_cache()
+    # Stat cache of the running build.
+    self._stat_cache = None
+    with bp.PROFILER.span('load_rules', 'graph'):
+      self._load_rules_list_to_map(rules_list)
+      bfc.BUILD_FILE_CACHE.save()
+    with bp.PROFILER.span('rule_graph', 'graph'):
+      self._graph = rg.RuleGraph(self._rules_map)
+      self._load_all_recursive_deps()
 
   def _expand_symbol(self, item, path):
     """Rule symbol expansion routine."""
@@ -130,7 +242,10 @@ class RuleBuilder(object):
       # Optimizing run-time error message for common error case.
       if (not su.TEST_MODE_EXECUTION) and (not su.path_exists(rule_file)):
         raise su.Error('Missing rule file: ' + rule_file)
-      self._rule_file_cache[rule_file] = su.read_build_file(rule_file)
+      self._rule_file_stamps[rule_file] = _get_file_stamp(rule_file)
+      with bp.PROFILER.span('load_bld_file', 'graph', file=rule_file):
+        self._rule_file_cache[rule_file] = bfc.BUILD_FILE_CACHE.get(
+            rule_file)
     return self._rule_file_cache[rule_file]
 
   def _get_rule_details(self, rule_path, rule_name, rule_file, rule_symbol):
@@ -170,24 +285,22 @@ class RuleBuilder(object):
     rule_details[su.RULE_FILE_PATH] = rule_file
     return rule_details
 
-  def _load_rules_list_to_map(self, rules_list):
-    """Load rules from list to map."""
-    active_list = rules_list[:]
-    iters = 0
+  def _load_rules_list_to_map(self, rules_list, loaded_details=None):
+    """Load rules from list to map. Details of rules found in loaded_details
+    are used as they are."""
+    loaded_details = loaded_details or {}
+    active_list = collections.deque(rules_list)
     while active_list:
-      rule_symbol = active_list[0]
-      active_list = active_list[1:]
+      rule_symbol = active_list.popleft()
       if rule_symbol in self._rules_map:
         continue
-      iters += 1
-      assert iters <= MAX_LOOP_COUNT
       rule_path, rule_name = _split_rule_symbol(rule_symbol)
       rule_file = self._get_rule_file(rule_symbol)
       self._load_file_cache(rule_file)
       if rule_symbol.endswith(self._all_rules):
         active_list.extend(
             ['{}{}{}'.format(rule_path, su.RULE_SEPARATOR, r)
-             for r in self._rule_file_cache[rule_file].keys()])
+             for r in sorted(self._rule_file_cache[rule_file])])
       elif rule_symbol.endswith(self._all_light_rules):
         light_rules_list = [
             l for l in self._rule_file_cache[rule_file]
@@ -196,8 +309,10 @@ class RuleBuilder(object):
         active_list.extend(['{}{}{}'.format(rule_path, su.RULE_SEPARATOR, r)
                             for r in light_rules_list])
       else:
-        rule_details = self._get_rule_details(
-            rule_path, rule_name, rule_file, rule_symbol)
+        rule_details = loaded_details.get(rule_symbol, None)
+        if rule_details is None:
+          rule_details = self._get_rule_details(
+              rule_path, rule_name, rule_file, rule_symbol)
         self._rules_map[rule_symbol] = rule_details
         active_list.extend(rule_details[su.DEPS_KEY])
         active_list.extend(rule_details[su.COMPILE_DEPS_KEY])
@@ -216,61 +331,114 @@ class RuleBuilder(object):
         raise su.Error('Non test rule {} cannot depend on test rule {}'.format(
                        rule_details[su.SYMBOL_KEY], rule))
 
-  def _load_build_order(self):
-    """Load build order from rules map."""
-    # Build order is a list of list of rule symbols. Every first order list
-    # is a list of rule symbols that can be built in parallel.
-    active_set = set(self._rules_map.keys())
-    built_set = set()
-    iters = 0
-    while active_set:
-      iters += 1
-      assert iters <= MAX_LOOP_COUNT
-      ready_set = set()
-      for rule_symbol in active_set:
-        deps = self._rules_map[rule_symbol][su.DEPS_KEY][:]
-        deps.extend(self._rules_map[rule_symbol][su.COMPILE_DEPS_KEY])
-        if all([s in built_set for s in deps]):
-          ready_set.add(rule_symbol)
-      assert ready_set
-      self._build_order.append(sorted(list(ready_set)))
-      built_set.update(ready_set)
-      active_set = [s for s in active_set if s not in ready_set]
-
   def _load_all_recursive_deps(self):
-    """Load all recursive dependencies for build optimization."""
-    for build_group in self._build_order:
-      for rule_symbol in build_group:
-        rule_details = self._rules_map[rule_symbol]
-        all_deps = [rule_symbol]
-        for dep_rule_symbol in rule_details[su.DEPS_KEY]:
-          dep_rule_details = self._rules_map[dep_rule_symbol]
-          include_recursively = (
-              self._rule_handler.rule_include_deps_recursively(
-                  dep_rule_details))
-          if include_recursively:
-            all_deps.extend(dep_rule_details[su.ALL_DEPS_KEY])
-          all_deps.append(dep_rule_symbol)
-        rule_details[su.ALL_DEPS_KEY] = list(set(all_deps))
+    """Load transitive dependency closures of all rules in topological order.
+    Closures are merged as bitsets of graph nodes, which handlers look up
+    through read only rule sets."""
+    graph = self._graph
+    all_deps = self._all_deps = [0] * graph.size()
+    all_compile_deps = self._all_compile_deps = [0] * graph.size()
+    for node in graph.get_topo_order():
+      rule_details = self._rules_map[graph.get_symbol(node)]
+      node_all_deps = 1 << node
+      node_compile_deps = 0
+      for dep_rule_symbol in rule_details[su.DEPS_KEY]:
+        dep_node = graph.get_node(dep_rule_symbol)
+        dep_rule_details = self._rules_map[dep_rule_symbol]
+        node_all_deps |= 1 << dep_node
+        if self._rule_handler.rule_include_deps_recursively(dep_rule_details):
+          node_all_deps |= all_deps[dep_node]
+        # Compile time deps of all recursive deps, which tests need at run
+        # time.
+        node_compile_deps |= all_compile_deps[dep_node]
+        node_compile_deps |= graph.get_bitset(
+            dep_rule_details[su.COMPILE_DEPS_KEY])
+      all_deps[node] = node_all_deps
+      all_compile_deps[node] = node_compile_deps
+      rule_details[su.ALL_DEPS_KEY] = graph.get_rule_set(node_all_deps)
+      rule_details[su.ALL_COMPILE_DEPS_KEY] = graph.get_rule_set(
+          node_compile_deps)
 
   def _build_rule_details(self, rule_symbol, rule_details):
-    """Execute build steps from rule detail."""
-    rule_hash = su.get_dictionary_hash(rule_details)
+    """Execute build steps from rule detail. Returns the build status and the
+    number of commands run."""
+    rule_hash = _get_rule_hash(rule_details)
     file_list = self._rule_handler.rule_file_list(rule_details)
-    if not su.needs_build(rule_details[su.WDIR_KEY], file_list, rule_hash):
+    snapshot_list = self._rule_handler.rule_snapshot_file_list(rule_details)
+    abi_files = self._rule_handler.rule_abi_file_list(rule_details)
+    relink_commands = self._rule_handler.rule_relink_commands(rule_details)
+    # Jars bundled in the outputs are identified by their contents. The
+    # compile snapshot of such rules only holds their public API, and
+    # decides if the outputs can be linked again without compiling.
+    snapshot_abi_files = [] if relink_commands else abi_files
+    with bp.PROFILER.span('needs_build', 'needs_build'):
+      is_needed = fs.needs_build(
+          rule_details[su.WDIR_KEY], snapshot_list, rule_hash,
+          self._stat_cache, snapshot_abi_files, ja.ABI_DIGEST_CACHE.get_digest)
+      can_relink = bool(relink_commands) and is_needed and not fs.needs_build(
+          rule_details[su.WDIR_KEY], snapshot_list, rule_hash,
+          self._stat_cache, abi_files, ja.ABI_DIGEST_CACHE.get_digest,
+          su.COMPILE_CACHE_FILE_NAME)
+    if not is_needed:
       logging.info(' Skipping build for %s', rule_symbol)
-      return
+      return bm.STATUS_UP_TO_DATE, 0
+    if can_relink:
+      return self._relink_rule(rule_symbol, rule_details, file_list,
+                               snapshot_list, abi_files, rule_hash,
+                               relink_commands)
     if not su.TEST_MODE_EXECUTION:
       su.cleandir(rule_details[su.WDIR_KEY])
       start_time_milli = su.get_epoch_milliseconds()
     _delete_existing_out_files(rule_details)
-    command_list = self._rule_handler.rule_build_commands(rule_details)
-    _run_commands(command_list)
-    su.save_file_list_cache(rule_details[su.WDIR_KEY], file_list, rule_hash)
+    with bp.PROFILER.span('build_commands', 'build') as span:
+      command_list = self._rule_handler.rule_build_commands(rule_details)
+      cache_key = self._action_cache.get_key(rule_details, file_list,
+                                             command_list)
+      if cache_key and self._action_cache.restore(cache_key, rule_details):
+        logging.info(' Restored %s from action cache', rule_symbol)
+        span.set_arg('action_cache', 'hit')
+        status = bm.STATUS_CACHED
+        command_list = self._rule_handler.rule_restore_commands(rule_details)
+        _run_commands(command_list)
+      else:
+        status = bm.STATUS_BUILT
+        _run_commands(command_list)
+        if cache_key:
+          self._action_cache.store(cache_key, rule_details)
+    self._stat_cache.invalidate(_get_written_files(rule_details, file_list))
+    fs.save_file_list_cache(rule_details[su.WDIR_KEY], snapshot_list,
+                            rule_hash, self._stat_cache, snapshot_abi_files,
+                            ja.ABI_DIGEST_CACHE.get_digest)
+    if relink_commands and status == bm.STATUS_BUILT:
+      fs.save_file_list_cache(rule_details[su.WDIR_KEY], snapshot_list,
+                              rule_hash, self._stat_cache, abi_files,
+                              ja.ABI_DIGEST_CACHE.get_digest,
+                              su.COMPILE_CACHE_FILE_NAME)
     if not su.TEST_MODE_EXECUTION:
       end_time_milli = su.get_epoch_milliseconds()
-      logging.info('Time (in seconds): %.2f',
-                   (end_time_milli - start_time_milli) / 1000.0)
+      duration = (end_time_milli - start_time_milli) / 1000.0
+      logging.info('Time (in seconds) for %s: %.2f', rule_symbol, duration)
+    return status, len(command_list)
+
+  def _relink_rule(self, rule_symbol, rule_details, file_list, snapshot_list,
+                   abi_files, rule_hash, relink_commands):
+    """Link the outputs of a rule again, keeping what its last build
+    compiled. Returns the build status and the number of commands run."""
+    logging.info(' Relinking %s', rule_symbol)
+    compile_cache_file = os.path.join(rule_details[su.WDIR_KEY],
+                                      su.COMPILE_CACHE_FILE_NAME)
+    # Should relinking fail, the next build compiles the rule again.
+    os.remove(compile_cache_file)
+    with bp.PROFILER.span('relink_commands', 'build'):
+      _run_commands(relink_commands)
+    self._stat_cache.invalidate(_get_written_files(rule_details, file_list))
+    fs.save_file_list_cache(rule_details[su.WDIR_KEY], snapshot_list,
+                            rule_hash, self._stat_cache)
+    fs.save_file_list_cache(rule_details[su.WDIR_KEY], snapshot_list,
+                            rule_hash, self._stat_cache, abi_files,
+                            ja.ABI_DIGEST_CACHE.get_digest,
+                            su.COMPILE_CACHE_FILE_NAME)
+    return bm.STATUS_BUILT, len(relink_commands)
 
   def _add_test_instrumentation(self, rule_symbol, rule_details,
                                 dependency_dict):
@@ -289,28 +457,379 @@ class RuleBuilder(object):
     dependency_dict[rule_symbol].extend(
         [MVN_COMPL_DEP_PREFIX + str(d) for d in maven_compile_deps])
 
-  def _build_rule_symbol(self, rule_symbol, run_tests, dependency_dict):
-    """Build a symbol assuming all dependencies have been built."""
+  def _setup_rule_symbol(self, rule_symbol, dependency_dict):
+    """Set up a symbol assuming all dependencies have been set up."""
     logging.info('-----\nBuilding %s', rule_symbol)
     rule_details = self._rules_map[rule_symbol]
-    self._rule_handler.rule_setup(rule_details, self._rules_map)
+    if rule_symbol not in self._set_up:
+      with bp.PROFILER.span('rule_setup', 'setup', rule=rule_symbol):
+        self._rule_handler.rule_setup(rule_details, self._rules_map)
+      self._set_up.add(rule_symbol)
     self._add_test_instrumentation(rule_symbol, rule_details, dependency_dict)
-    self._build_rule_details(rule_symbol, rule_details)
-    self._check_test_dependency(rule_details)
-    if run_tests:
-      command_list = self._rule_handler.rule_test(rule_details)
-      if command_list:
-        logging.info('-----\nRunning test %s', rule_symbol)
-        _run_commands(command_list)
 
-  def do_builds(self, run_tests, dependency_dict):
-    """Execute the rules."""
-    for build_group in self._build_order:
-      # Note: Parallelization logic should go here.
-      for rule_symbol in build_group:
-        self._build_rule_symbol(rule_symbol, run_tests, dependency_dict)
+  def _get_rule_locks(self, rule_symbol, rule_details):
+    """Get locks held while building a rule. Other bu processes wait on them
+    only to build the same rule or a rule using its outputs."""
+    graph = self._graph
+    node = graph.get_node(rule_symbol)
+    dep_nodes = (self._all_deps[node] | self._all_compile_deps[node] |
+                 graph.get_bitset(rg.get_rule_deps(rule_details)))
+    return fl.FileLocks(
+        [fl.get_rule_lock_file(rule_symbol)],
+        [fl.get_rule_lock_file(r)
+         for r in graph.get_rule_set(dep_nodes & ~(1 << node))])
+
+  def _build_rule_symbol(self, rule_symbol):
+    """Build a symbol assuming all dependencies have been built. This is the
+    part of a rule that may run on a worker thread."""
+    rule_details = self._rules_map[rule_symbol]
+    with bp.PROFILER.span(rule_symbol, 'rule'):
+      start_time = time.time()
+      with self._get_rule_locks(rule_symbol, rule_details):
+        status, num_commands = self._build_rule_details(rule_symbol,
+                                                        rule_details)
+      build_time = time.time() - start_time
+      self._check_test_dependency(rule_details)
+    output_size = 0
+    if status != bm.STATUS_UP_TO_DATE and not su.TEST_MODE_EXECUTION:
+      output_size = bm.get_output_size(ac.get_rule_outputs(rule_details))
+    self._rule_metrics[rule_symbol] = (
+        status, build_time, None, output_size, num_commands)
+
+  def set_test_options(self, test_jobs, test_timeout, test_shard_size,
+                       use_test_cache=True):
+    """Set the number of tests run in parallel (None for the number of build
+    jobs), the default timeout of a test in seconds (None for no limit), the
+    number of TestNG test classes run per JVM (0 for no sharding) and whether
+    tests that passed with the same inputs before are skipped."""
+    self._test_jobs = test_jobs
+    self._test_timeout = test_timeout
+    self._test_shard_size = test_shard_size
+    self._use_test_cache = use_test_cache
+
+  @classmethod
+  def _get_test_inputs(cls, rule_details, command_list):
+    """Get the files a test runs with: the outputs of its rule, its runtime
+    class path and any other file named by its commands."""
+    input_files = ac.get_rule_outputs(rule_details)
+    clsdeps_dir = rule_details.get(su.WDIR_CLSDEPS_KEY, None)
+    if clsdeps_dir and os.path.isdir(clsdeps_dir):
+      input_files.extend([os.path.join(clsdeps_dir, f)
+                          for f in os.listdir(clsdeps_dir)])
+    pending = list(command_list)
+    while pending:
+      item = pending.pop()
+      if isinstance(item, (list, tuple)):
+        pending.extend(item)
+      elif isinstance(item, str) and os.path.isabs(item) and (
+          su.path_isfile(item)):
+        input_files.append(item)
+    return sorted(set(input_files))
+
+  def _get_test_jobs(self, test_symbols):
+    """Get the test jobs of the given rules, longest first by their recent
+    test times."""
+    past_durations = bm.get_past_test_durations(bm.load_runs())
+    jobs = []
+    for rule_symbol in test_symbols:
+      rule_details = self._rules_map[rule_symbol]
+      timeout = self._test_timeout
+      if su.TEST_TIMEOUT_KEY in rule_details:
+        timeout = su.get_test_timeout(str(rule_details[su.TEST_TIMEOUT_KEY]))
+      command_list = self._rule_handler.rule_test(rule_details)
+      input_files = None
+      if not su.TEST_MODE_EXECUTION:
+        input_files = self._get_test_inputs(rule_details, command_list)
+      jobs.extend(tr.get_test_jobs(rule_symbol, command_list, timeout,
+                                   self._test_shard_size, input_files))
+    # Starting the longest tests first keeps them from delaying the end of
+    # the test phase.
+    jobs.sort(key=lambda j: -past_durations.get(j.rule_symbol, 0) /
+              j.num_shards)
+    return jobs
+
+  def _run_tests(self, test_symbols, num_jobs):
+    """Run the tests of the given built rules, then print a summary and fail
+    if any of them did not pass."""
+    jobs = self._get_test_jobs(test_symbols)
+    start_time = time.time()
+    test_cache = None if su.TEST_MODE_EXECUTION else tc.TestCache()
+    # Tested rules must not be rebuilt by other bu processes meanwhile.
+    with fl.FileLocks([], [fl.get_rule_lock_file(r) for r in test_symbols]):
+      results = tr.run_tests(
+          jobs, self._test_jobs or num_jobs,
+          lambda command_list: _run_commands(command_list,
+                                             tp.run_test_process),
+          test_cache, self._use_test_cache)
+    for result in results:
+      if result.cached:
+        continue
+      rule_symbol = result.job.rule_symbol
+      status, build_time, test_time, output_size, num_commands = (
+          self._rule_metrics[rule_symbol])
+      self._rule_metrics[rule_symbol] = (
+          status, build_time, (test_time or 0) + result.duration, output_size,
+          num_commands + len(result.job.command_list))
+    logging.info('-----\n%s', tr.get_summary(results, time.time() - start_time))
+    tr.check_results(results)
+
+  def _get_scheduler(self, build_rules):
+    """Get a ready queue scheduler over all the rules to build, the given
+    rules and the rules they depend on unless build_rules is None."""
+    past_durations = bs.load_past_durations()
+    rule_symbols = self._rules_map.keys()
+    if build_rules is not None:
+      rule_symbols = self._graph.get_bitset_symbols(
+          self._get_closure(build_rules, self._graph.get_deps))
+    rule_costs = dict(
+        [(r, bs.get_rule_cost(self._rules_map[r], past_durations))
+         for r in rule_symbols])
+    return bs.BuildScheduler(self._graph, rule_costs)
+
+  def do_builds(self, run_tests, dependency_dict, num_jobs=1,
+                build_rules=None):
+    """Execute the rules. A rule is handed to a pool of num_jobs workers as
+    soon as all its dependencies have been built. When running tests, they
+    run once all rules are built. If build_rules is given, only those rules
+    and the rules they depend on are built and only their own tests run."""
+    start_time = time.time()
+    test_rules = None if build_rules is None else set(build_rules)
+    self._rule_metrics = {}
+    self._stat_cache = fs.StatCache()
+    scheduler = self._get_scheduler(build_rules)
+    pool = wp.WorkerPool(num_jobs)
+    test_symbols = []
+    try:
+      try:
+        while not scheduler.done():
+          while scheduler.has_ready() and pool.in_flight() < num_jobs:
+            rule_symbol = scheduler.pop_ready()
+            logging.debug('Dispatching %s with critical path %.2f',
+                          rule_symbol, scheduler.get_priority(rule_symbol))
+            self._setup_rule_symbol(rule_symbol, dependency_dict)
+            pool.submit(rule_symbol, self._build_rule_symbol, rule_symbol)
+            if ((run_tests and
+                 (test_rules is None or rule_symbol in test_rules) and
+                 self._rule_handler.rule_test(
+                     self._rules_map[rule_symbol]))):
+              test_symbols.append(rule_symbol)
+          if not pool.in_flight():
+            raise Error(
+                'No rule is ready to build, dependency graph is broken.')
+          scheduler.mark_done(self._collect_one(pool))
+      finally:
+        # Build workers are done before tests start on their own pool.
+        pool.close()
+      if test_symbols:
+        self._run_tests(test_symbols, num_jobs)
+    finally:
+      self._save_metrics(time.time() - start_time)
+      self._update_build_dirs()
+      self._stat_cache.close()
+      fs.DIGEST_CACHE.save()
+      ja.ABI_DIGEST_CACHE.save()
+      # Closing finishes remote pushes, which then show up in statistics.
+      self._action_cache.close()
+      self._action_cache.log_stats()
     return 0
 
+  def _save_metrics(self, wall_time):
+    """Record the metrics of the rules built or tested by this build. Rules
+    which were up to date and not tested are only counted."""
+    rule_records = {}
+    num_up_to_date = 0
+    for rule_symbol, metrics in self._rule_metrics.iteritems():
+      status, build_time, test_time, output_size, num_commands = metrics
+      if status == bm.STATUS_UP_TO_DATE and test_time is None:
+        num_up_to_date += 1
+        continue
+      rule_records[rule_symbol] = [
+          status, round(build_time, 3), round(test_time or 0, 3),
+          output_size, num_commands]
+    bm.save_run(rule_records, num_up_to_date, wall_time)
+
+  def _update_build_dirs(self):
+    """Record the rules used by this build in the build ledger, then evict
+    the least recently used other rules above the size budget of the build
+    directories."""
+    if su.TEST_MODE_EXECUTION:
+      return
+    ledger = bg.BuildLedger()
+    for rule_symbol, metrics in self._rule_metrics.iteritems():
+      rule_details = self._rules_map[rule_symbol]
+      working_dir = rule_details[su.WDIR_KEY]
+      output_files = ac.get_rule_outputs(rule_details)
+      size = None
+      if metrics[0] != bm.STATUS_UP_TO_DATE:
+        size = bg.get_disk_size([working_dir] + output_files)
+      ledger.record(rule_symbol, working_dir, output_files, size)
+    max_size_bytes = bg.get_max_size_bytes()
+    if max_size_bytes:
+      evicted_rules, evicted_bytes = bg.evict(ledger, max_size_bytes,
+                                              set(self._rule_metrics))
+      if evicted_rules:
+        logging.info('Evicted %d rule(s), %.1f MB from build directories.',
+                     evicted_rules, evicted_bytes / (1024.0 * 1024))
+    ledger.save()
+
+  @classmethod
+  def _collect_one(cls, pool):
+    """Wait for a rule to finish and abort the build on its failure."""
+    rule_symbol, exc_info = pool.wait_one()
+    if not exc_info:
+      return rule_symbol
+    if pool.in_flight():
+      logging.info('Build of %s failed, waiting for %d running rule(s).',
+                   rule_symbol, pool.in_flight())
+      pool.drain()
+    wp.reraise(exc_info)
+
+  def setup_rules(self):
+    """Set up the rules which are not set up yet without building them, which
+    finds the files they are built from."""
+    for rule_symbol in self._graph.get_symbols_in_topo_order():
+      if rule_symbol not in self._set_up:
+        self._rule_handler.rule_setup(self._rules_map[rule_symbol],
+                                      self._rules_map)
+        self._set_up.add(rule_symbol)
+
+  def _get_closure(self, rule_symbols, get_adjacent):
+    """Get bitset of the given rules along with the rules reachable from them
+    through get_adjacent, which maps a graph node to adjacent nodes."""
+    graph = self._graph
+    pending = [graph.get_node(r) for r in rule_symbols]
+    closure = 0
+    while pending:
+      node = pending.pop()
+      if not closure & (1 << node):
+        closure |= 1 << node
+        pending.extend(get_adjacent(node))
+    return closure
+
+  def _get_source_files(self, rule_symbol):
+    """Get the BLD file and the files a rule is built from. Only the BLD file
+    is known until the rule is set up."""
+    rule_details = self._rules_map[rule_symbol]
+    source_files = [rule_details[su.RULE_FILE_PATH]]
+    if rule_symbol in self._set_up:
+      source_files.extend(self._rule_handler.rule_file_list(rule_details))
+    return source_files
+
+  def reload_rule_files(self, rule_files):
+    """Parse the given BLD files again. The rules loaded from them and the
+    rules depending on those are loaded and have to be set up again, other
+    rules are kept as they are. Returns the rules loaded again or newly
+    loaded. Rules are left as they were if loading fails."""
+    rule_files = set(rule_files)
+    stale_rules = set(self._graph.get_bitset_symbols(self._get_closure(
+        [r for (r, d) in self._rules_map.iteritems()
+         if d[su.RULE_FILE_PATH] in rule_files], self._graph.get_rdeps)))
+    rule_files.update(
+        [self._rules_map[r][su.RULE_FILE_PATH] for r in stale_rules])
+    kept_details = dict([(r, d) for (r, d) in self._rules_map.iteritems()
+                         if r not in stale_rules])
+    saved_state = (self._rules_map, dict(self._rule_file_cache),
+                   dict(self._rule_file_stamps), self._graph)
+    for rule_file in rule_files:
+      self._rule_file_cache.pop(rule_file, None)
+      self._rule_file_stamps.pop(rule_file, None)
+    self._rules_map = {}
+    try:
+      with bp.PROFILER.span('load_rules', 'graph'):
+        self._load_rules_list_to_map(self._rules_list, kept_details)
+        bfc.BUILD_FILE_CACHE.save()
+      with bp.PROFILER.span('rule_graph', 'graph'):
+        self._graph = rg.RuleGraph(self._rules_map)
+        self._load_all_recursive_deps()
+    except:
+      (self._rules_map, self._rule_file_cache, self._rule_file_stamps,
+       self._graph) = saved_state
+      self._load_all_recursive_deps()
+      raise
+    self._set_up = set([r for r in self._set_up
+                        if r in self._rules_map and r not in stale_rules])
+    return sorted([r for r in self._rules_map if r not in kept_details])
+
+  def get_changed_rule_files(self):
+    """Get the BLD files which changed since they were loaded, along with the
+    BLD files of rules which fetched files during set up that are gone
+    since."""
+    changed_files = set([f for (f, s) in self._rule_file_stamps.iteritems()
+                         if _get_file_stamp(f) != s])
+    for rule_symbol in self._set_up:
+      rule_details = self._rules_map[rule_symbol]
+      if not all([su.path_exists(f)
+                  for f in rule_details.get(su.SETUP_FILES_KEY, [])]):
+        changed_files.add(rule_details[su.RULE_FILE_PATH])
+    return sorted(changed_files)
+
+  def get_watched_files(self):
+    """Get the BLD files and source files of all the rules. Files generated
+    by other rules are left out."""
+    generated_dirs = (os.path.join(su.BUILD_OUT_DIR, ''),
+                      os.path.join(su.BUILD_WORK_DIR, ''))
+    watched_files = set()
+    for rule_symbol in self._rules_map:
+      watched_files.update(
+          [f for f in self._get_source_files(rule_symbol)
+           if not f.startswith(generated_dirs)])
+    return watched_files
+
+  def get_rules_affected_by(self, changed_files):
+    """Get the rules built from any of the changed files along with all the
+    rules depending on them."""
+    changed_files = set(changed_files)
+    return self._graph.get_bitset_symbols(self._get_closure(
+        [r for r in self._rules_map
+         if not changed_files.isdisjoint(self._get_source_files(r))],
+        self._graph.get_rdeps))
+
   def get_rules_map(self):
     """Returns rules map dictionary."""
     return self._rules_map
+
+  def get_rule_graph(self):
+    """Returns dependency graph of the rules in rules map."""
+    return self._graph
+
+
+class RuleBuilderCache(object):
+  """Rule builders kept between the commands of a build server, by the rules
+  they were loaded for. A kept builder is used again after loading and setting
+  up again only the rules of BLD files changed since, the rules whose set up
+  fetched files which are gone and the rules depending on those. Nothing is
+  kept until enabled."""
+  def __init__(self):
+    """Initialize."""
+    # Least recently used builders first.
+    self._builders = collections.OrderedDict()
+    self._max_builders = 0
+
+  def enable(self, max_builders):
+    """Keep up to max_builders rule builders."""
+    self._max_builders = max_builders
+
+  def clear(self):
+    """Drop all kept rule builders."""
+    self._builders.clear()
+
+  def get(self, rules_list):
+    """Get a builder of the given rules."""
+    key = tuple(sorted(set(rules_list)))
+    builder = self._builders.pop(key, None)
+    if builder:
+      changed_files = builder.get_changed_rule_files()
+      if changed_files:
+        try:
+          builder.reload_rule_files(changed_files)
+        except su.Error as error_obj:
+          # A new builder reports the error unless it was transient.
+          logging.debug('Dropped rule builder: %s', error_obj)
+          builder = None
+    if not builder:
+      builder = RuleBuilder(rules_list)
+    if self._max_builders:
+      self._builders[key] = builder
+      while len(self._builders) > self._max_builders:
+        self._builders.popitem(last=False)
+    return builder
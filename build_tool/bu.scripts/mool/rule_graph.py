@@ -0,0 +1,155 @@
+"""Dependency graph of build rules.
+
+Rules are numbered in sorted order of their symbols and the graph keeps both
+forward (rule to the rules it depends on) and reverse (rule to the rules
+depending on it) adjacency lists of those numbers. Topological ordering and
+cycle detection are linear in the size of the graph. Sets of rules, such as
+transitive dependency closures, are represented as integer bitsets of node
+numbers, which are compact and cheap to merge. Rule sets give read only access
+to the rules of a bitset.
+"""
+import collections
+
+import mool.shared_utils as su
+
+
+class Error(su.Error):
+  """Error class for this module."""
+
+
+def get_rule_deps(rule_details):
+  """Get the rules which must be built before the given rule."""
+  deps = set(rule_details[su.DEPS_KEY])
+  deps.update(rule_details[su.COMPILE_DEPS_KEY])
+  return deps
+
+
+class RuleGraph(object):
+  """Integer indexed graph of the rules in a rules map."""
+  def __init__(self, rules_map):
+    """Initialize."""
+    self._symbols = sorted(rules_map)
+    self._index = dict([(s, i) for (i, s) in enumerate(self._symbols)])
+    self._deps = [[] for _ in self._symbols]
+    self._rdeps = [[] for _ in self._symbols]
+    for node, rule_symbol in enumerate(self._symbols):
+      for dep in sorted(get_rule_deps(rules_map[rule_symbol])):
+        if dep not in self._index:
+          raise Error('Rule {} depends on unknown rule {}'.format(
+              rule_symbol, dep))
+        self._deps[node].append(self._index[dep])
+        self._rdeps[self._index[dep]].append(node)
+    self._topo_order = None
+
+  def size(self):
+    """Number of rules in the graph."""
+    return len(self._symbols)
+
+  def get_symbol(self, node):
+    """Get rule symbol of a node."""
+    return self._symbols[node]
+
+  def get_node(self, rule_symbol):
+    """Get node of a rule symbol."""
+    return self._index[rule_symbol]
+
+  def get_deps(self, node):
+    """Get nodes which the given node depends on."""
+    return self._deps[node]
+
+  def get_rdeps(self, node):
+    """Get nodes which depend on the given node."""
+    return self._rdeps[node]
+
+  def get_bitset(self, rule_symbols):
+    """Get bitset of a list of rule symbols."""
+    bitset = 0
+    for rule_symbol in rule_symbols:
+      bitset |= 1 << self._index[rule_symbol]
+    return bitset
+
+  def get_bitset_symbols(self, bitset):
+    """Get sorted list of rule symbols in a bitset."""
+    rule_symbols = []
+    while bitset:
+      lowest_bit = bitset & -bitset
+      rule_symbols.append(self._symbols[lowest_bit.bit_length() - 1])
+      bitset ^= lowest_bit
+    return rule_symbols
+
+  def get_rule_set(self, bitset):
+    """Get read only set of the rules in a bitset."""
+    return RuleSet(self, bitset)
+
+  def get_topo_order(self):
+    """Get all the nodes with every node placed after all of its deps."""
+    if self._topo_order is None:
+      waiting_on = [len(d) for d in self._deps]
+      ready = collections.deque(
+          [n for (n, c) in enumerate(waiting_on) if not c])
+      topo_order = []
+      while ready:
+        node = ready.popleft()
+        topo_order.append(node)
+        for rdep in self._rdeps[node]:
+          waiting_on[rdep] -= 1
+          if not waiting_on[rdep]:
+            ready.append(rdep)
+      if len(topo_order) != len(waiting_on):
+        raise Error('Dependency cycle among rules: {}'.format(' -> '.join(
+            [self._symbols[n] for n in self._find_cycle(waiting_on)])))
+      self._topo_order = topo_order
+    return self._topo_order
+
+  def get_symbols_in_topo_order(self):
+    """Get all the rule symbols with every rule placed after all of its
+    deps."""
+    return [self._symbols[n] for n in self.get_topo_order()]
+
+  def _find_cycle(self, waiting_on):
+    """Find a cycle among the nodes left over by topological sorting. Every
+    such node depends on another left over node, so walking those deps must
+    come back to a node seen before."""
+    node = min([n for (n, c) in enumerate(waiting_on) if c])
+    position = {}
+    path = []
+    while node not in position:
+      position[node] = len(path)
+      path.append(node)
+      node = [d for d in self._deps[node] if waiting_on[d]][0]
+    return path[position[node]:] + [node]
+
+
+class RuleSet(object):
+  """Read only set of the rules of a graph kept as a bitset of their nodes.
+  Rules are iterated in sorted order of their symbols without building a
+  list."""
+  def __init__(self, graph, bitset):
+    """Initialize."""
+    self._graph = graph
+    self._bitset = bitset
+
+  def get_bitset(self):
+    """Get bitset of the rules."""
+    return self._bitset
+
+  def __contains__(self, rule_symbol):
+    """Checks if a rule is in the set."""
+    try:
+      return bool(self._bitset & (1 << self._graph.get_node(rule_symbol)))
+    except KeyError:
+      return False
+
+  def __iter__(self):
+    """Iterate over rule symbols."""
+    # Scanning the binary digits is linear in the size of the graph, unlike
+    # clearing bits of a long integer one by one.
+    bits = bin(self._bitset)[:1:-1]
+    node = bits.find('1')
+    while node >= 0:
+      yield self._graph.get_symbol(node)
+      node = bits.find('1', node + 1)
+
+  def __len__(self):
+    """Number of rules in the set."""
+    return bin(self._bitset).count('1')
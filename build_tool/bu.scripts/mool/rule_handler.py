@@ -80,11 +80,42 @@ class RuleHandler(object):
       return rule_module.include_deps_recursively(rule_details)
     return True
 
+  def rule_restore_commands(self, rule_details):
+    """Commands to recreate the working directory state that tests of a rule
+    need, after its outputs have been restored from cache."""
+    rule_module = self._lookup[rule_details[su.TYPE_KEY]]
+    if hasattr(rule_module, 'restore_commands'):
+      return rule_module.restore_commands(rule_details)
+    return []
+
+  def rule_relink_commands(self, rule_details):
+    """Commands to only link the outputs of a rule again, from what the last
+    build of the rule compiled, when none of its compiled inputs changed."""
+    rule_module = self._lookup[rule_details[su.TYPE_KEY]]
+    if hasattr(rule_module, 'relink_commands'):
+      return rule_module.relink_commands(rule_details)
+    return []
+
   @classmethod
   def rule_file_list(cls, rule_details):
     """Return a list of input and output files of this rule."""
     return list(set(rule_details[su.ALL_DEP_PATHS_KEY]))
 
+  @classmethod
+  def rule_snapshot_file_list(cls, rule_details):
+    """Return the files whose digests decide if a rule is up to date. Files
+    which only reach the rule through the outputs of its dependencies are
+    left out."""
+    indirect_paths = set(rule_details.get(su.INDIRECT_DEP_PATHS_KEY, []))
+    return [f for f in cls.rule_file_list(rule_details)
+            if f not in indirect_paths]
+
+  @classmethod
+  def rule_abi_file_list(cls, rule_details):
+    """Return the dependency jars which the rule is compiled against, so only
+    their public API decides if it needs to be compiled again."""
+    return rule_details.get(su.ABI_DEP_PATHS_KEY, [])
+
   @classmethod
   def rule_test(cls, rule_details):
     """Generate test command line."""
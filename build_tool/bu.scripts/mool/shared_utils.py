@@ -1,5 +1,6 @@
 """Implement common utilities."""
-import fcntl
+import errno
+import hashlib
 import json
 import logging
 import os
@@ -7,16 +8,19 @@ import re
 import shutil
 import subprocess
 import sys
+import threading
 import time
 import urllib
 import zipfile
 
 from collections import OrderedDict
 
+import mool.build_profiler as bp
+
 CACHE_FILE_NAME = '.project.cache'
 COMMENT_CHAR = '#'
+COMPILE_CACHE_FILE_NAME = '.compile.cache'
 DIR_ROOT_KEY = 'dir_root'
-LOCK_FILE_NAME = '.bu.lock'
 QUOTE_CHAR = '"'
 RULE_KEY = 'build_rules'
 
@@ -49,6 +53,22 @@ SUBMITQ_DEBUG_MODE = os.environ.get('SUBMITQ_DEBUG_MODE', '').lower() == 'true'
 SUBMIT_QUEUE_FILE_NAME = 'SUBMITQ'
 THRIFT_COMPILER = os.environ.get('THRIFT_COMPILER', '/dev/null')
 DEVELOPER_MODE = os.environ.get('DEVELOPER_MODE', 'false')
+BUILD_JOBS = os.environ.get('BUILD_JOBS', '1')
+TEST_JOBS = os.environ.get('TEST_JOBS', '')
+TEST_SHARD_SIZE = os.environ.get('TEST_SHARD_SIZE', '10')
+TEST_TIMEOUT_SECONDS = os.environ.get('TEST_TIMEOUT_SECONDS', '900')
+TEST_CACHE_ENV_VARS = os.environ.get('TEST_CACHE_ENV_VARS', '').split()
+JAVA_COMPILE_SERVER = (
+    os.environ.get('JAVA_COMPILE_SERVER', 'false').lower() == 'true')
+BUILD_DAEMON_IDLE_MINUTES = os.environ.get('BUILD_DAEMON_IDLE_MINUTES', '180')
+ACTION_CACHE_DIR = os.environ.get(
+    'ACTION_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.mool', 'action_cache'))
+ACTION_CACHE_MAX_MB = os.environ.get('ACTION_CACHE_MAX_MB', '5120')
+BUILD_DIRS_MAX_MB = os.environ.get('BUILD_DIRS_MAX_MB', '0')
+REMOTE_CACHE_URL = os.environ.get('REMOTE_CACHE_URL', '')
+REMOTE_CACHE_PUSH = os.environ.get('REMOTE_CACHE_PUSH', 'false')
+REMOTE_CACHE_THREADS = os.environ.get('REMOTE_CACHE_THREADS', '8')
 MAVEN_PREFER_LOCAL_REPO = os.environ.get('MAVEN_PREFER_LOCAL_REPO', '')
 
 CC_BOOST_INCDIR = os.path.join(BOOST_INSTALL_DIR, 'include')
@@ -67,6 +87,8 @@ JAVA_COMPILER = os.environ.get('JAVA_COMPILER',
                                os.path.join(JAVA_HOME, 'bin', 'javac'))
 JAVA_RUNTIME = os.path.join(JAVA_HOME, 'bin', 'java')
 
+ABI_DEP_PATHS_KEY = '_abi_dep_paths'
+ALL_COMPILE_DEPS_KEY = '_all_compile_deps'
 ALL_DEP_PATHS_KEY = 'all_dependency_paths'
 ALL_DEPS_KEY = '_all_deps'
 ALL_LIGHT_RULES_KEY = 'LIGHTRULES'
@@ -98,6 +120,7 @@ FILE_COLL_TYPE = 'file_coll'
 FILE_PACKAGE_KEY = 'file_package'
 FILE_COLL_DEPS_KEY = 'file_coll_deps'
 HDRS_KEY = 'hdrs'
+INDIRECT_DEP_PATHS_KEY = '_indirect_dep_paths'
 JAR_INCLUDE_KEY = 'jar_include_paths'
 JAR_MANIFEST_KEY = 'META-INF'
 JAR_MANIFEST_SERVICE_KEY = 'services'
@@ -175,6 +198,7 @@ SCALA_PACKAGE_KEY = 'scala_package'
 SCALA_TEST_TYPE = 'scala_test'
 SCALA_TESTNG_GROUPS = 'test_groups'
 SCALA_VERSION_KEY = 'scala_version'
+SETUP_FILES_KEY = '_setup_files'
 SRCS_KEY = 'srcs'
 SYMBOL_KEY = 'rule_symbol'
 SYS_DEPS_KEY = 'sys_deps'
@@ -186,6 +210,7 @@ TEST_CLASS_KEY = 'test_class'
 TEST_CLASSES_KEY = 'test_classes'
 TEST_COMMANDS_KEY = 'test_command_list'
 TEST_MODE_EXECUTION = False
+TEST_TIMEOUT_KEY = 'test_timeout'
 TYPE_KEY = 'rule_type'
 WDIR_KEY = 'wdir_key'
 WDIR_CLSDEPS_KEY = 'wdir_clsdeps_key'
@@ -206,6 +231,11 @@ THRIFT_CHECK_GENERATED_SOURCE = 'THRIFT_CHECK_GENERATED_SOURCE'
 THRIFT_COMPILE_GENERATED_JAVA = 'THRIFT_COMPILE_GENERATED_JAVA'
 
 
+# Per thread state of the command sequence being executed. Build commands of
+# different rules run concurrently, so the current directory set by a
+# CHANGE_CURR_DIR command is kept here instead of the process wide os.chdir.
+_THREAD_STATE = threading.local()
+
 #================  Keys used in rule_details dictionary.  ================#
 
 # (str) For referring to final out headers directory in thrift cc lib rule.
@@ -289,7 +319,11 @@ def download_cached_item(url, file_path):
     print PROGRESS_BAR.format('=' * done, ' ' * (bar_size - done), done * 2),
     sys.stdout.flush()
 
-  subprocess.check_call(get_mkdir_command(os.path.dirname(file_path)))
+  try:
+    os.makedirs(os.path.dirname(file_path))
+  except OSError as exc:
+    if exc.errno != errno.EEXIST:
+      raise
   temp_path = file_path + '.temp'
   try:
     logging.debug('Downloading file from %s.', url)
@@ -322,6 +356,14 @@ def set_workdir_child(rule_details, path_key, extension):
   rule_details[path_key] = os.path.join(rule_details[WDIR_KEY], extension)
 
 
+def get_output_state_dir(out_file):
+  """Get the hidden directory next to an output file where the command writing
+  it may keep state for writing it again. It survives the deletion of the
+  output before a rule is built, and is deleted along with it otherwise."""
+  return os.path.join(os.path.dirname(out_file),
+                      '.{}.state'.format(os.path.basename(out_file)))
+
+
 def get_proto_compile_command(rule_details, out_path):
   """Get the protoc command line for specified parameters."""
   assert 1 == len(rule_details[SRCS_KEY])
@@ -441,22 +483,6 @@ def log_normalize(file_path):
   return file_path
 
 
-def lock_working_dir():
-  """Lock the working directory to enforce single instance of script."""
-  lock_file = os.path.join(BUILD_WORK_DIR, LOCK_FILE_NAME)
-  file_object = open(lock_file, 'w')
-  fcntl.lockf(file_object, fcntl.LOCK_EX)
-  return file_object
-
-
-def release_working_dir(file_object):
-  """Release the working directory to enforce single instance of script."""
-  if not file_object:
-    return
-  fcntl.lockf(file_object, fcntl.LOCK_UN)
-  file_object.close()
-
-
 def read_file(file_path):
   """Read text from file."""
   with open(file_path, 'rb') as file_object:
@@ -504,68 +530,59 @@ def string_to_bool(text):
   return text == TRUE_REPR
 
 
-def _get_current_snapshot_text(file_list, rule_hash):
-  """Gets current snapshot text from file list."""
-  def _file_signature(file_path):
-    """Gets the textual signature of a file version on disk."""
-    mod_timestamp = int(1000 * os.path.getmtime(file_path))
-    size_bytes = os.stat(file_path).st_size
-    return str((mod_timestamp, size_bytes))
-
-  found_all = True
-  curr_snapshot_map = {}
-  for file_path in file_list:
-    assert file_path not in curr_snapshot_map
-    if not path_exists(file_path):
-      logging.debug('Did not find %s', file_path)
-      found_all = False
-      break
-    curr_snapshot_map[file_path] = _file_signature(file_path)
-  curr_snapshot_text = '\n'.join(
-      ['{} {}'.format(v, k) for (k, v) in curr_snapshot_map.iteritems()])
-  full_snapshot_text = '{}: {}\n{}'.format(
-      'RULE_DETAILS_HASH_VALUE', rule_hash, curr_snapshot_text)
-  return found_all, full_snapshot_text
-
-
-def needs_build(working_dir, file_list, rule_hash):
-  """Checks file list snapshot for any changes."""
-  tracer = logging.debug
-  cache_file = os.path.join(working_dir, CACHE_FILE_NAME)
-  if not path_exists(cache_file):
-    tracer('Did not find cache file at %s', log_normalize(cache_file))
-    return True
-  found_all, snapshot_text = _get_current_snapshot_text(file_list, rule_hash)
-  if not found_all:
-    tracer('Did not find all files present.')
-    return True
-  cached_text = read_file(cache_file)
-  if snapshot_text != cached_text:
-    tracer('Snapshot mismatch.')
-    tracer('\nCache file: \n%s', cached_text)
-    tracer('\nCurrent snapshot: \n%s', snapshot_text)
-    return True
-  return False
-
-
-def save_file_list_cache(working_dir, file_list, rule_hash):
-  """Saves file list snapshot to disk."""
-  found_all, snapshot_text = _get_current_snapshot_text(file_list, rule_hash)
-  assert found_all
-  cache_file = os.path.join(working_dir, CACHE_FILE_NAME)
-  write_file(cache_file, snapshot_text)
-
-
 def check_dirname(dir_name):
   """Check directory name."""
   assert os.path.isdir(dir_name)
   assert dir_name == os.path.abspath(dir_name)
 
 
+def get_curr_dir():
+  """Get current directory of the command sequence run by this thread."""
+  return getattr(_THREAD_STATE, 'curr_dir', None) or os.getcwd()
+
+
+def is_curr_dir_set():
+  """Checks if a command sequence in this thread has changed directory."""
+  return getattr(_THREAD_STATE, 'curr_dir', None) is not None
+
+
+def reset_curr_dir():
+  """Fall back to the process working directory in this thread."""
+  _THREAD_STATE.curr_dir = None
+
+
 def change_dir(dir_name_params):
-  """Change directory command."""
+  """Change directory command. Only affects the calling thread.
+
+  Rules always change to one of their own working directories, which are
+  derived from the absolute BUILD_WORK_DIR and BUILD_OUT_DIR paths.
+  """
   assert 1 == len(dir_name_params)
-  os.chdir(dir_name_params[0])
+  _THREAD_STATE.curr_dir = dir_name_params[0]
+
+
+def get_num_jobs(jobs_text):
+  """Parse the number of parallel build jobs."""
+  try:
+    num_jobs = int(jobs_text)
+  except ValueError:
+    raise Error('Invalid number of jobs "{}"!'.format(jobs_text))
+  if num_jobs < 1:
+    raise Error('Number of jobs should be at least 1, got {}!'.format(
+        num_jobs))
+  return num_jobs
+
+
+def get_test_timeout(timeout_text):
+  """Parse a test timeout in seconds. Returns None for no timeout."""
+  try:
+    timeout = float(timeout_text)
+  except ValueError:
+    raise Error('Invalid test timeout "{}"!'.format(timeout_text))
+  if timeout < 0:
+    raise Error('Test timeout should not be negative, got {}!'.format(
+        timeout_text))
+  return timeout or None
 
 
 def get_javac_bin(version):
@@ -660,7 +677,7 @@ def _force_jar_extract_cwd(jar_path):
   """Forcefully extracts the jar to current working directory. It resolves the
   filename collisions on case insensitive file system and skips those files
   with a warning."""
-  curdir = os.path.abspath('.')
+  curdir = get_curr_dir()
 
   def _manual_unzip_to_cwd(jar_file):
     """Unzip each file manually if the file at same path doesn't exist."""
@@ -669,17 +686,17 @@ def _force_jar_extract_cwd(jar_path):
       for name in all_files:
         lower_name = name.lower().rstrip('/')
         full_path = os.path.join(curdir, lower_name)
-        if os.path.exists(lower_name) or os.path.isdir(lower_name):
+        if os.path.exists(full_path) or os.path.isdir(full_path):
           logging.debug('Skipping %s, file/directory already exists!', name)
         elif not os.path.isdir(os.path.dirname(full_path)):
           logging.debug('File with name %s exists, cannot extract %s!',
                         log_normalize(os.path.dirname(full_path)), name)
         else:
-          zipfile_obj.extract(name)
+          zipfile_obj.extract(name, curdir)
 
   try:
     subprocess.check_output(
-        [JAR_BIN, 'xf', jar_path], stderr=subprocess.STDOUT)
+        [JAR_BIN, 'xf', jar_path], stderr=subprocess.STDOUT, cwd=curdir)
   except subprocess.CalledProcessError as exc:
     msg = exc.output
     if 'sun.tools.jar.Main.extractFile' in msg and (
@@ -702,8 +719,9 @@ def extract_all_currdir(jar_path, delete_manifest=True):
     zip_obj.testzip()
 
   _force_jar_extract_cwd(jar_path)
-  if delete_manifest and os.path.exists(JAR_MANIFEST_PATH):
-    shutil.rmtree(JAR_MANIFEST_PATH)
+  manifest_path = os.path.join(get_curr_dir(), JAR_MANIFEST_PATH)
+  if delete_manifest and os.path.exists(manifest_path):
+    shutil.rmtree(manifest_path)
 
 
 def report_timing(func):
@@ -711,7 +729,8 @@ def report_timing(func):
   def profileit(*args):
     """Profiler function to capture execution time."""
     time1 = time.time()
-    ret = func(*args)
+    with bp.PROFILER.span(func.func_name, 'function'):
+      ret = func(*args)
     time2 = time.time()
     elapsed = (time2 - time1) * 1000.0
     logging.debug('%s function took %0.3f ms.', func.func_name, elapsed)
@@ -728,8 +747,9 @@ def get_rule_symbol(bld_file_path, build_root, rule_name):
 
 
 def get_dictionary_hash(python_dict):
-  """Returns hash of a python dictionary."""
-  return json.dumps(python_dict, sort_keys=True).__hash__()
+  """Returns hash of a python dictionary, which is stable across runs and
+  machines."""
+  return hashlib.sha1(json.dumps(python_dict, sort_keys=True)).hexdigest()
 
 
 def grep_lines_in_file(file_path, pattern_str):
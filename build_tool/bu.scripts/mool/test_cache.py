@@ -0,0 +1,134 @@
+"""Cache of passed tests.
+
+A passed test job is recorded with a digest of everything it runs with: its
+command lines, the contents of the built test artifact, of its runtime class
+path and of any other file named by its commands, and the environment
+variables tests commonly read. A job whose digest matches its last pass is not
+run again. Only the last pass of every job is kept, in a file under
+BUILD_WORK_DIR which concurrent builds update under a lock, each merging in
+the outcomes recorded by the others.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+import mool.build_file_cache as bfc
+import mool.file_locks as fl
+import mool.file_snapshot as fs
+import mool.shared_utils as su
+
+# Bump this whenever the way tests are run changes in a way that is not
+# visible in their command lists.
+CACHE_FORMAT_VERSION = '1'
+TEST_CACHE_FILE = os.path.join(su.BUILD_WORK_DIR, '.test_results')
+# Environment variables that may change the outcome of a test, besides the
+# ones listed in TEST_CACHE_ENV_VARS.
+ENV_VARS = ['HOME', 'JAVA_HOME', 'LANG', 'LC_ALL', 'LD_LIBRARY_PATH', 'PATH',
+            'PYTHONPATH', 'TZ']
+
+
+class TestCache(object):
+  """Digests of the last passed run of test jobs."""
+  def __init__(self, cache_file=TEST_CACHE_FILE):
+    """Initialize."""
+    self._cache_file = cache_file
+    # Job name -> digest of its last passed run, loaded lazily.
+    self._passes = None
+    # Job name -> digest of the pass recorded since loading, None if the pass
+    # was forgotten.
+    self._changes = {}
+    self._lock = threading.Lock()
+
+  def _read(self):
+    """Read the persisted passes, if any."""
+    if not os.path.exists(self._cache_file):
+      return {}
+    try:
+      return json.loads(su.read_file(self._cache_file))
+    except ValueError as exc:
+      logging.debug('Ignoring corrupt test cache %s: %s', self._cache_file,
+                    exc)
+      return {}
+
+  def _load(self):
+    """Load recorded passes."""
+    with fl.FileLocks([], [self._cache_file + bfc.LOCK_FILE_SUFFIX]):
+      self._passes = self._read()
+
+  @classmethod
+  def get_key(cls, job):
+    """Get digest of everything a test job runs with, None if any of its
+    input files is missing."""
+    key_hash = hashlib.sha1()
+    key_hash.update(CACHE_FORMAT_VERSION)
+    key_hash.update(su.log_normalize(
+        json.dumps(job.command_list, sort_keys=True, default=str)))
+    for file_path in sorted(set(job.input_files)):
+      if not su.path_isfile(file_path):
+        logging.debug('Not caching %s, missing input %s', job.get_name(),
+                      file_path)
+        return None
+      key_hash.update('\n{} {}'.format(su.log_normalize(file_path),
+                                       fs.DIGEST_CACHE.get_digest(file_path)))
+    for env_var in sorted(set(ENV_VARS + su.TEST_CACHE_ENV_VARS)):
+      key_hash.update('\n{}={}'.format(env_var, os.environ.get(env_var, '')))
+    return key_hash.hexdigest()
+
+  def is_passed(self, job, cache_key):
+    """Checks if a job passed the last time it ran with the same digest."""
+    with self._lock:
+      if self._passes is None:
+        self._load()
+      return self._passes.get(job.get_name(), None) == cache_key
+
+  def record(self, job, cache_key, passed):
+    """Record the outcome of a job run. A failed run forgets the last pass,
+    which a flaky test could otherwise keep reporting."""
+    with self._lock:
+      if self._passes is None:
+        self._load()
+      if passed:
+        self._passes[job.get_name()] = cache_key
+      else:
+        self._passes.pop(job.get_name(), None)
+      self._changes[job.get_name()] = cache_key if passed else None
+
+  def forget_rules(self, rule_symbols):
+    """Drop the passes of all the jobs of the given rules."""
+    rule_symbols = set(rule_symbols)
+    with self._lock:
+      if self._passes is None:
+        self._load()
+      for job_name in self._passes.keys():
+        if job_name.split(' ')[0] in rule_symbols:
+          del self._passes[job_name]
+          self._changes[job_name] = None
+
+  def save(self):
+    """Persist the passes recorded since the cache was loaded, merging in the
+    ones recorded by concurrent builds since."""
+    with self._lock:
+      if su.TEST_MODE_EXECUTION or not self._changes:
+        return
+      changes = self._changes
+      self._changes = {}
+    with fl.FileLocks([self._cache_file + bfc.LOCK_FILE_SUFFIX]):
+      passes = self._read()
+      for job_name, cache_key in changes.iteritems():
+        if cache_key is None:
+          passes.pop(job_name, None)
+        else:
+          passes[job_name] = cache_key
+      file_handle, temp_path = tempfile.mkstemp(
+          dir=os.path.dirname(self._cache_file), prefix='.tmp.')
+      try:
+        with os.fdopen(file_handle, 'w') as file_object:
+          json.dump(passes, file_object, sort_keys=True)
+        os.rename(temp_path, self._cache_file)
+      except (IOError, OSError) as exc:
+        logging.debug('Could not save test cache: %s', exc)
+        if os.path.exists(temp_path):
+          os.remove(temp_path)
@@ -0,0 +1,89 @@
+"""Run test processes on behalf of the test runner.
+
+Tests of different rules run concurrently, each thread writing the output of
+its test processes to a stream of its own and enforcing a deadline on them.
+Every test process runs in a process group of its own, so a timeout or an
+interrupted build kills its children too.
+"""
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import mool.shared_utils as su
+
+# Per thread output stream and deadline of the test being run.
+_THREAD_STATE = threading.local()
+
+# Test processes running at the moment, killed when a build is interrupted.
+_TEST_PROCESSES = set()
+_TEST_PROCESSES_LOCK = threading.Lock()
+
+
+class TestTimeoutError(su.Error):
+  """A test ran longer than its timeout."""
+
+
+def set_test_context(output, deadline):
+  """Make the test processes run by this thread write their output to a stream
+  and stop them at a deadline (epoch seconds, None for no limit)."""
+  _THREAD_STATE.test_output = output
+  _THREAD_STATE.test_deadline = deadline
+
+
+def get_test_output():
+  """Get the stream test output of this thread is written to."""
+  return getattr(_THREAD_STATE, 'test_output', None) or sys.stdout
+
+
+def _kill_process_group(process):
+  """Kill a process started in its own process group along with its
+  children."""
+  try:
+    os.killpg(process.pid, signal.SIGKILL)
+  except OSError:
+    pass
+
+
+def run_test_process(command, cwd=None):
+  """Run a test process with its output captured into the test output of this
+  thread. Past the test deadline, the process and all its children are
+  killed and TestTimeoutError is raised."""
+  deadline = getattr(_THREAD_STATE, 'test_deadline', None)
+  # A process group of its own lets a timeout kill the JVM or valgrind child
+  # processes that wrapper scripts start.
+  process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT, preexec_fn=os.setpgrp)
+  with _TEST_PROCESSES_LOCK:
+    _TEST_PROCESSES.add(process)
+  timed_out = []
+  timer = None
+  if deadline is not None:
+    def _on_timeout():
+      """Kill the test process."""
+      timed_out.append(True)
+      _kill_process_group(process)
+    timer = threading.Timer(max(deadline - time.time(), 0), _on_timeout)
+    timer.daemon = True
+    timer.start()
+  try:
+    output_text = process.communicate()[0]
+  finally:
+    if timer:
+      timer.cancel()
+    with _TEST_PROCESSES_LOCK:
+      _TEST_PROCESSES.discard(process)
+  get_test_output().write(output_text)
+  if timed_out:
+    raise TestTimeoutError('Timed out: {}'.format(' '.join(command)))
+  if process.returncode:
+    raise subprocess.CalledProcessError(process.returncode, command)
+
+
+def kill_test_processes():
+  """Kill all the running test processes."""
+  with _TEST_PROCESSES_LOCK:
+    for process in _TEST_PROCESSES:
+      _kill_process_group(process)
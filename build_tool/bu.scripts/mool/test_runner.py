@@ -0,0 +1,211 @@
+"""Test phase of a build.
+
+Tests of the built rules run once all of them are built, on a pool of their
+own workers, longest tests first. The TestNG command of a rule with many test
+classes is split into shards, each running a part of the classes in its own
+JVM. Every test job runs with a wall clock timeout and its output is
+buffered, so that it is printed whole once the job finishes. Jobs which
+passed with the same inputs before are reported from the test cache without
+running them. A summary of all results is printed at the end.
+"""
+import logging
+import os
+import StringIO
+import subprocess
+import sys
+import time
+
+import mool.build_profiler as bp
+import mool.shared_utils as su
+import mool.test_process as tp
+import mool.worker_pool as wp
+
+PASSED = 'PASSED'
+FAILED = 'FAILED'
+TIMED_OUT = 'TIMEOUT'
+
+# Positions of the test classes and result directory in a TestNG command.
+TESTNG_CLASSES_INDEX = 2
+TESTNG_RESULTS_DIR_INDEX = 3
+
+
+class Error(su.Error):
+  """Error class for this module."""
+
+
+class TestJob(object):
+  """Test commands of a rule, or of one shard of its test classes."""
+  def __init__(self, rule_symbol, command_list, timeout, shard=0,
+               num_shards=1, input_files=None):
+    """Initialize."""
+    self.rule_symbol = rule_symbol
+    self.command_list = command_list
+    self.timeout = timeout
+    self.input_files = input_files or []
+    self.shard = shard
+    self.num_shards = num_shards
+
+  def get_name(self):
+    """Get the name of the job for reports."""
+    if self.num_shards == 1:
+      return self.rule_symbol
+    return '{} (shard {}/{})'.format(self.rule_symbol, self.shard + 1,
+                                    self.num_shards)
+
+
+class TestResult(object):
+  """Outcome of a test job."""
+  def __init__(self, job, status, duration, output, cached=False):
+    """Initialize."""
+    self.job = job
+    self.status = status
+    self.duration = duration
+    self.output = output
+    self.cached = cached
+
+  def get_status_text(self):
+    """Get the status for reports."""
+    if self.cached:
+      return '(cached) {}'.format(self.status)
+    return self.status
+
+
+def _shard_testng_command(command, shard_size):
+  """Split a TestNG runner command into commands running at most shard_size
+  test classes each. Every shard gets its own result directory."""
+  test_classes = command[TESTNG_CLASSES_INDEX]
+  num_shards = (len(test_classes) + shard_size - 1) / shard_size
+  if num_shards <= 1:
+    return [command]
+  shards = []
+  for index in xrange(num_shards):
+    shard_command = list(command)
+    # Dealing the classes out keeps the shards of similar size.
+    shard_command[TESTNG_CLASSES_INDEX] = test_classes[index::num_shards]
+    shard_command[TESTNG_RESULTS_DIR_INDEX] = os.path.join(
+        command[TESTNG_RESULTS_DIR_INDEX], 'shard{}'.format(index))
+    shards.append(shard_command)
+  return shards
+
+
+def get_test_jobs(rule_symbol, command_list, timeout, shard_size,
+                  input_files=None):
+  """Get the test jobs of a rule. A rule tested by a single TestNG command is
+  sharded by its test classes."""
+  if ((shard_size and len(command_list) == 1 and
+       command_list[0][0] == su.JAVA_TESTNG_RUNNER)):
+    shards = _shard_testng_command(command_list[0], shard_size)
+    return [TestJob(rule_symbol, [c], timeout, i, len(shards), input_files)
+            for i, c in enumerate(shards)]
+  return [TestJob(rule_symbol, command_list, timeout,
+                  input_files=input_files)]
+
+
+def _run_job(job, run_commands):
+  """Run the commands of a test job on this thread with their output
+  buffered."""
+  output = StringIO.StringIO()
+  start_time = time.time()
+  deadline = start_time + job.timeout if job.timeout else None
+  tp.set_test_context(output, deadline)
+  try:
+    with bp.PROFILER.span(job.get_name(), 'test'):
+      run_commands(job.command_list)
+    status = PASSED
+  except tp.TestTimeoutError as error_obj:
+    output.write('{} after {} seconds\n'.format(
+        su.log_normalize(str(error_obj)), job.timeout))
+    status = TIMED_OUT
+  except subprocess.CalledProcessError as error_obj:
+    output.write('Failed with exit code {}: {}\n'.format(
+        error_obj.returncode,
+        ' '.join([su.log_normalize(x) for x in error_obj.cmd])))
+    status = FAILED
+  finally:
+    tp.set_test_context(None, None)
+  return TestResult(job, status, time.time() - start_time, output.getvalue())
+
+
+def _run_or_reuse_job(job, run_commands, test_cache, use_cached):
+  """Run a test job unless it passed with the same inputs before, recording
+  its outcome in the test cache."""
+  cache_key = test_cache.get_key(job) if test_cache else None
+  if use_cached and cache_key and test_cache.is_passed(job, cache_key):
+    return TestResult(job, PASSED, 0, '', cached=True)
+  result = _run_job(job, run_commands)
+  if cache_key:
+    test_cache.record(job, cache_key, result.status == PASSED)
+  return result
+
+
+def _print_result(result):
+  """Print the output of a finished test job."""
+  if result.cached:
+    logging.info('-----\n%s %s', result.get_status_text(),
+                 result.job.get_name())
+    return
+  logging.info('-----\n%s %s (%.2fs)', result.status, result.job.get_name(),
+               result.duration)
+  if result.output:
+    sys.stdout.write(result.output)
+    sys.stdout.flush()
+
+
+def run_tests(jobs, num_jobs, run_commands, test_cache=None,
+              use_cached=True):
+  """Run test jobs in the given order on a pool of num_jobs workers, printing
+  the output of each job as soon as it finishes. Outcomes are recorded in the
+  test cache if one is given, and passes found in it are reused unless
+  use_cached is False. Returns the results in the order of jobs."""
+  results = [None] * len(jobs)
+
+  def _run(index):
+    """Run a job on a worker."""
+    results[index] = _run_or_reuse_job(jobs[index], run_commands, test_cache,
+                                       use_cached)
+
+  pool = wp.WorkerPool(num_jobs)
+  next_index = 0
+  try:
+    while next_index < len(jobs) or pool.in_flight():
+      while next_index < len(jobs) and pool.in_flight() < num_jobs:
+        pool.submit(next_index, _run, next_index)
+        next_index += 1
+      index, exc_info = pool.wait_one()
+      if exc_info:
+        pool.drain()
+        wp.reraise(exc_info)
+      _print_result(results[index])
+  finally:
+    # Only interrupted builds and internal errors leave tests running.
+    tp.kill_test_processes()
+    pool.close()
+    if test_cache:
+      test_cache.save()
+  return results
+
+
+def get_summary(results, wall_time):
+  """Get the summary of all test results, failures last."""
+  order = {PASSED: 0, TIMED_OUT: 1, FAILED: 2}
+  lines = ['Test summary:']
+  for result in sorted(results, key=lambda r: (order[r.status],
+                                                r.job.get_name())):
+    lines.append('  {:15} {:8.2f}s  {}'.format(
+        result.get_status_text(), result.duration, result.job.get_name()))
+  counts = dict([(s, len([r for r in results if r.status == s]))
+                 for s in order])
+  lines.append(
+      ('{} passed ({} cached), {} failed, {} timed out in {:.2f}s ({:.2f}s of '
+       'tests)').format(counts[PASSED], len([r for r in results if r.cached]),
+                        counts[FAILED], counts[TIMED_OUT], wall_time,
+                        sum([r.duration for r in results])))
+  return '\n'.join(lines)
+
+
+def check_results(results):
+  """Raise an error naming the failed test jobs, if any."""
+  failed = [r.job.get_name() for r in results if r.status != PASSED]
+  if failed:
+    raise Error('{} of {} test(s) failed: {}'.format(
+        len(failed), len(results), ', '.join(failed)))
@@ -25,7 +25,7 @@ def assert_check_services(cpp_files):
   cpp files. This check ensures that we parsed all the service names correctly
   from thrift source file."""
   cpp_files = [os.path.basename(cpp_file) for cpp_file in cpp_files[0]]
-  gen_files = [f for f in os.listdir('.')
+  gen_files = [f for f in os.listdir(su.get_curr_dir())
                if f.endswith('.cpp') and not f.endswith(SKELETON_FILE_SUFFIX)]
   if not sorted(gen_files) == sorted(cpp_files):
     msg = ('Expected list of cpp files: {}\nGenerated list of cpp files: {}\n'
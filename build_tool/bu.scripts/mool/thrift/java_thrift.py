@@ -4,6 +4,7 @@ import logging
 import os
 import subprocess
 
+import mool.compile_server as cs
 import mool.java_common as jc
 import mool.shared_utils as su
 import mool.thrift.thrift_common as tc
@@ -16,11 +17,15 @@ def compile_thrift_generated(params):
   compile_libs = [os.path.join(rule_details[su.WDIR_CLSDEPS_KEY], '*')]
   java_namespace = tc.ThriftCommon.get_lang_namespace('java', rule_details)
   src_dir = os.path.sep.join(java_namespace.split('.'))
-  java_src_files = glob.glob('%s/*.java' % src_dir)
+  curr_dir = su.get_curr_dir()
+  java_src_files = [
+      os.path.relpath(f, curr_dir)
+      for f in glob.glob(os.path.join(curr_dir, src_dir, '*.java'))]
   compile_command = jc.get_java_compile_command(
       rule_details, compile_libs, rule_details[su.JAVAC_OUTDIR_KEY],
       java_src_files, False)
-  subprocess.check_call(compile_command)
+  if not cs.COMPILE_SERVER.run(compile_command, curr_dir):
+    subprocess.check_call(compile_command, cwd=curr_dir)
 
 
 class JavaThriftLibrary(tc.ThriftCommon):
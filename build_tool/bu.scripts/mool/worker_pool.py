@@ -0,0 +1,101 @@
+"""Thread pool used for running independent build steps in parallel."""
+import logging
+import Queue
+import sys
+import threading
+
+
+class WorkerPool(object):
+  """Fixed size pool of worker threads sharing one completion queue.
+
+  Work items are submitted with a key and are picked up by the first free
+  worker. The caller collects finished items one at a time with wait_one,
+  which returns the key along with the exception info of a failed item. With a
+  single worker the items are executed inline on submission, so sequential
+  builds behave exactly as they would without a pool.
+  """
+  def __init__(self, num_workers):
+    """Initialize."""
+    assert num_workers >= 1
+    self._num_workers = num_workers
+    self._work_queue = Queue.Queue()
+    self._done_queue = Queue.Queue()
+    self._in_flight = 0
+    self._threads = []
+    if num_workers > 1:
+      for index in xrange(num_workers):
+        thread = threading.Thread(target=self._worker_loop,
+                                  name='bu-worker-{}'.format(index))
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+  @classmethod
+  def _execute(cls, func, args):
+    """Execute a work item and return its exception info, if any."""
+    try:
+      func(*args)
+    except:
+      return sys.exc_info()
+    return None
+
+  def _worker_loop(self):
+    """Main loop of a worker thread."""
+    while True:
+      item = self._work_queue.get()
+      if item is None:
+        return
+      key, func, args = item
+      self._done_queue.put((key, self._execute(func, args)))
+
+  def submit(self, key, func, *args):
+    """Submit a work item identified by key."""
+    self._in_flight += 1
+    if self._threads:
+      self._work_queue.put((key, func, args))
+    else:
+      self._done_queue.put((key, self._execute(func, args)))
+
+  def num_workers(self):
+    """Number of items that can execute concurrently."""
+    return self._num_workers
+
+  def in_flight(self):
+    """Number of submitted items that have not been collected yet."""
+    return self._in_flight
+
+  def wait_one(self):
+    """Wait for a submitted item to finish. Returns (key, exc_info)."""
+    assert self._in_flight > 0
+    # A timeout keeps the main thread responsive to KeyboardInterrupt.
+    while True:
+      try:
+        result = self._done_queue.get(True, 1)
+        break
+      except Queue.Empty:
+        continue
+    self._in_flight -= 1
+    return result
+
+  def drain(self):
+    """Wait for all in-flight items, returning the exception infos seen."""
+    errors = []
+    while self._in_flight:
+      key, exc_info = self.wait_one()
+      if exc_info:
+        logging.debug('Discarding failure of %s during abort.', key)
+        errors.append(exc_info)
+    return errors
+
+  def close(self):
+    """Stop all the worker threads."""
+    for _ in self._threads:
+      self._work_queue.put(None)
+    for thread in self._threads:
+      thread.join()
+    self._threads = []
+
+
+def reraise(exc_info):
+  """Re-raise an exception captured in a worker with its traceback."""
+  raise exc_info[0], exc_info[1], exc_info[2]
@@ -18,4 +18,4 @@ for FF in $(find . -type f -name '*.py'); do
   pep8 --max-line-length=80 --ignore=E111 ${FF}
 done
 
-py.test -s unit_tests/build_utils_test.py
+py.test -s unit_tests
@@ -0,0 +1 @@
+"""Unit tests of mool and its extensions."""
@@ -0,0 +1,39 @@
+"""Unit tests for action_cache."""
+import mool.action_cache as ac
+import mool.shared_utils as su
+
+
+def test_action_cache(monkeypatch, tmpdir):
+  """Test storing, restoring and evicting rule outputs in action cache."""
+  out_dir = tmpdir.mkdir('out')
+  monkeypatch.setattr(su, 'BUILD_OUT_DIR', str(out_dir))
+  src_file = tmpdir.join('Source.java')
+  src_file.write('class Source {}')
+  out_file = out_dir.join('some', 'Source.jar')
+  rule_details = {su.SYMBOL_KEY: 'mool.some.Source', su.OUT_KEY: str(out_file)}
+  file_list = [str(src_file), str(out_file)]
+  command_list = [['javac', 'Source.java'], ['jar', 'cf', 'Source.jar']]
+  cache = ac.ActionCache(str(tmpdir.join('cache')), 1024)
+  cache_key = cache.get_key(rule_details, file_list, command_list)
+  assert not cache.restore(cache_key, rule_details)
+  out_file.write('jar contents', ensure=True)
+  cache.store(cache_key, rule_details)
+  out_file.remove()
+  assert cache.restore(cache_key, rule_details)
+  assert 'jar contents' == out_file.read()
+  # Changed input contents or commands lead to a different key.
+  src_file.write('class Source { int x; }')
+  assert cache_key != cache.get_key(rule_details, file_list, command_list)
+  assert cache_key != cache.get_key(rule_details, file_list, command_list[1:])
+  # Entries above the size limit are evicted at the end of the build.
+  out_file.write('x' * 2048)
+  big_key = cache.get_key(rule_details, file_list, command_list)
+  cache.store(big_key, rule_details)
+  assert cache.restore(big_key, rule_details)
+  cache.close()
+  assert not cache.restore(big_key, rule_details)
+  # Once the cache size is known, they are evicted as soon as they are stored.
+  src_file.write('class Source { int y; }')
+  big_key = cache.get_key(rule_details, file_list, command_list)
+  cache.store(big_key, rule_details)
+  assert not cache.restore(big_key, rule_details)
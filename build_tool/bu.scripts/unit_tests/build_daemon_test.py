@@ -0,0 +1,76 @@
+"""Unit tests for build_daemon and the rule builders it keeps."""
+import os
+import StringIO
+import subprocess
+import threading
+
+import mool.build_daemon as bd
+import mool.rule_builder as rb
+import mool.shared_utils as su
+import unit_tests.mock_utils as mu
+
+
+def test_build_daemon(monkeypatch, tmpdir):
+  """Test running commands through build server."""
+  def _run_func(cmd_line):
+    """Fake command runner writing to stdout like build commands do."""
+    subprocess.check_call(['echo', 'running'] + cmd_line)
+    return len(cmd_line)
+
+  socket_path = str(tmpdir.join('bu.sock'))
+  monkeypatch.setattr(bd, 'get_socket_path', lambda: socket_path)
+  assert bd.run_client(['do_build']) is None
+  server = bd.BuildServer(socket_path, _run_func, 60)
+  server.bind()
+  thread = threading.Thread(target=server.serve)
+  thread.daemon = True
+  thread.start()
+  output = StringIO.StringIO()
+  assert 2 == bd.run_client(['do_build', 'mool.rule'], output)
+  assert 'running do_build mool.rule\n' == output.getvalue()
+  # Clients running different bu sources fall back to in-process builds and
+  # the stale server shuts down.
+  monkeypatch.setattr(bd, 'get_code_stamp', lambda: 'changed')
+  assert bd.run_client(['do_build']) is None
+  thread.join(10)
+  assert not thread.is_alive()
+  assert not os.path.exists(socket_path)
+
+
+def test_rule_builder_cache(monkeypatch):
+  """Test that kept rule builders are used again, with only the rules of
+  changed BLD files or missing maven jars loaded again."""
+  mu.patch_os(monkeypatch, mu.get_filesystem_dict(), [])
+  monkeypatch.setattr(su, 'TEST_MODE_EXECUTION', True)
+  file_stamps = {}
+  monkeypatch.setattr(rb, '_get_file_stamp', file_stamps.get)
+  rules = ['mool.cc.samples.factorial_test', 'mool.cc.common.echo_utils_test']
+  cache = rb.RuleBuilderCache()
+  assert cache.get(rules) is not cache.get(rules)
+  cache.enable(1)
+  builder = cache.get(rules)
+  builder.setup_rules()
+  assert builder is cache.get(list(reversed(rules)))
+  assert not builder.get_changed_rule_files()
+  rules_map = dict(builder.get_rules_map())
+  rule_file = os.path.join(su.BUILD_ROOT, 'cc', 'samples', 'BLD')
+  file_stamps[rule_file] = (1.0, 1)
+  assert [rule_file] == builder.get_changed_rule_files()
+  assert builder is cache.get(rules)
+  assert not builder.get_changed_rule_files()
+  assert rules_map['mool.cc.common.echo_utils'] is (
+      builder.get_rules_map()['mool.cc.common.echo_utils'])
+  assert rules_map['mool.cc.samples.factorial'] is not (
+      builder.get_rules_map()['mool.cc.samples.factorial'])
+  java_rules = ['mool.src.main.java.some.work.LibThatIncludesAMavenDep']
+  java_builder = cache.get(java_rules)
+  java_builder.setup_rules()
+  assert builder is not cache.get(rules)
+  assert java_builder is not cache.get(java_rules)
+  java_builder = cache.get(java_rules)
+  java_builder.setup_rules()
+  monkeypatch.setattr(su, 'path_exists', lambda _: False)
+  assert [os.path.join(su.BUILD_ROOT, 'src', 'main', 'java', 'some', 'work',
+                       'BLD')] == java_builder.get_changed_rule_files()
+  cache.clear()
+  assert java_builder is not cache.get(java_rules)
@@ -0,0 +1,36 @@
+"""Unit tests for build_file_cache."""
+import os
+
+import mool.build_file_cache as bfc
+
+
+def test_build_file_cache(tmpdir):
+  """Test BLD files are parsed again only after they change."""
+  build_file = tmpdir.join('BLD')
+  build_file.write('"lib": {"rule_type": "java_lib", "deps": [":x"]}')
+  index_file = str(tmpdir.join('.bld_index'))
+  cache = bfc.BuildFileCache(index_file)
+  rules = cache.get(str(build_file))
+  rules['lib']['deps'].append('modified by caller')
+  assert {'rule_type': 'java_lib', 'deps': [':x']} == (
+      cache.get(str(build_file))['lib'])
+  cache.save()
+  # A new process loads parsed BLD files from the index.
+  other_cache = bfc.BuildFileCache(index_file)
+  assert rules.keys() == other_cache.get(str(build_file)).keys()
+  assert {'hits': 1, 'misses': 0} == other_cache.pop_stats()
+  build_file.write('"lib": {"rule_type": "java_bin"}')
+  os.utime(str(build_file), (0, 0))
+  assert {'rule_type': 'java_bin'} == other_cache.get(str(build_file))['lib']
+  assert {'hits': 0, 'misses': 1} == other_cache.pop_stats()
+  assert {'hits': 1, 'misses': 1} == cache.pop_stats()
+  # Concurrent processes keep the BLD files parsed by each other.
+  other_file = tmpdir.mkdir('other').join('BLD')
+  other_file.write('"bin": {"rule_type": "cc_bin"}')
+  cache.get(str(other_file))
+  cache.save()
+  other_cache.save()
+  new_cache = bfc.BuildFileCache(index_file)
+  new_cache.get(str(build_file))
+  new_cache.get(str(other_file))
+  assert {'hits': 2, 'misses': 0} == new_cache.pop_stats()
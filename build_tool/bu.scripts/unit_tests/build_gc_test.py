@@ -0,0 +1,71 @@
+"""Unit tests for build_gc."""
+import os
+import time
+
+import mool.build_gc as bg
+import mool.shared_utils as su
+
+
+def test_build_gc(monkeypatch, tmpdir):
+  """Test deleting files of removed rules and evicting unused rules."""
+  def _make_rule(rel_dir, out_files=()):
+    """Create the working directory of a rule and its output files."""
+    working_dir = work_dir.join(rel_dir)
+    working_dir.ensure(su.CACHE_FILE_NAME)
+    working_dir.ensure('classes', 'A.class').write('x' * 100)
+    for out_file in out_files:
+      out_dir.ensure(out_file).write('y' * 10)
+    return str(working_dir), [str(out_dir.join(f)) for f in out_files]
+
+  root_dir, work_dir, out_dir = [tmpdir.mkdir(d) for d in ['root', 'work',
+                                                           'out']]
+  for var, path in [('BUILD_ROOT', root_dir), ('BUILD_WORK_DIR', work_dir),
+                    ('BUILD_OUT_DIR', out_dir)]:
+    monkeypatch.setattr(su, var, str(path))
+  root_dir.ensure('pkg', su.BUILD_FILE_NAME)
+  ledger_file = str(work_dir.join('.gc_ledger'))
+  ledger = bg.BuildLedger(ledger_file)
+  lib_dir, lib_outs = _make_rule(os.path.join('pkg', 'lib'), ['pkg/lib.jar'])
+  ledger.record('mool.pkg.lib', lib_dir, lib_outs)
+  assert 110 == ledger.get_entries()['mool.pkg.lib'][bg.SIZE_INDEX]
+  old_dir, old_outs = _make_rule(os.path.join('pkg', 'old'), ['pkg/old.jar'])
+  ledger.record('mool.pkg.old', old_dir, old_outs)
+  # Working directories of rules in subdirectories nest in those of others.
+  nested_dir = _make_rule(os.path.join('pkg', 'old', 'sub'))[0]
+  # Rules built before the ledger was kept are found by their snapshots.
+  gone_dir = _make_rule(os.path.join('gone', 'bin'), ['gone/gen/bin'])[0]
+  work_dir.ensure('.locks', 'mool.gone.bin')
+  # Rules of unreadable BLD files are kept.
+  broken_dir = _make_rule(os.path.join('broken', 'lib'))[0]
+  deleted_rules, deleted_bytes = bg.remove_deleted_rules(
+      ledger, ['mool.pkg.lib', 'mool.pkg.old.sub'], ['mool.broken'])
+  assert ['mool.gone.bin', 'mool.pkg.old'] == deleted_rules
+  assert 220 == deleted_bytes
+  assert not [p for p in [gone_dir] + old_outs if os.path.exists(p)]
+  assert ['sub'] == os.listdir(old_dir)
+  assert os.path.exists(broken_dir) and os.path.exists(nested_dir)
+  assert not work_dir.join('gone').exists()
+  assert not out_dir.join('gone').exists()
+  assert ['mool.pkg.lib'] == ledger.get_entries().keys()
+  assert (['mool.pkg.old.sub'], 100) == bg.remove_deleted_rules(
+      ledger, ['mool.pkg.lib'], ['mool.broken'])
+  assert not work_dir.join('pkg', 'old').exists()
+  ledger.save()
+  # Concurrent builds keep their records, but not those of deleted rules.
+  other_ledger = bg.BuildLedger(ledger_file)
+  time.sleep(0.01)
+  new_dir, new_outs = _make_rule(os.path.join('pkg', 'new'), ['pkg/new.jar'])
+  other_ledger.record('mool.pkg.new', new_dir, new_outs)
+  other_ledger.save()
+  ledger = bg.BuildLedger(ledger_file)
+  assert ['mool.pkg.lib', 'mool.pkg.new'] == sorted(ledger.get_entries())
+  assert (0, 0) == bg.evict(ledger, 220)
+  # The least recently used rule goes first, unless the build is using it.
+  assert (1, 110) == bg.evict(ledger, 110)
+  assert not os.path.exists(lib_dir) and not os.path.exists(lib_outs[0])
+  assert os.path.exists(new_dir)
+  ledger.record('mool.pkg.lib', *_make_rule(os.path.join('pkg', 'lib'),
+                                            ['pkg/lib.jar']))
+  assert (1, 110) == bg.evict(ledger, 110, ['mool.pkg.new'])
+  assert os.path.exists(new_dir) and not os.path.exists(lib_dir)
+  assert ['mool.pkg.new'] == ledger.get_entries().keys()
@@ -0,0 +1,32 @@
+"""Unit tests for build_metrics and bu stats."""
+import extensions.build_stats as bs_ext
+import mool.build_metrics as bm
+
+
+def test_build_metrics(monkeypatch, tmpdir):
+  """Test build metrics store and reports."""
+  metrics_file = str(tmpdir.join('metrics'))
+  monkeypatch.setattr(bm, 'MAX_RUNS', 3)
+  built, cached = bm.STATUS_BUILT, bm.STATUS_CACHED
+  for lib_time, test_time in [(9.0, 1.0), (2.0, 1.0), (3.0, 1.0), (2.5, 1.0),
+                              (2.0, 1.0), (3.0, 5.0)]:
+    bm.save_run({'mool.lib': [built, lib_time, 0, 100, 3],
+                 'mool.test': [built, 0.5, test_time, 10, 2]}, 4, 10.0,
+                metrics_file)
+  runs = bm.load_runs(metrics_file)
+  assert 6 == len(runs)
+  assert {'mool.lib': 2.5, 'mool.test': 0.5} == bm.get_past_durations(runs)
+  assert {'mool.test': 1.0} == bm.get_past_test_durations(runs)
+  assert [('mool.lib', 3.0, 6), ('mool.test', 1.5, 6)] == (
+      bs_ext.get_slowest_rules(runs, 2))
+  assert [('mool.test', 1.5, 5.5), ('mool.lib', 2.5, 3.0)] == (
+      bs_ext.get_regressed_rules(runs, 5))
+  assert [('mool.lib', 2), ('mool.test', 2)] == (
+      bs_ext.get_rebuilt_rules(runs, runs[-2:], 5))
+  assert 'Most often rebuilt' in bs_ext.get_report(runs, 20, 5)
+  # The oldest builds are dropped once the store has doubled.
+  bm.save_run({'mool.lib': [cached, 0.1, 0, 100, 1]}, 5, 1.0, metrics_file)
+  runs = bm.load_runs(metrics_file)
+  assert 3 == len(runs)
+  assert {bm.STATUS_UP_TO_DATE: 13, cached: 1, built: 4} == (
+      bs_ext.get_cache_stats(runs))
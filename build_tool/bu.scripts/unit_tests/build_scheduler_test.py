@@ -0,0 +1,33 @@
+"""Unit tests for build_scheduler."""
+import mool.build_scheduler as bs
+import mool.rule_graph as rg
+import mool.shared_utils as su
+
+
+def test_build_scheduler_order():
+  """Test ready queue ordering by critical path length."""
+  def _rule(symbol, deps, weight=None):
+    """Create minimal rule details."""
+    details = {su.SYMBOL_KEY: symbol, su.DEPS_KEY: deps,
+               su.COMPILE_DEPS_KEY: []}
+    if weight:
+      details[su.RULE_WEIGHT_KEY] = weight
+    return (symbol, details)
+
+  rules_map = dict([
+      _rule('mool.a.leaf', []), _rule('mool.a.lib', ['mool.a.leaf']),
+      _rule('mool.a.uber', ['mool.a.lib'], 'heavy'),
+      _rule('mool.b.small', []), _rule('mool.b.test', ['mool.b.small'])])
+  rule_costs = dict([(r, bs.get_rule_cost(d, {'mool.b.small': 0.5}))
+                     for (r, d) in rules_map.iteritems()])
+  scheduler = bs.BuildScheduler(rg.RuleGraph(rules_map), rule_costs)
+  assert 12.0 == scheduler.get_priority('mool.a.leaf')
+  assert 1.5 == scheduler.get_priority('mool.b.small')
+  build_order = []
+  while not scheduler.done():
+    rule_symbol = scheduler.pop_ready()
+    build_order.append(rule_symbol)
+    scheduler.mark_done(rule_symbol)
+  # The chain ending in the heavy rule is started first.
+  assert ['mool.a.leaf', 'mool.a.lib', 'mool.a.uber', 'mool.b.small',
+          'mool.b.test'] == build_order
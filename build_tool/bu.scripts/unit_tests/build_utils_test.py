@@ -4,267 +4,39 @@ The test methodology for this project is based on end-to-end strategy. Once the
 project starts looking more stable, we can consider adding unit tests for each
 of the rule classes.
 """
+import json
 import os
 
-THIS_SCRIPT_DIR = os.path.join(os.environ['BU_SCRIPT_DIR'], 'unit_tests')
-# We need to override the environment variables before loading the shared_utils
-# module.
-MOCKED_ENVIRONS = ('BUILD_OUT_DIR', 'BUILD_ROOT', 'BUILD_WORK_DIR',
-                   'BU_SCRIPT_DIR', 'CC_COMPILER', 'CC_INSTALL_PREFIX',
-                   'GTEST_MAIN_LIB', 'GTEST_MOCK_LIB', 'JAR_SEARCH_PATH',
-                   'JAVA_HOME', 'PEP8_BINARY', 'PROTO_COMPILER',
-                   'PYTHON_PROTOBUF_DIR', 'BOOST_DIR', 'THRIFT_DIR')
-os.environ = dict([(k, 'TEST_{}'.format(k)) for k in MOCKED_ENVIRONS])
-os.environ['JAVA_COMPILER'] = 'TEST_JAVA_HOME/bin/javac -Xlint'
-os.environ['JAVA_TEST_DEFAULT_JARS'] = 'test_default1.jar test_default2.jar'
-os.environ['JAVA_PROTOBUF_JAR'] = 'test_java_protobuf.jar'
-os.environ['JAVA_DEFAULT_VERSION'] = 'bad_version'
-os.environ['VALGRIND_PREFIX'] = 'TEST_VALGRIND_PREFIX TEST_VALGRIND_PARAMS'
-
-import shutil
-import subprocess
-
+import mool.build_profiler as bp
 import mool.build_utils as bu
 import mool.core_cmds as cc
-import mool.jar_merger as jm
-import mool.jar_testng_runner as jtr
-import mool.java_common as jc
-import mool.python_common as pc
-import mool.release_package as rp
+import mool.file_snapshot as fs
 import mool.shared_utils as su
+import unit_tests.mock_utils as mu
 
 from functools import partial
 
-TEST_RESOURCES = (su.BUILD_FILE_NAME, su.SUBMIT_QUEUE_FILE_NAME)
 OVERWRITE_TEST_RESOURCE = False
 
 
-def _get_test_resource_file(file_name):
-  """Convert file name to test resource file path."""
-  return os.path.join(THIS_SCRIPT_DIR, 'test_data', file_name)
-
-
-def _read_test_resource(file_name):
-  """Read text from test resource."""
-  file_path = _get_test_resource_file(file_name)
-  with open(file_path, 'r') as file_object:
-    return file_object.read()
-
-
 def _write_test_resource(file_name, file_text):
   """Write text to test resource in development mode."""
   print file_text
   if not OVERWRITE_TEST_RESOURCE:
     return
-  file_path = _get_test_resource_file(file_name)
+  file_path = mu.get_test_resource_file(file_name)
   with open(file_path, 'w') as file_object:
     file_object.write(file_text)
 
 
-def _mock_do_merge(command_list, lib_details, jar_out_file, main_class):
-  """Mock implementation of jar merger utility."""
-  command_list.append(['mock_jar_merger',
-                       str([lib_details, jar_out_file, main_class])])
-
-
-def _mock_extract_jar(command_list, jar_path):
-  """Mock the extraction of files, used in file collection"""
-  command_list.append(['mock_extract_jar', jar_path])
-
-
-def _mock_exists(filesystem_dict, command_list, file_path):
-  """Check if a path exists."""
-  command_list.append(['mock_ls', file_path])
-  if file_path.startswith('TEST_JAR_SEARCH_PATH' + os.sep):
-    return True
-  if file_path in ('TEST_GTEST_MAIN_LIB', 'TEST_GTEST_MOCK_LIB'):
-    return True
-  return file_path in filesystem_dict
-
-
-def _mock_isfile(filesystem_dict, command_list, file_path):
-  """Check if a path is a file."""
-  command_list.append(['mock_isfile', file_path])
-  return file_path in filesystem_dict
-
-
-def _mock_isdir(filesystem_dict, command_list, dir_path):
-  """Check if a directory exists."""
-  command_list.append(['mock_isdir', dir_path])
-  return dir_path in filesystem_dict
-
-
-def _mock_check_dirname(filesystem_dict, dir_name):
-  """Check if a dirname is valid."""
-  return dir_name in filesystem_dict
-
-
-def _mock_makedirs(command_list, dir_path):
-  """Make directory recursively."""
-  command_list.append(['mock_mkdir', '-p', dir_path])
-
-
-def _mock_rmtree(command_list, dir_path):
-  """Remove directory recursively."""
-  command_list.append(['mock_rmtree', dir_path])
-
-
-def _mock_oslistdir(dir_path):
-  """List current directory."""
-  return [os.path.join(dir_path, 'mock_file1'),
-          os.path.join(dir_path, 'mock_file2')]
-
-
-def _mock_osremove(command_list, file_path):
-  """Mock remove file path entry."""
-  command_list.append(['mock_remove', file_path])
-
-
-def _mock_chdir(command_list, dir_path):
-  """Change current directory."""
-  command_list.append(['mock_cd', dir_path])
-
-
-def _mock_download_cached_item(command_list, url, file_path):
-  """Download item from URL."""
-  command_list.append(['mock_download_cached_item', url, file_path])
-
-
-def _mock_check_call(command_list, command, **kargs):
-  """Mock command line command."""
-  mock_cmd = list(command)
-  mock_cmd.extend(['{}:{}'.format(k, v) for k, v in kargs.iteritems()])
-  command_list.append(mock_cmd)
-
-
-def _mock_read_file(filesystem_dict, command_list, file_path):
-  """Mock file system reads."""
-  assert file_path in filesystem_dict
-  command_list.append(['mock_cat', file_path])
-  return filesystem_dict[file_path]
-
-
-def _mock_write_file(command_list, file_path, file_text):
-  """Mock file system writes."""
-  file_text = file_text.replace('\n', '\\n')
-  command_list.append(['mock_write', file_path, '"{}"'.format(file_text)])
-
-
-def _mock_python_compile_all(command_list, params):
-  """Mock python compiler step."""
-  command_list.append(['mock_python_compile_all', str(params)])
-
-
-def _mock_python_expand_lib(command_list, params):
-  """Mock python expand linked library in place."""
-  command_list.append(['mock_python_expand_lib', str(params)])
-
-
-def _mock_py_create_initializers(command_list, params):
-  """Mock python create_initializers call."""
-  command_list.append(['create_initializers', str(params)])
-
-
-def _mock_coding_guidelines_check(command_list, params):
-  """Mock additional python coding guidelines check."""
-  command_list.append(['mock_coding_guidelines_check', str(params)])
-
-
-def _mock_python_perform_linking(command_list, command_parts):
-  """Mock python linking step."""
-  command_list.append(['mock_python_perform_linking', str(command_parts)])
-
-
-def _mock_zip_all_currdir(command_list, command_parts):
-  """Mock python linking step."""
-  command_list.append(['mock_zip_all_currdir', str(command_parts)])
-
-
-def _mock_compare_java_version(command_list, rule_version, dep_version):
-  """Mock java version comparison check."""
-  command_list.append(['mock_java_version_comparison', rule_version,
-                       dep_version])
-  return True
-
-
-def _mock_check_jar_collisions(command_list, jar_list):
-  """Mock jar collision testing."""
-  mock_cmd = ['mock_check_jar_collisions']
-  mock_cmd.extend(jar_list)
-  command_list.append(mock_cmd)
-
-
-def _mock_extract_files_from_jars(command_list, work_dir, jar_list):
-  """Mock jar extraction in working directory."""
-  mock_cmd = ['mock_extract_files_from_jars', work_dir]
-  mock_cmd.extend(jar_list)
-  command_list.append(mock_cmd)
-
-
-def _mock_export_mvn_deps(command_list, command_parts):
-  """Mock export mvn dependencies."""
-  command_list.append(['mock_export_mvn_deps', str(command_parts)])
-
-
-def _patch_os(monkeypatch, filesystem_dict, command_list):
-  """Apply monkeypatch on system libraries."""
-  monkeypatch.setattr(su, 'path_exists',
-                      partial(_mock_exists, filesystem_dict, command_list))
-  monkeypatch.setattr(su, 'path_isfile',
-                      partial(_mock_isfile, filesystem_dict, command_list))
-  monkeypatch.setattr(os.path, 'isdir',
-                      partial(_mock_isdir, filesystem_dict, command_list))
-  monkeypatch.setattr(os, 'makedirs', partial(_mock_makedirs, command_list))
-  monkeypatch.setattr(os, 'chdir', partial(_mock_chdir, command_list))
-  monkeypatch.setattr(os, 'listdir', _mock_oslistdir)
-  monkeypatch.setattr(os, 'remove', partial(_mock_osremove, command_list))
-  monkeypatch.setattr(shutil, 'rmtree', partial(_mock_rmtree, command_list))
-  monkeypatch.setattr(subprocess, 'check_call',
-                      partial(_mock_check_call, command_list))
-  monkeypatch.setattr(bu, 'SHOW_ERRORS', False)
-
-  monkeypatch.setattr(jc, 'compare_java_versions',
-                      partial(_mock_compare_java_version, command_list))
-  monkeypatch.setattr(jc, 'export_mvn_deps',
-                      partial(_mock_export_mvn_deps, command_list))
-  monkeypatch.setattr(jm, 'do_merge', partial(_mock_do_merge, command_list))
-  monkeypatch.setattr(jm, 'check_jar_collisions',
-                      partial(_mock_check_jar_collisions, command_list))
-  monkeypatch.setattr(jtr, '_extract_files_from_jars',
-                      partial(_mock_extract_files_from_jars, command_list))
-  monkeypatch.setattr(su, 'extract_all_currdir',
-                      partial(_mock_extract_jar, command_list))
-  monkeypatch.setattr(su, 'DUMMY_CC', 'DUMMY_CC_FILE')
-  monkeypatch.setattr(su, 'check_dirname',
-                      partial(_mock_check_dirname, filesystem_dict))
-  monkeypatch.setattr(su, 'read_file',
-                      partial(_mock_read_file, filesystem_dict, command_list))
-  monkeypatch.setattr(su, 'write_file',
-                      partial(_mock_write_file, command_list))
-  monkeypatch.setattr(su, 'lock_working_dir', lambda: None)
-  monkeypatch.setattr(su, 'needs_build', lambda _, __, ___: True)
-  monkeypatch.setattr(su, 'release_working_dir', lambda _: None)
-  monkeypatch.setattr(su, 'save_file_list_cache', lambda _, __, ___: None)
-  monkeypatch.setattr(pc, 'compile_all',
-                      partial(_mock_python_compile_all, command_list))
-  monkeypatch.setattr(pc, 'expand_lib',
-                      partial(_mock_python_expand_lib, command_list))
-  monkeypatch.setattr(pc, 'perform_linking',
-                      partial(_mock_python_perform_linking, command_list))
-  monkeypatch.setattr(pc, 'create_initializers',
-                      partial(_mock_py_create_initializers, command_list))
-  monkeypatch.setattr(pc, 'coding_guidelines_check',
-                      partial(_mock_coding_guidelines_check, command_list))
-  monkeypatch.setattr(su, 'download_cached_item',
-                      partial(_mock_download_cached_item, command_list))
-  monkeypatch.setattr(rp, 'zip_all_currdir',
-                      partial(_mock_zip_all_currdir, command_list))
-
-
-def _get_commands(monkeypatch, filesystem_dict, rules_list):
-  """Test command sequence."""
+def _get_commands(monkeypatch, filesystem_dict, rules_list,
+                  patch_snapshots=None):
+  """Test command sequence. Every rule is built unless patch_snapshots
+  mocks file list snapshots otherwise."""
   command_list = []
-  _patch_os(monkeypatch, filesystem_dict, command_list)
+  mu.patch_os(monkeypatch, filesystem_dict, command_list)
+  if patch_snapshots:
+    patch_snapshots(monkeypatch, command_list)
   monkeypatch.setattr(su, 'TEST_MODE_EXECUTION', True)
   dependency_dict = {}
   bu.apply_rules(rules_list, dependency_dict)
@@ -279,24 +51,11 @@ def _get_commands(monkeypatch, filesystem_dict, rules_list):
 
 def _get_return_code(monkeypatch, filesystem_dict, rules_list):
   """Get return status of command execution."""
-  _patch_os(monkeypatch, filesystem_dict, [])
+  mu.patch_os(monkeypatch, filesystem_dict, [])
   monkeypatch.setattr(su, 'TEST_MODE_EXECUTION', True)
   return bu.apply_rules(rules_list, {})[0]
 
 
-def _get_filesystem_dict():
-  """Get in-memory filesystem dictionary."""
-  file_list = [
-      f.strip() for f in _read_test_resource('file_list.txt').split('\n')
-      if f.strip()]
-  filesystem_dict = dict([(f, '') for f in file_list])
-  for file_name in file_list:
-    if os.path.basename(file_name) in TEST_RESOURCES:
-      filesystem_dict[file_name] = _read_test_resource(
-          file_name.replace(os.sep, '_') + '.txt')
-  return filesystem_dict
-
-
 def test_null_sequence(monkeypatch):
   """Test command sequence."""
   assert 0 == _get_return_code(monkeypatch, {}, [])
@@ -304,7 +63,7 @@ def test_null_sequence(monkeypatch):
 
 def test_clean(monkeypatch):
   """Test clean command sequence."""
-  expected_commands = _read_test_resource('clean_command_steps.txt').strip()
+  expected_commands = mu.read_test_resource('clean_command_steps.txt').strip()
   actual_cmds, dep_list = _get_commands(monkeypatch, {}, [cc.CLEAN_COMMAND])
   if (expected_commands, []) != (actual_cmds, dep_list):
     _write_test_resource('clean_command_steps.txt', actual_cmds)
@@ -327,12 +86,12 @@ def _test_command_utility(monkeypatch, op_command, rules_text,
     lines = lines.replace(su.RULE_ROOT_NAME, '\n' + su.RULE_ROOT_NAME)
     return '{}\n'.format(lines.strip('\n'))
 
-  filesystem_dict = _get_filesystem_dict()
+  filesystem_dict = mu.get_filesystem_dict()
   rules_list = [op_command]
   rules_list.extend([r for r in rules_text.split() if r])
   actual_commands, actual_dep_list = _get_commands(
       monkeypatch, filesystem_dict, rules_list)
-  expected_build_deps = _read_test_resource(build_deps_file)
+  expected_build_deps = mu.read_test_resource(build_deps_file)
   expected_dep_list = [
       l.strip() for l in expected_build_deps.split('\n') if l.strip()]
   if expected_dep_list != actual_dep_list:
@@ -340,7 +99,7 @@ def _test_command_utility(monkeypatch, op_command, rules_text,
                          _get_debug_dep_list(actual_dep_list))
     assert expected_dep_list == actual_dep_list
   actual_commands = actual_commands.strip()
-  expected_commands = _read_test_resource(build_commands_file).strip()
+  expected_commands = mu.read_test_resource(build_commands_file).strip()
   if expected_commands != actual_commands:
     _write_test_resource(build_commands_file, '\n'.join([actual_commands, '']))
     assert expected_commands == actual_commands
@@ -390,6 +149,112 @@ def test_complex_java_command(monkeypatch):
                         'complex_java_command_steps.txt')
 
 
+def test_parallel_java_command(monkeypatch):
+  """Test that parallel builds run the same commands as sequential builds."""
+  rules_text = """
+    mool.src.main.java.some.work.ALL
+    mool.src.test.java.some.other.work.MultipleTestClasses
+    mool.src.test.java.some.work.DriverTest"""
+  rules_list = [r for r in rules_text.split() if r]
+  sequential_params = [cc.TEST_COMMAND]
+  sequential_params.extend(rules_list)
+  parallel_params = [cc.TEST_COMMAND, '-j', '4']
+  parallel_params.extend(rules_list)
+  expected_commands, expected_dep_list = _get_commands(
+      monkeypatch, mu.get_filesystem_dict(), sequential_params)
+  actual_commands, actual_dep_list = _get_commands(
+      monkeypatch, mu.get_filesystem_dict(), parallel_params)
+  assert expected_dep_list == actual_dep_list
+  assert (sorted(expected_commands.split('\n')) ==
+          sorted(actual_commands.split('\n')))
+
+
+def _patch_compile_snapshots(compile_up_to_date, monkeypatch, command_list):
+  """Mock file list snapshots of rules which all need a build, but whose
+  compile snapshots are up to date if compile_up_to_date is set."""
+  def _get_cache_file_name(args):
+    """Get the snapshot file name of needs_build and save_file_list_cache
+    arguments."""
+    return args[6] if len(args) > 6 else su.CACHE_FILE_NAME
+
+  def _needs_build(*args):
+    """Mock snapshot check."""
+    return (not compile_up_to_date or
+            _get_cache_file_name(args) != su.COMPILE_CACHE_FILE_NAME)
+
+  def _save_file_list_cache(*args):
+    """Mock snapshot save."""
+    command_list.append(['mock_save_snapshot', args[0],
+                         _get_cache_file_name(args)])
+
+  monkeypatch.setattr(fs, 'needs_build', _needs_build)
+  monkeypatch.setattr(fs, 'save_file_list_cache', _save_file_list_cache)
+
+
+def test_relink_java_command(monkeypatch):
+  """Test rules bundling their dependencies are linked again without
+  compiling when no API they compile against changed."""
+  rules_text = """
+    mool.src.main.java.some.work.DriverFromDriverLibWithIncludedDeps
+    mool.src.main.java.some.work.DriverLibWithExcludedDeps"""
+  rules_list = [cc.BUILD_COMMAND]
+  rules_list.extend(rules_text.split())
+  actual_commands = _get_commands(
+      monkeypatch, mu.get_filesystem_dict(), rules_list,
+      partial(_patch_compile_snapshots, True))[0].strip()
+  expected_commands = mu.read_test_resource(
+      'relink_java_command_steps.txt').strip()
+  if expected_commands != actual_commands:
+    _write_test_resource('relink_java_command_steps.txt',
+                         '\n'.join([actual_commands, '']))
+    assert expected_commands == actual_commands
+  # A changed API compiles the rules again.
+  compile_commands = _get_commands(
+      monkeypatch, mu.get_filesystem_dict(), rules_list,
+      partial(_patch_compile_snapshots, False))[0].split('\n')
+  work_dir = os.path.join(su.BUILD_WORK_DIR, 'src', 'main', 'java', 'some',
+                          'work', 'DriverLibWithIncludedDeps')
+  assert 'mock_remove {}'.format(os.path.join(
+      work_dir, su.COMPILE_CACHE_FILE_NAME)) not in compile_commands
+  assert any([c.startswith(su.JAVA_COMPILER) and
+              os.path.join(work_dir, 'target') in c
+              for c in compile_commands])
+  assert 'mock_save_snapshot {} {}'.format(
+      work_dir, su.COMPILE_CACHE_FILE_NAME) in compile_commands
+
+
+def test_build_profile(monkeypatch, tmpdir):
+  """Test trace event profile of a parallel build."""
+  profile_file = str(tmpdir.join('out.json'))
+  _get_commands(monkeypatch, mu.get_filesystem_dict(),
+                [cc.TEST_COMMAND, '-j', '2', '--profile=' + profile_file,
+                 'mool.cc.samples.factorial_test'])
+  with open(profile_file, 'r') as file_object:
+    events = json.load(file_object)['traceEvents']
+  spans = [e for e in events if e['ph'] == 'X']
+  lane_names = dict([(e['tid'], e['args']['name']) for e in events
+                     if e['ph'] == 'M'])
+  names = set([e['name'] for e in spans])
+  assert set(['load_rules', 'load_bld_file', 'rule_graph', 'rule_setup',
+              'needs_build', 'build_commands']).issubset(names)
+  rule_spans = dict([(e['name'], e) for e in spans if e['cat'] == 'rule'])
+  assert set(['mool.cc.common.some_lib', 'mool.cc.samples.factorial',
+              'mool.cc.samples.factorial_test']) == set(rule_spans)
+  test_spans = [e for e in spans if e['cat'] == 'test']
+  assert ['mool.cc.samples.factorial_test'] == [e['name'] for e in test_spans]
+  test_span = test_spans[0]
+  # Tests run after the build, on their own workers.
+  assert test_span['ts'] >= max([e['ts'] + e['dur']
+                                 for e in rule_spans.values()])
+  assert lane_names[test_span['tid']].startswith('bu-worker-')
+  commands = [e for e in spans if e['cat'] == 'command' and
+              e['tid'] == test_span['tid'] and
+              test_span['ts'] <= e['ts'] and
+              e['ts'] + e['dur'] <= test_span['ts'] + test_span['dur']]
+  assert 'TEST_VALGRIND_PREFIX' in [e['name'] for e in commands]
+  assert not bp.PROFILER.is_enabled()
+
+
 def test_file_coll_command(monkeypatch):
   """Test file collection rule."""
   rules_text = 'mool.py.first_service.first_module.zipped_archive'
@@ -418,7 +283,7 @@ def test_complex_python_command(monkeypatch):
 
 def test_build_all(monkeypatch):
   """Test list of effective build rules with ALL command."""
-  filesystem_dict = _get_filesystem_dict()
+  filesystem_dict = mu.get_filesystem_dict()
   rules_text = ('mool.cc.samples.ALL mool.cc.common.ALL '
                 'mool.src.main.java.some.work.ALL '
                 'mool.py.first_service.first_module.ALL '
@@ -426,7 +291,7 @@ def test_build_all(monkeypatch):
   rules_list = [cc.BUILD_COMMAND]
   rules_list.extend([r for r in rules_text.split() if r])
   _, dependency_list = _get_commands(monkeypatch, filesystem_dict, rules_list)
-  expected_list = _read_test_resource('all_rules_list.txt').strip().split()
+  expected_list = mu.read_test_resource('all_rules_list.txt').strip().split()
   actual_list = [d for d in dependency_list if su.RULE_ROOT_NAME in d]
   if expected_list != actual_list:
     _write_test_resource('all_rules_list.txt', '\n'.join(actual_list))
@@ -435,7 +300,7 @@ def test_build_all(monkeypatch):
 
 def test_build_lightrules(monkeypatch):
   """Test list of effective build rules with LIGHTRULES command."""
-  filesystem_dict = _get_filesystem_dict()
+  filesystem_dict = mu.get_filesystem_dict()
   rules_text = ('mool.cc.samples.LIGHTRULES mool.cc.common.LIGHTRULES '
                 'mool.src.main.java.some.work.LIGHTRULES '
                 'mool.py.first_service.first_module.LIGHTRULES '
@@ -443,7 +308,7 @@ def test_build_lightrules(monkeypatch):
   rules_list = [cc.BUILD_COMMAND]
   rules_list.extend([r for r in rules_text.split() if r])
   _, dependency_list = _get_commands(monkeypatch, filesystem_dict, rules_list)
-  expected_list = _read_test_resource('light_rules_list.txt').strip().split()
+  expected_list = mu.read_test_resource('light_rules_list.txt').strip().split()
   actual_list = [d for d in dependency_list if su.RULE_ROOT_NAME in d]
   if expected_list != actual_list:
     _write_test_resource('light_rules_list.txt', '\n'.join(actual_list))
@@ -458,7 +323,7 @@ def test_submit_queue_list(monkeypatch):
     actual_tests = su.get_affected_rules(changed_files)
     assert expected_tests == actual_tests
 
-  _patch_os(monkeypatch, _get_filesystem_dict(), [])
+  mu.patch_os(monkeypatch, mu.get_filesystem_dict(), [])
   _validate_test_list([], [])
   _validate_test_list(
       ['mool.cc.samples.factorial_test',
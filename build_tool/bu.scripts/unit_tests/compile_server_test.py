@@ -0,0 +1,61 @@
+"""Unit tests for compile_server."""
+import StringIO
+import subprocess
+import sys
+
+import pytest
+
+import mool.compile_server as cs
+
+
+FAKE_JAVA = """#!{}
+import os
+import sys
+open(os.path.join(os.path.dirname(sys.argv[0]), 'starts'), 'a').write('x')
+while True:
+  line = sys.stdin.readline()
+  if not line:
+    break
+  args = [sys.stdin.readline().rstrip() for _ in range(int(line))]
+  if 'Crash.java' in args[-1]:
+    break
+  output = ' '.join(args)
+  sys.stdout.write('{{}} {{}}\\n{{}}'.format(int('Bad' in output), len(output),
+                                         output))
+  sys.stdout.flush()
+"""
+
+
+def test_compile_server(monkeypatch, tmpdir):
+  """Test javac commands are run by long lived workers."""
+  jdk_dir = tmpdir.mkdir('jdk')
+  jdk_dir.join('java').write(FAKE_JAVA.format(sys.executable))
+  jdk_dir.join('javac').write('#!/bin/sh\n')
+  for file_name in ['java', 'javac']:
+    jdk_dir.join(file_name).chmod(0755)
+  tmpdir.join('lib', 'b.jar').write('', ensure=True)
+  tmpdir.join('lib', 'a.jar').write('')
+  javac = str(jdk_dir.join('javac'))
+  cwd = str(tmpdir)
+  assert None == cs.get_request([javac, '-J-Xmx1g', 'A.java'], cwd)
+  assert ((str(jdk_dir.join('java')), '-source', '1.8'),
+          ['-source', '1.8', '-cp',
+           '{0}/lib/a.jar:{0}/lib/b.jar:/abs/c.jar'.format(cwd), '-d',
+           cwd + '/out', '-nowarn', cwd + '/A.java']) == cs.get_request(
+               [javac, '-source', '1.8', '-cp', 'lib/*:/abs/c.jar', '-d',
+                'out', '-nowarn', 'A.java'], cwd)
+  server = cs.CompileServer(str(tmpdir.join('server')), True)
+  assert not server.run(['ls', 'A.java'], cwd)
+  stderr = StringIO.StringIO()
+  monkeypatch.setattr(sys, 'stderr', stderr)
+  assert server.run([javac, '-d', 'out', 'A.java'], cwd)
+  assert server.run([javac, '-d', 'out', 'B.java'], cwd)
+  assert '-d {0}/out {0}/A.java-d {0}/out {0}/B.java'.format(
+      cwd) == stderr.getvalue()
+  with pytest.raises(subprocess.CalledProcessError):
+    server.run([javac, '-d', 'out', 'Bad.java'], cwd)
+  assert 'x' == jdk_dir.join('starts').read()
+  # Commands run as processes once a worker fails.
+  assert not server.run([javac, '-d', 'out', 'Crash.java'], cwd)
+  assert not server.run([javac, '-d', 'out', 'A.java'], cwd)
+  assert 'x' == jdk_dir.join('starts').read()
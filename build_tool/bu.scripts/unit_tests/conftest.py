@@ -0,0 +1,17 @@
+"""Test configuration shared by all the unit tests. Pytest loads it before any
+test module."""
+import os
+
+# We need to override the environment variables before loading the shared_utils
+# module.
+MOCKED_ENVIRONS = ('BUILD_OUT_DIR', 'BUILD_ROOT', 'BUILD_WORK_DIR',
+                   'BU_SCRIPT_DIR', 'CC_COMPILER', 'CC_INSTALL_PREFIX',
+                   'GTEST_MAIN_LIB', 'GTEST_MOCK_LIB', 'JAR_SEARCH_PATH',
+                   'JAVA_HOME', 'PEP8_BINARY', 'PROTO_COMPILER',
+                   'PYTHON_PROTOBUF_DIR', 'BOOST_DIR', 'THRIFT_DIR')
+os.environ = dict([(k, 'TEST_{}'.format(k)) for k in MOCKED_ENVIRONS])
+os.environ['JAVA_COMPILER'] = 'TEST_JAVA_HOME/bin/javac -Xlint'
+os.environ['JAVA_TEST_DEFAULT_JARS'] = 'test_default1.jar test_default2.jar'
+os.environ['JAVA_PROTOBUF_JAR'] = 'test_java_protobuf.jar'
+os.environ['JAVA_DEFAULT_VERSION'] = 'bad_version'
+os.environ['VALGRIND_PREFIX'] = 'TEST_VALGRIND_PREFIX TEST_VALGRIND_PARAMS'
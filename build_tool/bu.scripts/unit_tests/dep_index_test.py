@@ -0,0 +1,56 @@
+"""Unit tests for dep_index."""
+import os
+
+import mool.build_file_cache as bfc
+import mool.dep_index as di
+import mool.shared_utils as su
+
+
+def test_dep_index(monkeypatch, tmpdir):
+  """Test changed files map to the rules depending on them transitively."""
+  monkeypatch.setattr(su, 'TEST_MODE_EXECUTION', False)
+  monkeypatch.setattr(bfc, 'BUILD_FILE_CACHE',
+                      bfc.BuildFileCache(str(tmpdir.join('.bld_index'))))
+  root = tmpdir.mkdir('root')
+  prebuilt_dir = tmpdir.mkdir('prebuilt')
+  monkeypatch.setitem(os.environ, 'PREBUILT_DIR', str(prebuilt_dir))
+  root.mkdir('lib').join('BLD').write(
+      '"lib": {"rule_type": "java_lib", "srcs": ["A.java"]},\n'
+      '"other": {"rule_type": "java_lib", "srcs": ["B.java"]},\n'
+      '"native": {"rule_type": "cc_lib", "srcs": ["c.cc"],\n'
+      '           "precompiled_deps": ["env.PREBUILT_DIR/libc.a"],\n'
+      '           "sys_deps": ["-lpthread", "env.PREBUILT_DIR/libd.a"]}')
+  root.mkdir('app').join('BLD').write(
+      '"app": {"rule_type": "java_bin", "deps": ["mool.lib.lib"]},\n'
+      '"app_test": {"rule_type": "java_test", "deps": [".app"]}')
+  index_file = str(tmpdir.join('.dep_index'))
+  lib_file = str(root.join('lib', 'A.java'))
+  dep_index = di.DepIndex(str(root), index_file)
+  assert 2 == dep_index.refresh()
+  assert ['mool.app.app', 'mool.app.app_test', 'mool.lib.lib'] == (
+      dep_index.get_affected_rules([lib_file]))
+  assert ['mool.lib.other'] == dep_index.get_affected_rules(
+      [str(root.join('lib', 'B.java'))])
+  assert [] == dep_index.get_affected_rules([str(root.join('README'))])
+  # Precompiled libraries are owned by the rules linking them.
+  for lib_name in ['libc.a', 'libd.a']:
+    assert ['mool.lib.native'] == dep_index.get_affected_rules(
+        [str(prebuilt_dir.join(lib_name))])
+  # A new process reads only the BLD files changed since.
+  root.join('app', 'BLD').write(
+      '"app": {"rule_type": "java_bin", "deps": ["mool.lib.other"]}')
+  dep_index = di.DepIndex(str(root), index_file)
+  assert 1 == dep_index.refresh()
+  assert ['mool.lib.lib'] == dep_index.get_affected_rules([lib_file])
+  # Rules of a removed BLD file no longer show up.
+  root.join('app', 'BLD').remove()
+  assert ['mool.lib.other'] == dep_index.get_affected_rules(
+      [str(root.join('lib', 'B.java'))])
+  assert 0 == dep_index.refresh()
+  # Rules depending on all the rules of a BLD file depend on each of them.
+  root.mkdir('bundle').join('BLD').write(
+      '"bundle": {"rule_type": "file_coll", "deps": ["mool.lib.ALL"]}')
+  assert ['mool.bundle.bundle', 'mool.lib.other'] == (
+      dep_index.get_affected_rules([str(root.join('lib', 'B.java'))]))
+  assert ['mool.bundle.bundle'] == dep_index.get_dependents(
+      ['mool.bundle.bundle'])
@@ -0,0 +1,35 @@
+"""Unit tests for file_commands."""
+import os
+import subprocess
+
+import pytest
+
+import mool.file_commands as fcmd
+import mool.shared_utils as su
+
+
+def test_file_commands(tmpdir):
+  """Test in-process execution of simple file commands."""
+  assert fcmd.is_file_command(su.get_mkdir_command('./a'))
+  assert fcmd.is_file_command(su.get_copy_command('a', 'b', True))
+  assert fcmd.is_file_command(su.get_copy_command('a', 'b', False))
+  assert not fcmd.is_file_command(['cp', '-r', 'a', 'b'])
+  assert not fcmd.is_file_command(['ln', '-s', 'a', 'b'])
+  source_file = tmpdir.join('source.txt')
+  source_file.write('text')
+  fcmd.run_file_commands([
+      su.get_mkdir_command('./out/sub'),
+      su.get_mkdir_command('./out/sub'),
+      su.get_copy_command(str(source_file), './out/sub/link.txt', True),
+      su.get_copy_command(str(source_file), './out/sub/link.txt', True),
+      su.get_copy_command(str(source_file), './out/copy.txt', False),
+      ['mv', './out/copy.txt', './out/moved.txt'],
+      ['chmod', '+x', './out/moved.txt']], str(tmpdir))
+  link_file = tmpdir.join('out', 'sub', 'link.txt')
+  assert str(source_file) == os.readlink(str(link_file))
+  assert not tmpdir.join('out', 'copy.txt').check()
+  moved_file = str(tmpdir.join('out', 'moved.txt'))
+  assert 'text' == open(moved_file).read()
+  assert os.access(moved_file, os.X_OK)
+  with pytest.raises(subprocess.CalledProcessError):
+    fcmd.run_file_commands([['cp', './missing.txt', './out']], str(tmpdir))
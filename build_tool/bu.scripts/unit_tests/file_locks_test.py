@@ -0,0 +1,36 @@
+"""Unit tests for file_locks."""
+import os
+import threading
+
+import mool.file_locks as fl
+
+
+def test_file_locks(tmpdir):
+  """Test builds wait on exclusive locks of the rules they share only."""
+  def _try_locks(exclusive_paths, shared_paths):
+    """Check if locks can be taken while other locks are held."""
+    taken = []
+
+    def _lock():
+      """Take and release the locks."""
+      with fl.FileLocks(exclusive_paths, shared_paths):
+        taken.append(True)
+
+    thread = threading.Thread(target=_lock)
+    thread.daemon = True
+    thread.start()
+    thread.join(0.5)
+    return bool(taken), thread
+
+  rule_a, rule_b = str(tmpdir.join('a')), str(tmpdir.join('locks', 'b'))
+  with fl.FileLocks([rule_a], [rule_b]):
+    assert os.path.exists(rule_b)
+    assert _try_locks([], [rule_b])[0]
+    is_taken, exclusive_thread = _try_locks([rule_b], [])
+    assert not is_taken
+    is_taken, shared_thread = _try_locks([], [rule_a])
+    assert not is_taken
+  for thread in [exclusive_thread, shared_thread]:
+    thread.join(5)
+    assert not thread.is_alive()
+  assert _try_locks([rule_a, rule_b], [])[0]
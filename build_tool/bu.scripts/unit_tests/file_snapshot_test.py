@@ -0,0 +1,61 @@
+"""Unit tests for file_snapshot."""
+import os
+
+import mool.file_snapshot as fs
+
+
+def test_content_snapshots(monkeypatch, tmpdir):
+  """Test rebuild checks based on content digests."""
+  work_dir = str(tmpdir.mkdir('work'))
+  src_file = tmpdir.join('Source.java')
+  src_file.write('class Source {}')
+  digest_file = str(tmpdir.join('.file_digests'))
+  monkeypatch.setattr(fs, 'DIGEST_CACHE', fs.DigestCache(digest_file))
+  fs.save_file_list_cache(work_dir, [str(src_file)], 'rule_hash')
+  assert not fs.needs_build(work_dir, [str(src_file)], 'rule_hash')
+  assert fs.needs_build(work_dir, [str(src_file)], 'other_rule_hash')
+  # Touching a file does not change its contents.
+  os.utime(str(src_file), (0, 0))
+  assert not fs.needs_build(work_dir, [str(src_file)], 'rule_hash')
+  fs.DIGEST_CACHE.save()
+  # Digests of unchanged files are loaded instead of being computed again.
+  monkeypatch.setattr(fs, 'DIGEST_CACHE', fs.DigestCache(digest_file))
+  with monkeypatch.context() as patch:
+    patch.setattr(fs, 'get_file_digest', None)
+    assert not fs.needs_build(work_dir, [str(src_file)], 'rule_hash')
+  src_file.write('class Source { int x; }')
+  assert fs.needs_build(work_dir, [str(src_file)], 'rule_hash')
+
+
+def test_stat_cache(monkeypatch, tmpdir):
+  """Test files are looked up once per build until they are written."""
+  file_list = [str(tmpdir.join('a', 'one.java')),
+               str(tmpdir.join('b', 'two.java')),
+               str(tmpdir.join('b', 'missing.java')),
+               str(tmpdir.join('missing_dir', 'three.java'))]
+  tmpdir.join('a', 'one.java').write('one', ensure=True)
+  tmpdir.join('b', 'two.java').write('two', ensure=True)
+  stat_cache = fs.StatCache(2)
+  stat_cache.prefetch(file_list)
+  monkeypatch.setattr(os, 'stat', None)
+  assert [True, True, False, False] == [
+      bool(stat_cache.get(f)) for f in file_list]
+  monkeypatch.undo()
+  tmpdir.join('b', 'missing.java').write('written by a rule')
+  assert not stat_cache.get(file_list[2])
+  stat_cache.invalidate([file_list[2]])
+  assert 17 == stat_cache.get(file_list[2]).st_size
+
+  # A rule writing a file while another rule looks it up.
+  racing_file = str(tmpdir.join('c', 'racing.java'))
+  list_dir = fs.StatCache._list_dir
+  def _list_and_write(dir_path):
+    listing = list_dir(dir_path)
+    tmpdir.join('c', 'racing.java').write('racing', ensure=True)
+    stat_cache.invalidate([racing_file])
+    return listing
+  monkeypatch.setattr(stat_cache, '_list_dir', _list_and_write)
+  stat_cache.prefetch([racing_file])
+  monkeypatch.undo()
+  assert 6 == stat_cache.get(racing_file).st_size
+  stat_cache.close()
@@ -0,0 +1,102 @@
+"""Unit tests for file_watcher and the watch mode."""
+import os
+
+import mool.core_cmds as cc
+import mool.file_watcher as fw
+import mool.rule_builder as rb
+import mool.shared_utils as su
+import unit_tests.mock_utils as mu
+
+
+class _ScriptedWatcher(object):
+  """File watcher reporting given changes, then stopping the watch."""
+  def __init__(self, changes, command_list):
+    """Initialize."""
+    self._changes = list(changes)
+    self._command_list = command_list
+    self.watched_files = set()
+
+  def set_files(self, file_paths):
+    """Set the files to watch."""
+    self.watched_files = set(file_paths)
+
+  def wait_for_changes(self, timeout=None):
+    """Report the next change."""
+    if not self._changes:
+      raise KeyboardInterrupt()
+    self._command_list.append(['mock_change'])
+    return self._changes.pop(0)
+
+  def close(self):
+    """Release resources."""
+
+
+def test_watch_rules(monkeypatch):
+  """Test that a saved change rebuilds and retests only affected rules, with
+  only the rules of changed BLD files loaded again."""
+  def _get_test_runs(commands):
+    """Get the tests run by a list of commands."""
+    return sorted([c[-1] for c in commands if c[0] == 'TEST_VALGRIND_PREFIX'])
+
+  builders = []
+  base_class = rb.RuleBuilder
+
+  class _RuleBuilder(base_class):
+    """Rule builder recording its instances."""
+    def __init__(self, rules_list):
+      """Initialize."""
+      base_class.__init__(self, rules_list)
+      builders.append(self)
+
+  command_list = []
+  mu.patch_os(monkeypatch, mu.get_filesystem_dict(), command_list)
+  monkeypatch.setattr(su, 'TEST_MODE_EXECUTION', True)
+  monkeypatch.setattr(rb, 'RuleBuilder', _RuleBuilder)
+  changed_file = os.path.join(su.BUILD_ROOT, 'cc', 'samples', 'factorial.cc')
+  rule_file = os.path.join(su.BUILD_ROOT, 'cc', 'samples', 'BLD')
+  watcher = _ScriptedWatcher([set([changed_file]), set([rule_file])],
+                             command_list)
+  rules = ['mool.cc.common.echo_utils_test', 'mool.cc.samples.factorial_test']
+  args = cc._parse_build_params(cc.WATCH_COMMAND, rules)
+  assert 0 == cc._watch_rules(args, watcher, {})
+  assert changed_file in watcher.watched_files
+  assert rule_file in watcher.watched_files
+  assert not [f for f in watcher.watched_files
+              if f.startswith(su.BUILD_OUT_DIR)]
+  first_change, second_change = [
+      i for (i, c) in enumerate(command_list) if c == ['mock_change']]
+  out_dir = su.BUILD_OUT_DIR
+  assert ([os.path.join(out_dir, 'cc', 'common', 'echo_utils_test'),
+           os.path.join(out_dir, 'cc', 'samples', 'factorial_test')] ==
+          _get_test_runs(command_list[:first_change]))
+  assert ([os.path.join(out_dir, 'cc', 'samples', 'factorial_test')] ==
+          _get_test_runs(command_list[first_change:second_change]))
+  assert ([os.path.join(out_dir, 'cc', 'samples', 'factorial_test')] ==
+          _get_test_runs(command_list[second_change:]))
+  assert 1 == len(builders)
+  rules_map = builders[0].get_rules_map()
+  old_details = dict(rules_map)
+  assert (['mool.cc.samples.factorial', 'mool.cc.samples.factorial_test'] ==
+          builders[0].reload_rule_files([rule_file]))
+  assert old_details['mool.cc.common.echo_utils'] is (
+      builders[0].get_rules_map()['mool.cc.common.echo_utils'])
+  assert old_details['mool.cc.samples.factorial'] is not (
+      builders[0].get_rules_map()['mool.cc.samples.factorial'])
+
+
+def test_file_watcher(tmpdir):
+  """Test detection of saved files."""
+  for watcher in [fw.PollingWatcher(0.01), fw.get_file_watcher()]:
+    source_file = tmpdir.join('source.cc')
+    source_file.write('int x;')
+    other_file = tmpdir.join('other.cc')
+    other_file.write('int y;')
+    watcher.set_files([str(source_file), str(other_file)])
+    assert set() == watcher.wait_for_changes(0.05)
+    source_file.write('int x = 1;')
+    assert set([str(source_file)]) == watcher.wait_for_changes(5)
+    # Editors often save by renaming a new file over the old one.
+    tmpdir.join('other.cc.new').write('int y = 1;')
+    os.rename(str(tmpdir.join('other.cc.new')), str(other_file))
+    assert set([str(other_file)]) == watcher.wait_for_changes(5)
+    watcher.close()
@@ -0,0 +1,32 @@
+"""Unit tests for jar_index."""
+import os
+import zipfile
+
+import mool.file_snapshot as fs
+import mool.jar_index as ji
+import mool.jar_merger as jm
+import mool.shared_utils as su
+
+
+def test_jar_index(monkeypatch, tmpdir):
+  """Test jars are scanned once for their entries and class collisions."""
+  jar_files = [str(tmpdir.join('one.jar')), str(tmpdir.join('two.jar'))]
+  for jar_file, text in zip(jar_files, ['one', 'two']):
+    with zipfile.ZipFile(jar_file, 'w') as jar_obj:
+      jar_obj.writestr('META-INF/MANIFEST.MF', text)
+      jar_obj.writestr('my/Same.class', 'same')
+      jar_obj.writestr('my/Clash.class', text)
+  index_dir = str(tmpdir.join('index'))
+  monkeypatch.setattr(ji, 'JAR_INDEX', ji.JarIndex(index_dir))
+  entries = ji.JAR_INDEX.get_entries(jar_files[0])
+  assert (3, 4) == (len(entries), entries['my/Same.class'][ji.SIZE_INDEX])
+  digests = [fs.DIGEST_CACHE.get_digest(f) for f in jar_files]
+  assert [digests[0]] == os.listdir(index_dir)
+  assert jm.check_jar_collisions(jar_files)
+  assert not jm.check_jar_collisions(jar_files[:1] + jar_files[:1])
+  monkeypatch.setattr(ji.JarIndex, '_scan', None)
+  assert entries == ji.JarIndex(index_dir).get_entries(jar_files[0])
+  temp_file = os.path.join(index_dir, '.tmp.saving')
+  su.write_file(temp_file, 'index being saved')
+  assert 1 == ji.JAR_INDEX.remove_unused(digests[1:])
+  assert sorted([digests[1], '.tmp.saving']) == sorted(os.listdir(index_dir))
@@ -0,0 +1,74 @@
+"""Unit tests for jar_merger."""
+import os
+import subprocess
+import zipfile
+
+import pytest
+
+import mool.jar_index as ji
+import mool.jar_merger as jm
+import mool.shared_utils as su
+
+
+def test_jar_merger(monkeypatch, tmpdir):
+  """Test jar entries are merged as they are stored, without the jar tool,
+  and merged again from the previous output."""
+  big_text = ''.join([str(i) for i in xrange(300000)])
+  jar_files = [str(tmpdir.join('one.jar')), str(tmpdir.join('two.jar'))]
+  with zipfile.ZipFile(jar_files[0], 'w') as jar_obj:
+    jar_obj.writestr('META-INF/MANIFEST.MF', 'Manifest-Version: 1.0\n')
+    jar_obj.writestr('META-INF/services/my.Service', 'my.One\n')
+    jar_obj.writestr('my/Big.class', big_text, zipfile.ZIP_DEFLATED)
+    jar_obj.writestr('my/Same.class', 'same')
+  with zipfile.ZipFile(jar_files[1], 'w') as jar_obj:
+    jar_obj.writestr('META-INF/services/my.Service', '# Comment\nmy.Two\n')
+    jar_obj.writestr('my/Same.class', 'same')
+    # Like the jar tool, write sizes in a data descriptor after the data.
+    zip_info = zipfile.ZipInfo('my/Two.class')
+    zip_info.flag_bits = jm.DATA_DESCRIPTOR_FLAG
+    jar_obj.writestr(zip_info, 'two', zipfile.ZIP_DEFLATED)
+  monkeypatch.setattr(subprocess, 'check_call', None)
+  monkeypatch.setattr(ji, 'JAR_INDEX', ji.JarIndex(str(tmpdir.join('index'))))
+  main_class = 'my.' + 'very_long_package_name.' * 4 + 'Main'
+  out_file = str(tmpdir.join('out.jar'))
+  jm.do_merge(([], [], jar_files), out_file, main_class)
+  with zipfile.ZipFile(out_file, 'r') as jar_obj:
+    assert jar_obj.testzip() is None
+    assert ['META-INF/', 'META-INF/MANIFEST.MF', 'my/Big.class',
+            'my/Same.class', 'my/Two.class', 'META-INF/services/',
+            'META-INF/services/my.Service'] == jar_obj.namelist()
+    manifest_lines = jar_obj.read('META-INF/MANIFEST.MF').split('\r\n')
+    assert all([len(l) <= jm.MANIFEST_LINE_LENGTH for l in manifest_lines])
+    assert 'Main-Class: ' + main_class == ''.join(
+        [l[1:] if l.startswith(' ') else l for l in manifest_lines[2:]])
+    assert big_text == jar_obj.read('my/Big.class')
+    assert zipfile.ZIP_DEFLATED == jar_obj.getinfo('my/Big.class').compress_type
+    assert zipfile.ZIP_STORED == jar_obj.getinfo('my/Same.class').compress_type
+    assert 'two' == jar_obj.read('my/Two.class')
+    assert set(['my.One', 'my.Two']) == set(
+        jar_obj.read('META-INF/services/my.Service').split('\n'))
+  # Merging again only reads the changed jar and reuses the previous output.
+  state_dir = su.get_output_state_dir(out_file)
+  assert os.path.samefile(
+      out_file, os.path.join(state_dir, jm.PREVIOUS_JAR_FILE_NAME))
+  os.remove(out_file)
+  with zipfile.ZipFile(jar_files[1], 'a') as jar_obj:
+    jar_obj.writestr('my/Three.class', 'three')
+  scanned_jars = []
+  scan_jar = jm.JarMerger._scan_jar
+  monkeypatch.setattr(jm.JarMerger, '_scan_jar', lambda self, *args: (
+      scanned_jars.append(args[0]) or scan_jar(self, *args)))
+  jm.do_merge(([], [], jar_files), out_file, main_class)
+  assert [jar_files[1]] == scanned_jars
+  with zipfile.ZipFile(out_file, 'r') as jar_obj:
+    assert jar_obj.testzip() is None
+    assert ['META-INF/', 'META-INF/MANIFEST.MF', 'my/Big.class',
+            'my/Same.class', 'my/Three.class', 'my/Two.class',
+            'META-INF/services/',
+            'META-INF/services/my.Service'] == jar_obj.namelist()
+    assert big_text == jar_obj.read('my/Big.class')
+    assert 'three' == jar_obj.read('my/Three.class')
+  with zipfile.ZipFile(jar_files[1], 'a') as jar_obj:
+    jar_obj.writestr('my/Big.class', 'different')
+  with pytest.raises(jm.Error):
+    jm.do_merge(([], [], jar_files), out_file, su.JAVA_FAKE_MAIN_CLASS)
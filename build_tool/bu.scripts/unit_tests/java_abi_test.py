@@ -0,0 +1,122 @@
+"""Unit tests for java_abi."""
+import struct
+import zipfile
+
+import mool.file_snapshot as fs
+import mool.java_abi as ja
+
+
+def _make_class_file(methods, constant, annotation=None, default=None):
+  """Make the class file of a class with an int constant and the given
+  methods, as (access flags, name, descriptor, code). The class is annotated
+  with an annotation type if given, and its methods get an int annotation
+  default if given."""
+  pool = []
+
+  def _add_utf8(text):
+    """Add a UTF8 constant."""
+    pool.append(struct.pack('>BH', 1, len(text)) + text)
+    return len(pool)
+
+  this_index = _add_utf8('my/Api')
+  pool.append(struct.pack('>BH', 7, this_index))
+  this_index = len(pool)
+  super_index = _add_utf8('java/lang/Object')
+  pool.append(struct.pack('>BH', 7, super_index))
+  super_index = len(pool)
+  pool.append(struct.pack('>Bi', 3, constant))
+  constant_index = len(pool)
+  field_data = struct.pack('>HHHHHIH', 0x19, _add_utf8('LIMIT'),
+                           _add_utf8('I'), 1, _add_utf8('ConstantValue'), 2,
+                           constant_index)
+  default_data = ''
+  if default is not None:
+    pool.append(struct.pack('>Bi', 3, default))
+    default_index = len(pool)
+    default_data = struct.pack('>HIcH', _add_utf8('AnnotationDefault'), 3, 'I',
+                               default_index)
+  method_data = struct.pack('>H', len(methods))
+  for access_flags, name, descriptor, code in methods:
+    method_data += struct.pack('>HHHHHI', access_flags, _add_utf8(name),
+                               _add_utf8(descriptor), 1 + bool(default_data),
+                               _add_utf8('Code'), len(code)) + code
+    method_data += default_data
+  class_attributes = struct.pack('>H', 0)
+  if annotation:
+    class_attributes = struct.pack(
+        '>HHIHHH', 1, _add_utf8('RuntimeVisibleAnnotations'), 6, 1,
+        _add_utf8(annotation), 0)
+  return ''.join([struct.pack('>IHHH', 0xCAFEBABE, 0, 52, len(pool) + 1)] +
+                 pool +
+                 [struct.pack('>HHHHH', 0x21, this_index, super_index, 0, 1),
+                  field_data, method_data, class_attributes])
+
+
+def test_java_abi(monkeypatch, tmpdir):
+  """Test rules are compiled again only when the API of their dependency
+  jars changes."""
+  monkeypatch.setattr(fs, 'DIGEST_CACHE',
+                      fs.DigestCache(str(tmpdir.join('.file_digests'))))
+  cache_file = str(tmpdir.join('.abi_digests'))
+  monkeypatch.setattr(ja, 'ABI_DIGEST_CACHE', ja.AbiDigestCache(cache_file))
+  jar_file = str(tmpdir.join('dep.jar'))
+  run_method = (0x1, 'run', '()V', 'code')
+  helper_method = (0x2, 'helper', '()V', 'code')
+
+  def _write_jar(methods, constant=1, extra_files=(), annotation=None,
+                 default=None):
+    """Write the dependency jar."""
+    with zipfile.ZipFile(jar_file, 'w') as jar_obj:
+      jar_obj.writestr('my/Api.class', _make_class_file(
+          methods, constant, annotation, default))
+      for file_name in extra_files:
+        jar_obj.writestr(file_name, 'text')
+    fs.DIGEST_CACHE.forget([jar_file])
+
+  def _needs_build():
+    """Checks if a rule compiled against the jar needs a build."""
+    return fs.needs_build(work_dir, [jar_file], 'rule_hash', None, [jar_file],
+                          ja.ABI_DIGEST_CACHE.get_digest)
+
+  def _save_snapshot():
+    """Save the snapshot of a rule compiled against the jar."""
+    fs.save_file_list_cache(work_dir, [jar_file], 'rule_hash', None,
+                            [jar_file], ja.ABI_DIGEST_CACHE.get_digest)
+
+  work_dir = str(tmpdir.mkdir('work'))
+  _write_jar([run_method, helper_method])
+  _save_snapshot()
+  api_digest = ja.ABI_DIGEST_CACHE.get_digest(jar_file)
+  # Method bodies, private members and member order are not in the API.
+  _write_jar([(0x1, 'run', '()V', 'other code')])
+  assert not _needs_build()
+  _write_jar([helper_method, run_method])
+  assert not _needs_build()
+  ja.ABI_DIGEST_CACHE.save()
+  monkeypatch.setattr(ja, 'ABI_DIGEST_CACHE', ja.AbiDigestCache(cache_file))
+  with monkeypatch.context() as patch:
+    patch.setattr(ja, 'get_class_api', None)
+    assert api_digest == ja.ABI_DIGEST_CACHE.get_digest(jar_file)
+  for methods, kwargs in [
+      ([(0x1, 'run', '(I)V', 'code')], {}),
+      ([(0x1, 'helper', '()V', 'code')], {}),
+      ([run_method], {'constant': 2}),
+      ([run_method], {'extra_files': ['my/data.txt']}),
+      ([run_method], {'annotation': 'Ljavax/inject/Inject;'}),
+      ([run_method], {'default': 1})]:
+    _write_jar(methods, **kwargs)
+    assert _needs_build()
+  # Annotation defaults decide which uses of an annotation compile.
+  _save_snapshot()
+  for default in [2, None]:
+    _write_jar([run_method], default=default)
+    assert _needs_build()
+  _write_jar([run_method], 1, [ja.PROCESSOR_SERVICE_FILE])
+  assert fs.DIGEST_CACHE.get_digest(jar_file) == (
+      ja.ABI_DIGEST_CACHE.get_digest(jar_file))
+  assert 11 == ja.ABI_DIGEST_CACHE.remove_unused(
+      [fs.DIGEST_CACHE.get_digest(jar_file)])
+  not_jar_file = tmpdir.join('not.jar')
+  not_jar_file.write('text')
+  assert fs.DIGEST_CACHE.get_digest(str(not_jar_file)) == (
+      ja.ABI_DIGEST_CACHE.get_digest(str(not_jar_file)))
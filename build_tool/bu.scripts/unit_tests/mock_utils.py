@@ -0,0 +1,259 @@
+"""In-memory filesystem and mocked build steps shared by unit tests."""
+import os
+import shutil
+import subprocess
+
+import mool.build_utils as bu
+import mool.file_commands as fcmd
+import mool.file_locks as fl
+import mool.file_snapshot as fs
+import mool.jar_merger as jm
+import mool.jar_testng_runner as jtr
+import mool.java_common as jc
+import mool.python_common as pc
+import mool.release_package as rp
+import mool.shared_utils as su
+import mool.test_process as tp
+
+from functools import partial
+
+THIS_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+TEST_RESOURCES = (su.BUILD_FILE_NAME, su.SUBMIT_QUEUE_FILE_NAME)
+
+
+def get_test_resource_file(file_name):
+  """Convert file name to test resource file path."""
+  return os.path.join(THIS_SCRIPT_DIR, 'test_data', file_name)
+
+
+def read_test_resource(file_name):
+  """Read text from test resource."""
+  file_path = get_test_resource_file(file_name)
+  with open(file_path, 'r') as file_object:
+    return file_object.read()
+
+
+def _mock_do_merge(command_list, lib_details, jar_out_file, main_class):
+  """Mock implementation of jar merger utility."""
+  command_list.append(['mock_jar_merger',
+                       str([lib_details, jar_out_file, main_class])])
+
+
+def _mock_extract_jar(command_list, jar_path):
+  """Mock the extraction of files, used in file collection"""
+  command_list.append(['mock_extract_jar', jar_path])
+
+
+def _mock_exists(filesystem_dict, command_list, file_path):
+  """Check if a path exists."""
+  command_list.append(['mock_ls', file_path])
+  if file_path.startswith('TEST_JAR_SEARCH_PATH' + os.sep):
+    return True
+  if file_path in ('TEST_GTEST_MAIN_LIB', 'TEST_GTEST_MOCK_LIB'):
+    return True
+  return file_path in filesystem_dict
+
+
+def _mock_isfile(filesystem_dict, command_list, file_path):
+  """Check if a path is a file."""
+  command_list.append(['mock_isfile', file_path])
+  return file_path in filesystem_dict
+
+
+def _mock_isdir(filesystem_dict, command_list, dir_path):
+  """Check if a directory exists."""
+  command_list.append(['mock_isdir', dir_path])
+  return dir_path in filesystem_dict
+
+
+def _mock_check_dirname(filesystem_dict, dir_name):
+  """Check if a dirname is valid."""
+  return dir_name in filesystem_dict
+
+
+def _mock_makedirs(command_list, dir_path):
+  """Make directory recursively."""
+  command_list.append(['mock_mkdir', '-p', dir_path])
+
+
+def _mock_rmtree(command_list, dir_path):
+  """Remove directory recursively."""
+  command_list.append(['mock_rmtree', dir_path])
+
+
+def _mock_oslistdir(dir_path):
+  """List current directory."""
+  return [os.path.join(dir_path, 'mock_file1'),
+          os.path.join(dir_path, 'mock_file2')]
+
+
+def _mock_osremove(command_list, file_path):
+  """Mock remove file path entry."""
+  command_list.append(['mock_remove', file_path])
+
+
+def _mock_chdir(command_list, dir_path):
+  """Change current directory."""
+  command_list.append(['mock_cd', dir_path])
+
+
+def _mock_download_cached_item(command_list, url, file_path):
+  """Download item from URL."""
+  command_list.append(['mock_download_cached_item', url, file_path])
+
+
+def _mock_check_call(command_list, command, **kargs):
+  """Mock command line command."""
+  mock_cmd = list(command)
+  mock_cmd.extend(['{}:{}'.format(k, v) for k, v in kargs.iteritems()])
+  command_list.append(mock_cmd)
+
+
+def _mock_run_file_commands(command_list, file_commands, cwd=None):
+  """Mock in-process file commands like command line commands."""
+  for command in file_commands:
+    if cwd:
+      _mock_check_call(command_list, command, cwd=cwd)
+    else:
+      _mock_check_call(command_list, command)
+
+
+def _mock_read_file(filesystem_dict, command_list, file_path):
+  """Mock file system reads."""
+  assert file_path in filesystem_dict
+  command_list.append(['mock_cat', file_path])
+  return filesystem_dict[file_path]
+
+
+def _mock_write_file(command_list, file_path, file_text):
+  """Mock file system writes."""
+  file_text = file_text.replace('\n', '\\n')
+  command_list.append(['mock_write', file_path, '"{}"'.format(file_text)])
+
+
+def _mock_python_compile_all(command_list, params):
+  """Mock python compiler step."""
+  command_list.append(['mock_python_compile_all', str(params)])
+
+
+def _mock_python_expand_lib(command_list, params):
+  """Mock python expand linked library in place."""
+  command_list.append(['mock_python_expand_lib', str(params)])
+
+
+def _mock_py_create_initializers(command_list, params):
+  """Mock python create_initializers call."""
+  command_list.append(['create_initializers', str(params)])
+
+
+def _mock_coding_guidelines_check(command_list, params):
+  """Mock additional python coding guidelines check."""
+  command_list.append(['mock_coding_guidelines_check', str(params)])
+
+
+def _mock_python_perform_linking(command_list, command_parts):
+  """Mock python linking step."""
+  command_list.append(['mock_python_perform_linking', str(command_parts)])
+
+
+def _mock_zip_all_currdir(command_list, command_parts):
+  """Mock python linking step."""
+  command_list.append(['mock_zip_all_currdir', str(command_parts)])
+
+
+def _mock_compare_java_version(command_list, rule_version, dep_version):
+  """Mock java version comparison check."""
+  command_list.append(['mock_java_version_comparison', rule_version,
+                       dep_version])
+  return True
+
+
+def _mock_check_jar_collisions(command_list, jar_list):
+  """Mock jar collision testing."""
+  mock_cmd = ['mock_check_jar_collisions']
+  mock_cmd.extend(jar_list)
+  command_list.append(mock_cmd)
+
+
+def _mock_extract_files_from_jars(command_list, work_dir, jar_list):
+  """Mock jar extraction in working directory."""
+  mock_cmd = ['mock_extract_files_from_jars', work_dir]
+  mock_cmd.extend(jar_list)
+  command_list.append(mock_cmd)
+
+
+def _mock_export_mvn_deps(command_list, command_parts):
+  """Mock export mvn dependencies."""
+  command_list.append(['mock_export_mvn_deps', str(command_parts)])
+
+
+def patch_os(monkeypatch, filesystem_dict, command_list):
+  """Apply monkeypatch on system libraries."""
+  monkeypatch.setattr(su, 'path_exists',
+                      partial(_mock_exists, filesystem_dict, command_list))
+  monkeypatch.setattr(su, 'path_isfile',
+                      partial(_mock_isfile, filesystem_dict, command_list))
+  monkeypatch.setattr(os.path, 'isdir',
+                      partial(_mock_isdir, filesystem_dict, command_list))
+  monkeypatch.setattr(os, 'makedirs', partial(_mock_makedirs, command_list))
+  monkeypatch.setattr(os, 'chdir', partial(_mock_chdir, command_list))
+  monkeypatch.setattr(os, 'listdir', _mock_oslistdir)
+  monkeypatch.setattr(os, 'remove', partial(_mock_osremove, command_list))
+  monkeypatch.setattr(shutil, 'rmtree', partial(_mock_rmtree, command_list))
+  monkeypatch.setattr(subprocess, 'check_call',
+                      partial(_mock_check_call, command_list))
+  monkeypatch.setattr(fcmd, 'run_file_commands',
+                      partial(_mock_run_file_commands, command_list))
+  monkeypatch.setattr(tp, 'run_test_process',
+                      partial(_mock_check_call, command_list))
+  monkeypatch.setattr(bu, 'SHOW_ERRORS', False)
+
+  monkeypatch.setattr(jc, 'compare_java_versions',
+                      partial(_mock_compare_java_version, command_list))
+  monkeypatch.setattr(jc, 'export_mvn_deps',
+                      partial(_mock_export_mvn_deps, command_list))
+  monkeypatch.setattr(jm, 'do_merge', partial(_mock_do_merge, command_list))
+  monkeypatch.setattr(jm, 'check_jar_collisions',
+                      partial(_mock_check_jar_collisions, command_list))
+  monkeypatch.setattr(jtr, '_extract_files_from_jars',
+                      partial(_mock_extract_files_from_jars, command_list))
+  monkeypatch.setattr(su, 'extract_all_currdir',
+                      partial(_mock_extract_jar, command_list))
+  monkeypatch.setattr(su, 'DUMMY_CC', 'DUMMY_CC_FILE')
+  monkeypatch.setattr(su, 'check_dirname',
+                      partial(_mock_check_dirname, filesystem_dict))
+  monkeypatch.setattr(su, 'read_file',
+                      partial(_mock_read_file, filesystem_dict, command_list))
+  monkeypatch.setattr(su, 'write_file',
+                      partial(_mock_write_file, command_list))
+  monkeypatch.setattr(fl, 'lock_working_dir', lambda _: None)
+  monkeypatch.setattr(fs, 'needs_build', lambda *_: True)
+  monkeypatch.setattr(fl, 'release_working_dir', lambda _: None)
+  monkeypatch.setattr(fs, 'save_file_list_cache', lambda *_: None)
+  monkeypatch.setattr(pc, 'compile_all',
+                      partial(_mock_python_compile_all, command_list))
+  monkeypatch.setattr(pc, 'expand_lib',
+                      partial(_mock_python_expand_lib, command_list))
+  monkeypatch.setattr(pc, 'perform_linking',
+                      partial(_mock_python_perform_linking, command_list))
+  monkeypatch.setattr(pc, 'create_initializers',
+                      partial(_mock_py_create_initializers, command_list))
+  monkeypatch.setattr(pc, 'coding_guidelines_check',
+                      partial(_mock_coding_guidelines_check, command_list))
+  monkeypatch.setattr(su, 'download_cached_item',
+                      partial(_mock_download_cached_item, command_list))
+  monkeypatch.setattr(rp, 'zip_all_currdir',
+                      partial(_mock_zip_all_currdir, command_list))
+
+
+def get_filesystem_dict():
+  """Get in-memory filesystem dictionary."""
+  file_list = [
+      f.strip() for f in read_test_resource('file_list.txt').split('\n')
+      if f.strip()]
+  filesystem_dict = dict([(f, '') for f in file_list])
+  for file_name in file_list:
+    if os.path.basename(file_name) in TEST_RESOURCES:
+      filesystem_dict[file_name] = read_test_resource(
+          file_name.replace(os.sep, '_') + '.txt')
+  return filesystem_dict
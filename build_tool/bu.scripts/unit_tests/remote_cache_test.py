@@ -0,0 +1,146 @@
+"""Unit tests for remote_cache."""
+import BaseHTTPServer
+import httplib
+import os
+import shutil
+import threading
+
+import mool.action_cache as ac
+import mool.remote_cache as rc
+import mool.shared_utils as su
+
+
+class _KeyValueRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Minimal HTTP key/value store serving a directory, standing in for a
+  real remote cache server."""
+
+  def _get_path(self):
+    """Map request path to a file path."""
+    name = os.path.normpath(self.path.lstrip('/'))
+    if name.startswith('..'):
+      return None
+    return os.path.join(self.server.root_dir, name)
+
+  def _send_file(self, with_body):
+    """Reply with the contents of a file."""
+    file_path = self._get_path()
+    if not file_path or not os.path.isfile(file_path):
+      self.send_error(httplib.NOT_FOUND)
+      return
+    self.send_response(httplib.OK)
+    self.send_header('Content-Length', str(os.path.getsize(file_path)))
+    self.end_headers()
+    if with_body:
+      with open(file_path, 'rb') as src_obj:
+        shutil.copyfileobj(src_obj, self.wfile)
+
+  def do_GET(self):  # pylint: disable=C0103
+    """Handle GET request."""
+    self._send_file(True)
+
+  def do_HEAD(self):  # pylint: disable=C0103
+    """Handle HEAD request."""
+    self._send_file(False)
+
+  def do_PUT(self):  # pylint: disable=C0103
+    """Handle PUT request."""
+    file_path = self._get_path()
+    if not file_path:
+      self.send_error(httplib.BAD_REQUEST)
+      return
+    remaining = int(self.headers.getheader('Content-Length'))
+    file_dir = os.path.dirname(file_path)
+    if not os.path.isdir(file_dir):
+      os.makedirs(file_dir)
+    temp_path = file_path + '.tmp.{}'.format(threading.current_thread().ident)
+    with open(temp_path, 'wb') as dst_obj:
+      while remaining:
+        chunk = self.rfile.read(min(remaining, rc.COPY_BUFFER_SIZE))
+        if not chunk:
+          break
+        dst_obj.write(chunk)
+        remaining -= len(chunk)
+    shutil.move(temp_path, file_path)
+    self.send_response(httplib.CREATED)
+    self.send_header('Content-Length', '0')
+    self.end_headers()
+
+  def log_message(self, log_format, *args):
+    """Keep access logs out of test output."""
+
+
+class _KeyValueServer(BaseHTTPServer.HTTPServer):
+  """Threaded key/value server over a directory."""
+  def __init__(self, root_dir, server_address):
+    """Initialize."""
+    BaseHTTPServer.HTTPServer.__init__(self, server_address,
+                                       _KeyValueRequestHandler)
+    self.root_dir = root_dir
+
+  def process_request(self, request, client_address):
+    """Serve each request on its own thread."""
+    thread = threading.Thread(target=self._process_request_thread,
+                              args=(request, client_address))
+    thread.daemon = True
+    thread.start()
+
+  def _process_request_thread(self, request, client_address):
+    """Serve a request."""
+    try:
+      self.finish_request(request, client_address)
+    except:
+      self.handle_error(request, client_address)
+    finally:
+      self.shutdown_request(request)
+
+
+def _check_remote_cache(tmpdir, out_dir, remote_url):
+  """Check sharing an entry between two local caches through remote cache."""
+  src_file = tmpdir.join('Source.java')
+  src_file.write('class Source {}')
+  out_file = out_dir.join('some', 'Source.jar')
+  out_file.write('jar contents', ensure=True)
+  rule_details = {su.SYMBOL_KEY: 'mool.some.Source', su.OUT_KEY: str(out_file)}
+  file_list = [str(src_file), str(out_file)]
+  command_list = [['javac', 'Source.java'], ['jar', 'cf', 'Source.jar']]
+  pusher = rc.RemoteCache(rc.get_backend(remote_url), True, 2)
+  cache = ac.ActionCache(str(tmpdir.join('cache1')), 1024, pusher)
+  cache_key = cache.get_key(rule_details, file_list, command_list)
+  cache.store(cache_key, rule_details)
+  # Pushes are done in the background until the end of the build.
+  cache.close()
+  assert 1 == pusher.pop_stats()['pushes']
+  out_file.remove()
+  puller = rc.RemoteCache(rc.get_backend(remote_url), False, 2)
+  other_cache = ac.ActionCache(str(tmpdir.join('cache2')), 1024, puller)
+  assert other_cache.restore(cache_key, rule_details)
+  assert 'jar contents' == out_file.read()
+  assert not other_cache.restore(cache_key[::-1], rule_details)
+  assert {'hits': 0, 'remote_hits': 1, 'misses': 1} == other_cache._stats
+  stats = puller.pop_stats()
+  assert (1, 1, 0) == (stats['hits'], stats['misses'], stats['errors'])
+  assert stats['bytes_down'] > len('jar contents')
+  # Transfer threads are stopped after every build and restarted on demand.
+  other_cache.close()
+  assert not other_cache.restore(cache_key[::-1], rule_details)
+  other_cache.close()
+
+
+def test_remote_cache(monkeypatch, tmpdir):
+  """Test sharing action cache entries over filesystem and HTTP backends."""
+  out_dir = tmpdir.mkdir('out')
+  monkeypatch.setattr(su, 'BUILD_OUT_DIR', str(out_dir))
+  _check_remote_cache(tmpdir.mkdir('fs'), out_dir,
+                      str(tmpdir.join('fs_remote')))
+  server = _KeyValueServer(str(tmpdir.mkdir('http_remote')),
+                           ('127.0.0.1', 0))
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  try:
+    _check_remote_cache(tmpdir.mkdir('http'), out_dir,
+                        'http://127.0.0.1:{}/cache'.format(
+                            server.server_address[1]))
+  finally:
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,40 @@
+"""Unit tests for rule_graph."""
+import pytest
+
+import mool.rule_graph as rg
+import mool.shared_utils as su
+
+
+def test_rule_graph():
+  """Test topological order and cycle diagnostics of rule graph."""
+  def _rules_map(edges):
+    """Create minimal rules map from (rule, deps) pairs."""
+    return dict([(r, {su.DEPS_KEY: d, su.COMPILE_DEPS_KEY: []})
+                 for (r, d) in edges])
+
+  # Deep graphs are sorted without any iteration limit.
+  num_rules = 100000
+  graph = rg.RuleGraph(_rules_map(
+      [('mool.r{:06d}'.format(i), ['mool.r{:06d}'.format(i + 1)])
+       for i in xrange(num_rules - 1)] +
+      [('mool.r{:06d}'.format(num_rules - 1), [])]))
+  topo_order = graph.get_topo_order()
+  assert range(num_rules - 1, -1, -1) == topo_order
+  assert [1] == graph.get_deps(0) and [0] == graph.get_rdeps(1)
+  bitset = graph.get_bitset(['mool.r099999', 'mool.r000007'])
+  assert 1 << 7 | 1 << 99999 == bitset
+  assert ['mool.r000007', 'mool.r099999'] == graph.get_bitset_symbols(bitset)
+  rule_set = graph.get_rule_set(bitset)
+  assert ['mool.r000007', 'mool.r099999'] == list(rule_set)
+  assert 2 == len(rule_set) and 'mool.r099999' in rule_set
+  assert 'mool.r000008' not in rule_set and 'mool.missing' not in rule_set
+  assert [] == list(graph.get_rule_set(0))
+  graph = rg.RuleGraph(_rules_map([
+      ('mool.a', ['mool.b']), ('mool.b', ['mool.c']),
+      ('mool.c', ['mool.d', 'mool.e']), ('mool.d', ['mool.b']),
+      ('mool.e', [])]))
+  with pytest.raises(rg.Error) as exc_info:
+    graph.get_topo_order()
+  assert str(exc_info.value).endswith('mool.b -> mool.c -> mool.d -> mool.b')
+  with pytest.raises(rg.Error):
+    rg.RuleGraph(_rules_map([('mool.a', ['mool.missing'])]))
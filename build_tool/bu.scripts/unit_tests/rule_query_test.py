@@ -0,0 +1,55 @@
+"""Unit tests for rule_query."""
+import json
+
+import pytest
+
+import extensions.rule_query as rq
+import mool.shared_utils as su
+import unit_tests.mock_utils as mu
+
+
+def test_rule_query(monkeypatch):
+  """Test queries over the rule graph, which build nothing."""
+  def _query(text, output_format='text'):
+    """Get result of a query as list of lines."""
+    return rq.run_query(text, output_format).split('\n')
+
+  command_list = []
+  mu.patch_os(monkeypatch, mu.get_filesystem_dict(), command_list)
+  monkeypatch.setattr(su, 'TEST_MODE_EXECUTION', True)
+  samples, common = 'mool.cc.samples.', 'mool.cc.common.'
+  assert [common + 'echo_utils', common + 'shared_headers',
+          samples + 'factorial', samples + 'factorial_main'] == _query(
+              'deps(mool.cc.samples.factorial_main, 1)')
+  assert [common + 'some_lib', samples + 'factorial',
+          samples + 'factorial_main', samples + 'factorial_test'] == _query(
+              'rdeps(mool.cc.samples.ALL, mool.cc.common.some_lib)')
+  assert [common + 'some_lib', samples + 'factorial',
+          samples + 'factorial_test'] == _query(
+              'somepath(mool.cc.samples.factorial_test, '
+              'mool.cc.common.some_lib)')
+  assert [samples + 'factorial_main', samples + 'factorial_test'] == _query(
+      'kind("cc_(bin|test)", mool.cc.samples.LIGHTRULES) - '
+      'mool.cc.samples.factorial_multi_src')
+  assert [samples + 'person_proto_main'] == _query(
+      'attr(weight, mool.cc.samples.ALL)')
+  assert [samples + 'factorial_main', samples + 'factorial_multi_src'] == (
+      _query('attr(sys_deps, -lre2, mool.cc.samples.ALL)'))
+  assert [samples + 'factorial', samples + 'factorial_main',
+          samples + 'factorial_test'] == _query(
+              'attr(_all_deps, some_lib, mool.cc.samples.ALL)')
+  assert ['digraph mool {', '  "{}factorial";'.format(samples),
+          '  "{}factorial_test";'.format(samples),
+          '  "{0}factorial_test" -> "{0}factorial";'.format(samples),
+          '}'] == _query('allpaths(mool.cc.samples.factorial_test, '
+                         'mool.cc.samples.factorial)', 'dot')
+  assert [{'deps': [samples + 'factorial'], 'name': samples + 'factorial_test',
+           'rule_type': 'cc_test'}] == json.loads(rq.run_query(
+               'kind(cc_test, mool.cc.samples.ALL)', 'json'))
+  for text in ['deps(mool.cc.samples.factorial', 'foo(mool.cc.samples.ALL)',
+               'kind(mool.cc.samples.ALL)', 'deps(mool.cc.samples.ALL, x)',
+               'mool.cc.samples.ALL +']:
+    with pytest.raises(rq.Error):
+      _query(text)
+  # Only BLD files were read.
+  assert not [c for c in command_list if c[0] != 'mock_cat']
@@ -0,0 +1,47 @@
+"""Unit tests for test_cache."""
+import mool.rule_builder as rb
+import mool.test_cache as tc
+import mool.test_process as tp
+import mool.test_runner as tr
+
+
+def test_test_cache(tmpdir):
+  """Test that passed tests are skipped until their inputs change."""
+  def _run_tests(use_cached=True):
+    """Run the test once and get its result."""
+    return tr.run_tests(
+        [tr.TestJob('mool.test', [['sh', str(test_script)]], 10,
+                    input_files=[str(test_script)])],
+        1, lambda commands: rb._run_commands(commands, tp.run_test_process),
+        tc.TestCache(cache_file), use_cached)[0]
+
+  cache_file = str(tmpdir.join('test_results'))
+  test_script = tmpdir.join('test.sh')
+  test_script.write('echo run')
+  assert not _run_tests().cached
+  result = _run_tests()
+  assert result.cached and tr.PASSED == result.status
+  assert '(cached) PASSED' == result.get_status_text()
+  assert not _run_tests(False).cached
+  test_script.write('echo changed; exit 1')
+  assert tr.FAILED == _run_tests().status
+  # A failed run forgets the earlier pass of the job.
+  test_script.write('echo run')
+  assert not _run_tests().cached
+  assert _run_tests().cached
+  # Passes of removed rules are dropped by bu gc.
+  test_cache = tc.TestCache(cache_file)
+  test_cache.forget_rules(['mool.test'])
+  test_cache.save()
+  assert not _run_tests().cached
+  # Concurrent builds keep the passes recorded by each other.
+  jobs = [tr.TestJob(r, [], 10) for r in ['mool.a_test', 'mool.b_test']]
+  test_caches = [tc.TestCache(cache_file), tc.TestCache(cache_file)]
+  for job, test_cache in zip(jobs, test_caches):
+    assert not test_cache.is_passed(job, 'key')
+  for job, test_cache in zip(jobs, test_caches):
+    test_cache.record(job, 'key', True)
+    test_cache.save()
+  test_cache = tc.TestCache(cache_file)
+  assert all([test_cache.is_passed(j, 'key') for j in jobs])
+  assert _run_tests().cached
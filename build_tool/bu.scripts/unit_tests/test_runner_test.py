@@ -0,0 +1,40 @@
+"""Unit tests for test_runner."""
+import pytest
+
+import mool.rule_builder as rb
+import mool.shared_utils as su
+import mool.test_process as tp
+import mool.test_runner as tr
+
+
+def test_test_runner():
+  """Test sharding, timeouts and buffered output of the test phase."""
+  testng_command = [su.JAVA_TESTNG_RUNNER, 'tests.jar',
+                    ['c{}'.format(i) for i in xrange(5)], '/results']
+  jobs = tr.get_test_jobs('mool.java.tests', [testng_command], None, 2)
+  assert [['c0', 'c3'], ['c1', 'c4'], ['c2']] == [
+      j.command_list[0][2] for j in jobs]
+  assert ['/results/shard0', '/results/shard1', '/results/shard2'] == [
+      j.command_list[0][3] for j in jobs]
+  assert 'mool.java.tests (shard 2/3)' == jobs[1].get_name()
+  assert 1 == len(tr.get_test_jobs('mool.java.tests', [testng_command],
+                                   None, 0))
+  jobs = [tr.TestJob('mool.passing', [['sh', '-c', 'echo passed']], 10),
+          tr.TestJob('mool.failing', [['sh', '-c', 'echo failed; exit 3']],
+                     10),
+          tr.TestJob('mool.hanging', [['sh', '-c', 'echo started; sleep 30']],
+                     0.5)]
+  results = tr.run_tests(
+      jobs, 3, lambda commands: rb._run_commands(commands,
+                                                 tp.run_test_process))
+  assert [tr.PASSED, tr.FAILED, tr.TIMED_OUT] == [r.status for r in results]
+  assert 'passed\n' == results[0].output
+  assert results[1].output.startswith('failed\nFailed with exit code 3')
+  assert results[2].output.startswith('started\nTimed out')
+  assert results[2].duration < 10
+  summary = tr.get_summary(results, 1.0)
+  assert summary.endswith('1 passed (0 cached), 1 failed, 1 timed out in '
+                          '1.00s ({:.2f}s of tests)'.format(
+                              sum([r.duration for r in results])))
+  with pytest.raises(tr.Error):
+    tr.check_results(results)
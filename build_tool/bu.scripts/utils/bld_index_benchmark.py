@@ -0,0 +1,118 @@
+#!/usr/bin/env python2.7
+"""Benchmark loading of BLD files with and without the compiled BLD index.
+
+Generates a tree of synthetic BLD files and measures:
+  parse : parsing every BLD file as JSON, i.e. loading without any index.
+  cold  : first load through the index, which parses and saves the index.
+  warm  : load from the saved index by a new process, i.e. fresh cache object.
+
+Usage: bld_index_benchmark.py [--files N] [--rules N] [--repeat N]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+if __name__ == '__main__':
+  SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(sys.argv[0])))
+  if SCRIPT_DIR != sys.path[0]:
+    sys.path.insert(0, SCRIPT_DIR)
+
+import utils.file_utils as fu
+
+# Importing shared utils requires a bu environment. The benchmark passes the
+# paths of its BLD files and index around, so nothing is ever written to these
+# directories.
+for env_var in ['BU_SCRIPT_DIR', 'BUILD_ROOT', 'BUILD_OUT_DIR',
+                'BUILD_WORK_DIR']:
+  os.environ.setdefault(env_var, tempfile.gettempdir())
+
+import mool.build_file_cache as bfc
+import mool.shared_utils as su
+
+RULE_TEMPLATE = """# Rule number {index}.
+"rule_{index}": {{
+    "rule_type": "java_lib",
+    "srcs": ["Source{index}.java", "Helper{index}.java"],
+    "deps": [":rule_{prev}", "mool.java.com.some.other.common.lib"],
+    "compileDeps": ["mool.java.com.some.third_party.guava"],
+    "maven_specs": {{
+        "group_id": "com.google.guava",
+        "artifact_id": "guava",
+        "version": "18.0"
+    }}
+}}"""
+
+
+def _create_bld_files(root_dir, num_files, num_rules):
+  """Create a tree of BLD files and return their paths."""
+  file_paths = []
+  for file_index in xrange(num_files):
+    file_dir = os.path.join(root_dir, 'pkg{}'.format(file_index % 100),
+                            'module{}'.format(file_index))
+    os.makedirs(file_dir)
+    file_path = os.path.join(file_dir, su.BUILD_FILE_NAME)
+    rules = [RULE_TEMPLATE.format(index=i, prev=max(0, i - 1))
+             for i in xrange(num_rules)]
+    fu.write_file(file_path, ',\n'.join(rules))
+    file_paths.append(file_path)
+  return file_paths
+
+
+def _time_it(func, repeat):
+  """Get the best run time of a function in seconds."""
+  best = None
+  for _ in xrange(repeat):
+    start = time.time()
+    func()
+    duration = time.time() - start
+    best = duration if best is None else min(best, duration)
+  return best
+
+
+def main():
+  """Run the benchmark."""
+  parser = argparse.ArgumentParser(description='BLD index benchmark.')
+  parser.add_argument('--files', type=int, default=2000,
+                      help='number of BLD files')
+  parser.add_argument('--rules', type=int, default=5,
+                      help='number of rules per BLD file')
+  parser.add_argument('--repeat', type=int, default=3,
+                      help='number of runs, the best one is reported')
+  args = parser.parse_args()
+  scratch_dir = fu.get_temp_dir(prefix='bld_index_benchmark')
+  try:
+    file_paths = _create_bld_files(os.path.join(scratch_dir, 'src'),
+                                   args.files, args.rules)
+    index_file = os.path.join(scratch_dir, bfc.INDEX_FILE_NAME)
+
+    def _parse():
+      """Parse all BLD files."""
+      for file_path in file_paths:
+        su.read_build_file(file_path)
+
+    def _load(remove_index):
+      """Load all BLD files through a new cache."""
+      if remove_index and os.path.exists(index_file):
+        os.remove(index_file)
+      cache = bfc.BuildFileCache(index_file)
+      for file_path in file_paths:
+        cache.get(file_path)
+      cache.save()
+
+    results = [('parse', _time_it(_parse, args.repeat)),
+               ('cold', _time_it(lambda: _load(True), args.repeat)),
+               ('warm', _time_it(lambda: _load(False), args.repeat))]
+    print 'Loaded {} BLD files with {} rules each, index size {} KB.'.format(
+        args.files, args.rules, os.path.getsize(index_file) / 1024)
+    for name, duration in results:
+      print '{:>6}: {:8.3f} seconds'.format(name, duration)
+  finally:
+    shutil.rmtree(scratch_dir)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,116 @@
+#!/usr/bin/env python2.7
+"""Benchmark simple file commands run as processes and in process.
+
+Build rules start by creating directories and linking their sources into the
+working directory. For every tree under build_tool/mool_tests this generates
+those commands for all the files of the tree, like cp_commands_list does, and
+measures:
+  fork      : running every command as a separate process.
+  in-process: running the commands through file_commands.run_file_commands.
+
+Usage: file_commands_benchmark.py [--copy] [--repeat N]
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+if __name__ == '__main__':
+  SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(sys.argv[0])))
+  if SCRIPT_DIR != sys.path[0]:
+    sys.path.insert(0, SCRIPT_DIR)
+
+import utils.file_utils as fu
+
+# Importing shared utils requires a bu environment. The benchmark only uses it
+# to generate commands, so nothing is ever written to these directories.
+for env_var in ['BU_SCRIPT_DIR', 'BUILD_ROOT', 'BUILD_OUT_DIR',
+                'BUILD_WORK_DIR']:
+  os.environ.setdefault(env_var, tempfile.gettempdir())
+
+import mool.file_commands as fcmd
+import mool.shared_utils as su
+
+MOOL_TESTS_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '..',
+    'mool_tests')
+
+
+def _get_commands(tree_dir, use_links):
+  """Get commands that mirror all the files of a tree."""
+  commands = []
+  dst_dirs = set()
+  for root, _, files in os.walk(tree_dir):
+    for file_name in sorted(files):
+      src_file = os.path.join(root, file_name)
+      dst_file = '.' + os.sep + os.path.relpath(src_file, tree_dir)
+      dst_dir = os.path.dirname(dst_file)
+      if dst_dir not in dst_dirs:
+        commands.append(su.get_mkdir_command(dst_dir))
+        dst_dirs.add(dst_dir)
+      commands.append(su.get_copy_command(src_file, dst_file, use_links))
+  return commands
+
+
+def _get_runners(commands):
+  """Get functions running the commands as processes and in process."""
+  def _fork(curr_dir):
+    """Run every command as a process."""
+    for command in commands:
+      subprocess.check_call(command, cwd=curr_dir)
+
+  def _in_process(curr_dir):
+    """Run all commands in this process."""
+    fcmd.run_file_commands(commands, curr_dir)
+
+  return _fork, _in_process
+
+
+def _time_it(func, work_dir, repeat):
+  """Get the best run time of a function in a fresh directory in seconds."""
+  best = None
+  for _ in xrange(repeat):
+    if os.path.exists(work_dir):
+      shutil.rmtree(work_dir)
+    os.makedirs(work_dir)
+    start = time.time()
+    func(work_dir)
+    duration = time.time() - start
+    best = duration if best is None else min(best, duration)
+  return best
+
+
+def main():
+  """Run the benchmark."""
+  parser = argparse.ArgumentParser(description='File commands benchmark.')
+  parser.add_argument('--copy', action='store_true',
+                      help='copy files instead of linking them')
+  parser.add_argument('--repeat', type=int, default=3,
+                      help='number of runs, the best one is reported')
+  args = parser.parse_args()
+  scratch_dir = fu.get_temp_dir(prefix='file_commands_benchmark')
+  try:
+    print '{:>10} {:>8} {:>10} {:>10} {:>8}'.format(
+        'tree', 'commands', 'fork', 'in-process', 'speedup')
+    for tree in sorted(os.listdir(MOOL_TESTS_DIR)):
+      tree_dir = os.path.join(MOOL_TESTS_DIR, tree)
+      if not os.path.isdir(tree_dir):
+        continue
+      commands = _get_commands(tree_dir, not args.copy)
+      work_dir = os.path.join(scratch_dir, tree)
+      fork, in_process = _get_runners(commands)
+      fork_time = _time_it(fork, work_dir, args.repeat)
+      in_process_time = _time_it(in_process, work_dir, args.repeat)
+      print '{:>10} {:8d} {:9.3f}s {:9.3f}s {:7.0f}x'.format(
+          tree, len(commands), fork_time, in_process_time,
+          fork_time / max(in_process_time, 1e-6))
+  finally:
+    shutil.rmtree(scratch_dir)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())